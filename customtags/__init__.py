@@ -1,3 +1,5 @@
 __version__ = '0.1 alpha'
 
+default_app_config = 'customtags.apps.CustomtagsConfig'
+
 from customtags.core import Options, Tag
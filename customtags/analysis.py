@@ -0,0 +1,314 @@
+"""
+Static cost analysis of tag grammars.
+
+The parser resolves ambiguity by trial parsing: ``Optional``, ``Repetition``
+and ``OneOf`` parse their contents against copies of the stream, and the
+``MultiValue`` arguments probe every argument that could follow them before
+consuming each value.  A grammar in which those branches start with the same
+tokens as what follows them parses correctly, but at a cost that can grow
+exponentially with the length of the tag.
+
+``analyze(options)`` walks the output of ``structure_arguments`` and reports
+the branch points whose FIRST sets overlap, the worst-case nesting of trial
+parses (the lookahead depth), and a rough estimate of the parse cost as a
+function of the number of tokens in the tag.  With ``CUSTOMTAGS_ANALYZE_GRAMMARS``
+set, every ``Options.initialize`` call warns about ambiguous grammars; the
+``customtags_grammar`` management command reports on every registered tag.
+"""
+import warnings
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from customtags.arguments import TagName, Constant, Argument, KeywordArgument, \
+     MultiValueBase, Flag, NodeList, MultiArgument, OneOf, BlockTag, Optional, \
+     Repetition, EndTag
+from customtags.exceptions import GrammarWarning
+
+#: the number of tokens in a tag used when estimating its parse cost
+DEFAULT_TOKENS = 20
+
+END_OF_TAG = '<end of tag>'
+
+
+def is_enabled():
+    try:
+        return getattr(settings, 'CUSTOMTAGS_ANALYZE_GRAMMARS', False)
+    except ImproperlyConfigured:
+        return False
+
+
+class First(object):
+    """
+    The set of tokens that an argument may start with.  ``any`` stands for an
+    arbitrary expression, less the tokens in ``exclude``.
+    """
+    def __init__(self, tokens=(), any=False, exclude=(), nullable=False):
+        self.tokens = set(tokens)
+        self.any = any
+        self.exclude = set(exclude)
+        self.nullable = nullable
+
+    def __repr__(self):
+        tokens = sorted(self.tokens)
+        if self.any:
+            tokens.insert(0, '<expression>')
+        return '{%s}' % ', '.join(tokens)
+
+    def union(self, other):
+        if self.any and other.any:
+            exclude = self.exclude & other.exclude
+        else:
+            exclude = self.exclude if self.any else other.exclude
+        return First(self.tokens | other.tokens, self.any or other.any, exclude,
+                     self.nullable or other.nullable)
+
+    def overlap(self, other):
+        """
+        Returns a description of the tokens both sets may start with, or None.
+        """
+        common = self.tokens & other.tokens
+        if self.any:
+            common |= set(t for t in other.tokens if _is_word(t)) - self.exclude
+        if other.any:
+            common |= set(t for t in self.tokens if _is_word(t)) - other.exclude
+        if self.any and other.any:
+            common.add('<expression>')
+        if common:
+            return ', '.join(sorted(common))
+        return None
+
+
+def _is_word(token):
+    return not token.startswith('{%') and token != END_OF_TAG
+
+
+class BranchPoint(object):
+    def __init__(self, kind, argument, overlap, width=1):
+        self.kind = kind
+        self.argument = argument
+        self.overlap = overlap
+        self.width = width
+
+    def __repr__(self):
+        return "<BranchPoint(%s): %r on %s>" % (self.kind, self.argument, self.overlap)
+
+    @property
+    def ambiguous(self):
+        return self.overlap is not None
+
+
+class GrammarReport(object):
+    def __init__(self, tagname):
+        self.tagname = tagname
+        self.branch_points = []
+        self.max_lookahead_depth = 0
+        self.max_loop_nesting = 0
+        self.max_lookahead_width = 1
+
+    def __repr__(self):
+        return "<GrammarReport(tagname=%s): %s>" % (self.tagname, self.complexity)
+
+    @property
+    def ambiguous(self):
+        return [point for point in self.branch_points if point.ambiguous]
+
+    @property
+    def complexity(self):
+        terms = []
+        if self.max_lookahead_depth:
+            terms.append('2^%d' % self.max_lookahead_depth)
+        if self.max_lookahead_width > 1:
+            terms.append('%d' % self.max_lookahead_width)
+        if self.max_loop_nesting == 1:
+            terms.append('n')
+        elif self.max_loop_nesting:
+            terms.append('n^%d' % self.max_loop_nesting)
+        return 'O(%s)' % (' * '.join(terms) or '1')
+
+    def estimated_cost(self, tokens=DEFAULT_TOKENS):
+        """
+        A rough upper bound of the budget steps spent parsing a tag of
+        *tokens* tokens; every trial parse is paid for twice.
+        """
+        return (2 ** self.max_lookahead_depth) * self.max_lookahead_width * \
+               max(tokens, 1) ** max(self.max_loop_nesting, 1)
+
+    def format(self, tokens=DEFAULT_TOKENS):
+        lines = ["%s: %s, lookahead depth %d, ~%d steps for %d tokens" % (
+            self.tagname, self.complexity, self.max_lookahead_depth,
+            self.estimated_cost(tokens), tokens)]
+        for point in self.ambiguous:
+            lines.append("    ambiguous %s %r: branches overlap on %s" % (
+                point.kind, point.argument, point.overlap))
+        return "\n".join(lines)
+
+
+def first(argument):
+    if isinstance(argument, basestring) or isinstance(argument, TagName):
+        return First(nullable=True)
+    if isinstance(argument, Constant):
+        return First([argument.value])
+    if isinstance(argument, (BlockTag, EndTag)) and argument.tagname is not None:
+        return First(['{%% %s' % argument.tagname])
+    if isinstance(argument, NodeList):
+        return First([END_OF_TAG])
+    if isinstance(argument, Repetition):
+        result = first_of_sequence(argument.arguments)
+        result.nullable = not argument.min_reps
+        return result
+    if isinstance(argument, Optional):
+        result = first_of_sequence(argument.arguments)
+        result.nullable = True
+        return result
+    if isinstance(argument, OneOf):
+        result = First()
+        for alternative in argument.arguments:
+            result = result.union(first(alternative))
+        return result
+    if isinstance(argument, MultiArgument):
+        return first_of_sequence(argument.arguments)
+    if isinstance(argument, Flag):
+        return First(argument.true_values + argument.false_values,
+                     nullable=not argument.required)
+    if isinstance(argument, KeywordArgument):
+        return First(any=True, exclude=argument.exclude,
+                     nullable=isinstance(argument, MultiValueBase) and not argument.required)
+    if isinstance(argument, Argument):
+        return First(any=True, exclude=argument.exclude,
+                     nullable=isinstance(argument, MultiValueBase) and not argument.required)
+    return First(any=True)
+
+
+def first_of_sequence(arguments, follow=None):
+    result = First(nullable=True)
+    for argument in arguments:
+        current = first(argument)
+        result = result.union(current)
+        result.nullable = current.nullable
+        if not current.nullable:
+            return result
+    if follow is not None:
+        result = result.union(follow)
+        result.nullable = follow.nullable
+    return result
+
+
+def analyze(options):
+    """
+    Returns a ``GrammarReport`` for an initialized ``Options`` object.
+    """
+    report = GrammarReport(options.tagname)
+    _analyze_sequence(list(options.arguments), First([END_OF_TAG]), report, 0, 0, [])
+    return report
+
+
+def _analyze_sequence(arguments, follow, report, depth, loops, outside):
+    """
+    *outside* mirrors the ``nextargs`` that ``MultiArgument`` hands to its last
+    argument: the arguments that follow the enclosing sequence.
+    """
+    for i, argument in enumerate(arguments):
+        rest = arguments[i+1:]
+        nextargs = rest or outside
+        continuation = first_of_sequence(rest, follow)
+
+        if isinstance(argument, OneOf):
+            _record_one_of(argument, report)
+            for alternative in argument.arguments:
+                _analyze_sequence([alternative], continuation, report, depth + 1,
+                                  loops, nextargs)
+
+        elif isinstance(argument, Optional):
+            is_repetition = isinstance(argument, Repetition)
+            kind = 'repetition' if is_repetition else 'optional'
+            inner = first_of_sequence(argument.arguments)
+            report.branch_points.append(
+                BranchPoint(kind, argument, inner.overlap(continuation)))
+            if is_repetition:
+                inner_follow = inner.union(continuation)
+                inner_loops = loops + 1
+            else:
+                inner_follow = continuation
+                inner_loops = loops
+            _analyze_sequence(argument.arguments, inner_follow, report, depth + 1,
+                              inner_loops, nextargs)
+
+        elif isinstance(argument, MultiValueBase):
+            probed = _probed_arguments(nextargs)
+            value = first(argument)
+            overlaps = [value.overlap(first(arg)) for arg in probed]
+            overlaps = [overlap for overlap in overlaps if overlap is not None]
+            report.branch_points.append(BranchPoint(
+                'multi_value', argument, ', '.join(overlaps) or None, len(probed)))
+            report.max_lookahead_width = max(report.max_lookahead_width, len(probed))
+            probe_depth = max([_clean_depth(arg) for arg in probed] + [0])
+            _note_depth(report, depth + probe_depth, loops + 1)
+
+        elif isinstance(argument, MultiArgument):
+            _analyze_sequence(argument.arguments, continuation, report, depth, loops,
+                              nextargs)
+
+        _note_depth(report, depth, loops)
+
+
+def _record_one_of(argument, report):
+    firsts = [first(alternative) for alternative in argument.arguments]
+    overlaps = []
+    for i, left in enumerate(firsts):
+        for right in firsts[i+1:]:
+            overlap = left.overlap(right)
+            if overlap is not None:
+                overlaps.append(overlap)
+    report.branch_points.append(BranchPoint(
+        'one_of', argument, ', '.join(overlaps) or None, len(firsts)))
+
+
+def _probed_arguments(rest):
+    """
+    The arguments a MultiValue argument probes before consuming each value:
+    every Optional that follows it, and the first required argument.
+    """
+    probed = []
+    for argument in rest:
+        probed.append(argument)
+        if not isinstance(argument, Optional):
+            break
+    return probed
+
+
+def _clean_depth(argument):
+    """
+    The nesting of stream copies made by ``clean_token`` on *argument*.
+    """
+    if isinstance(argument, MultiArgument):
+        return 1 + max([_clean_depth(arg) for arg in argument.arguments] + [0])
+    return 0
+
+
+def _note_depth(report, depth, loops):
+    report.max_lookahead_depth = max(report.max_lookahead_depth, depth)
+    report.max_loop_nesting = max(report.max_loop_nesting, loops)
+
+
+def warn_about(options):
+    """
+    Emits a ``GrammarWarning`` for every ambiguous branch point of *options*,
+    and for grammars whose estimated cost exceeds the parse budget.
+    """
+    report = analyze(options)
+    for point in report.ambiguous:
+        warnings.warn(
+            "Tag '%s': the %s branch %r overlaps what follows it on %s." % (
+                report.tagname, point.kind.replace('_', ' '), point.argument,
+                point.overlap),
+            GrammarWarning, stacklevel=3
+        )
+    limit = options.get_parse_budget()
+    if limit is not None and report.estimated_cost() > limit:
+        warnings.warn(
+            "Tag '%s': estimated parse cost %s may exceed its parse budget of %s." % (
+                report.tagname, report.complexity, limit),
+            GrammarWarning, stacklevel=3
+        )
+    return report
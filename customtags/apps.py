@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class CustomtagsConfig(AppConfig):
+    name = 'customtags'
+
+    def ready(self):
+        if getattr(settings, 'CUSTOMTAGS_TIMING', False):
+            from customtags import timing
+            timing.enable()
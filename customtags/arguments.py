@@ -1,4 +1,5 @@
 
+import threading
 from collections import deque
 from copy import copy
 
@@ -6,12 +7,14 @@ from django.template import TemplateSyntaxError
 from django.template.base import TOKEN_BLOCK, TOKEN_TEXT, TOKEN_VAR, TOKEN_COMMENT
 from django.template.base import Parser as DjangoParser, NodeList as template_NodeList
 from django.core.exceptions import ImproperlyConfigured
+from django.conf import settings
 
 from customtags.exceptions import *
 from customtags.values import *
 from customtags.utils import FakeParser, NULL, Container
-from customtags.lexer import Lexer
+from customtags.lexer import get_lexer
 from customtags.expr_parser import ExprParser
+from customtags.budget import probe
 
 TOKEN_TYPE_DICT = {
   TOKEN_BLOCK : "block",
@@ -21,12 +24,29 @@ TOKEN_TYPE_DICT = {
 }
 
 
+def copy_parser(parser, stream):
+    """
+    Returns a throwaway copy of the django parser for a trial parse.  Copying
+    the remaining template tokens is a snapshot, and is charged to the budget
+    attached to the stream.
+    """
+    if stream.budget is not None:
+        stream.budget.snapshot()
+    if hasattr(parser, 'tokens'):
+        parser_copy = DjangoParser(list(parser.tokens))
+        parser_copy.tags    = copy(parser.tags)
+        parser_copy.filters = copy(parser.filters)
+        if hasattr(parser, '_customtags_end_commands'):
+            parser_copy._customtags_end_commands = parser._customtags_end_commands
+        return parser_copy
+    return FakeParser(parser)
+
+
 class BaseArgument(object):
     def __init__(self, name, required=True):
         self.name = name
         self.required = required
-        self.lexer = Lexer()
-        self.expr_parser = ExprParser(argument=self)
+        self.lexer = get_lexer()
 
     def __repr__(self):
         tpl = "<%s(name=%s): %s>"
@@ -38,7 +58,15 @@ class BaseArgument(object):
 
     def initialize(self, tagname):
         self.tagname = tagname
-        self.expr_parser.tagname = tagname
+
+    def parse_expression(self, parser, stream):
+        """
+        Parses an expression from *stream*.  The expression parser keeps the
+        stream and the django parser it works on, so every call gets its own:
+        the arguments of a tag are shared by all the templates using it, and
+        may be parsing several of them at once.
+        """
+        return ExprParser(argument=self).parse(stream, parser)
 
     def set_name(self, name):
         if not isinstance(name, basestring) and name is not None:
@@ -115,7 +143,7 @@ class Argument(BaseArgument):
 
         try:
             if self.resolve:
-                return self.expr_parser.parse(stream, parser)
+                return self.parse_expression(parser, stream)
             else:
                 result = StaticValue(current.value)
                 next(stream)
@@ -160,7 +188,7 @@ class KeywordArgument(Argument):
         try:
             name = stream.expect("name").value
             stream.expect("assign")
-            value = self.expr_parser.parse(stream, parser)
+            value = self.parse_expression(parser, stream)
         except Exception, e:
             raise
             #raise FormatError(self.__class__.__name__, 'keyword=<value expression>')
@@ -245,6 +273,7 @@ class MultiValueBase(object):
                     # of the first non-optional argument after the multi-value arg
                     if not isinstance(nextargs[j], Optional):
                         break
+                    probe(stream, nextargs[j])
                     nextargs[j].clean_token(parser, copy(stream))
                     return num
                 except BaseError:
@@ -253,6 +282,7 @@ class MultiValueBase(object):
 
             try:
                 if j < len_nextargs and not isinstance(nextargs[j], Optional):
+                    probe(stream, nextargs[j])
                     nextargs[j].clean_token(parser, copy(stream))
                     return num
             except BaseError:
@@ -404,11 +434,112 @@ class Expression(Argument):
     pass
 
 
-class NodeList(BaseArgument):
+class LazyNodeList(object):
+    """
+    The body of a lazy ``NodeList`` argument: keeps the template tokens of the
+    body, and the tags and filters they were to be parsed with, and compiles
+    them the first time the body is rendered or its nodes are looked at.
+    """
+    def __init__(self, parser, tokens):
+        self.parser_class = type(parser)
+        self.tokens = tokens
+        self.tags = copy(parser.tags)
+        self.filters = copy(parser.filters)
+        self.lock = threading.Lock()
+        self._nodelist = None
+
+    def __repr__(self):
+        state = "compiled" if self.compiled else "%d tokens" % len(self.tokens)
+        return "<%s: %s>" % (self.__class__.__name__, state)
+
+    @property
+    def compiled(self):
+        return self._nodelist is not None
+
+    @property
+    def nodelist(self):
+        """
+        The compiled body.  Only one thread compiles it; the others wait for
+        it to be published.
+        """
+        nodelist = self._nodelist
+        if nodelist is None:
+            with self.lock:
+                if self._nodelist is None:
+                    parser = self.parser_class(list(self.tokens))
+                    parser.tags = self.tags
+                    parser.filters = self.filters
+                    self._nodelist = parser.parse()
+                    self.tokens = self.tags = self.filters = None
+                nodelist = self._nodelist
+        return nodelist
+
+    @property
+    def contains_nontext(self):
+        return self.nodelist.contains_nontext
+
+    def render(self, context):
+        return self.nodelist.render(context)
+
+    def get_nodes_by_type(self, nodetype):
+        return self.nodelist.get_nodes_by_type(nodetype)
+
+    def __iter__(self):
+        return iter(self.nodelist)
+
+    def __len__(self):
+        return len(self.nodelist)
+
+    def __getitem__(self, index):
+        return self.nodelist[index]
+
+    def __reduce__(self):
+        # pickled compiled, as the NodeList it compiles to
+        nodelist = self.nodelist
+        return type(nodelist), (list(nodelist),), nodelist.__dict__
+
 
-    def __init__(self, name=None, endtags=None, required=True):
+def _end_commands(parser):
+    """
+    The commands starting with 'end' in the template being parsed, computed
+    once per parser.
+    """
+    commands = getattr(parser, '_customtags_end_commands', None)
+    if commands is None:
+        commands = parser._customtags_end_commands = frozenset(
+            token.contents.split()[0] for token in parser.tokens
+            if token.token_type == TOKEN_BLOCK and token.contents.startswith('end'))
+    return commands
+
+
+def _closing_command(parser, command):
+    """
+    The command closing the block tag *command*, or None if it isn't a block
+    tag.  Tags made with ``Tag.as_tag`` know their end tag; other tags are
+    taken to be block tags if 'end<command>' appears in the template.
+    """
+    tag_class = getattr(parser.tags.get(command), 'tag_class', None)
+    if tag_class is not None:
+        return tag_class.options.get_end_tagname()
+    command = 'end' + command
+    return command if command in _end_commands(parser) else None
+
+
+class NodeList(BaseArgument):
+    """
+    A template body, parsed up to one of its *endtags*.
+
+    A lazy body (``NodeList(..., lazy=True)``, or the
+    ``CUSTOMTAGS_LAZY_NODELISTS`` setting) is skipped when the template is
+    compiled, and compiled the first time it is rendered, see
+    ``LazyNodeList``.  Syntax errors in the body are then raised by that first
+    render.  Bodies that can't be skipped safely, such as bodies containing a
+    ``{% load %}``, are always compiled with the template.
+    """
+    def __init__(self, name=None, endtags=None, required=True, lazy=NULL):
         self.explicit_endtags = endtags
         self.endtags = endtags
+        self.lazy = lazy
         super(NodeList, self).__init__(name, required)
 
     def __repr__(self):
@@ -421,10 +552,19 @@ class NodeList(BaseArgument):
         if not stream.eos:
             raise TooManyArguments(str(self), [token.value for token in stream.list])
 
+    def is_lazy(self):
+        if self.lazy is NULL:
+            return getattr(settings, 'CUSTOMTAGS_LAZY_NODELISTS', False)
+        return self.lazy
+
     def parse(self, parser, stream, container, nextargs=None):
         self.clean_token(parser, stream)
 
-        nodelist = parser.parse(self.endtags)
+        nodelist = None
+        if self.is_lazy() and hasattr(parser, 'tokens'):
+            nodelist = self.skip(parser)
+        if nodelist is None:
+            nodelist = parser.parse(self.endtags)
         wrapped_nodelist = StaticValue(nodelist)
         if self.name is None:
             container.tag_args.append(wrapped_nodelist)
@@ -432,6 +572,44 @@ class NodeList(BaseArgument):
             container.tag_kwargs[str(self.name)] = wrapped_nodelist
         container.tag_nodelists.append(nodelist)
 
+    def skip(self, parser):
+        """
+        Moves *parser* to the end tag of the body, and returns the body as a
+        ``LazyNodeList``; returns None without moving it if the end of the
+        body can't be found without compiling it.
+        """
+        end = self.find_end(parser)
+        if end is None:
+            return None
+        tokens = parser.tokens[:end]
+        del parser.tokens[:end]
+        return LazyNodeList(parser, tokens)
+
+    def find_end(self, parser):
+        """
+        Returns the index of the end tag of the body in the tokens left to
+        parse, matching the block tags nested in the body with their end tags.
+        """
+        expected = []
+        for index, token in enumerate(parser.tokens):
+            if token.token_type != TOKEN_BLOCK:
+                continue
+            bits = token.contents.split()
+            if not bits:
+                return None
+            command = bits[0]
+            if expected and command == expected[-1]:
+                expected.pop()
+            elif not expected and command in self.endtags:
+                return index
+            elif command == 'load' or command.startswith('end'):
+                return None
+            else:
+                closing = _closing_command(parser, command)
+                if closing is not None:
+                    expected.append(closing)
+        return None
+
 
 class Literal(NodeList):
 
@@ -495,6 +673,7 @@ class MultiArgument(BaseArgument):
         return tpl % (self.__class__.__name__, tag, opt)
 
     def clean_token(self, parser, stream):
+        probe(stream, self)
         stream_copy = copy(stream)
         arguments = deque(self.arguments)
         while not stream_copy.eos and arguments:
@@ -534,11 +713,14 @@ class OneOf(MultiArgument):
     def clean_token(self, parser, stream):
         is_accepted = False
         for argument in self.arguments:
+            probe(stream, argument)
             stream_copy = copy(stream)
             try:
                 argument.clean_token(parser, stream_copy)
                 is_accepted = True
                 break
+            except ParseBudgetExceeded:
+                raise
             except:
                 pass
         if not is_accepted:
@@ -551,13 +733,9 @@ class OneOf(MultiArgument):
         while arguments:
             current_arg = arguments.popleft()
 
+            probe(stream, current_arg)
             stream_copy = copy(stream)
-            if hasattr(parser, 'tokens'):
-                parser_copy = DjangoParser(list(parser.tokens))
-                parser_copy.tags    = copy(parser.tags)
-                parser_copy.filters = copy(parser.filters)
-            else:
-                parser_copy = FakeParser(parser)
+            parser_copy = copy_parser(parser, stream)
 
             try:
                 current_arg.parse(parser_copy, stream_copy, Container(), nextargs)
@@ -587,7 +765,7 @@ class BlockTag(MultiArgument):
                 "The first argument of BlockTag must be a string or a TagName obj, "
                 "or another BlockTag object, not %s." % name
             )
-        self.lexer = Lexer()
+        self.lexer = get_lexer()
 
         kwargs['name'] = self.tagname
         super(BlockTag, self).__init__(*args, **kwargs)
@@ -608,10 +786,12 @@ class BlockTag(MultiArgument):
 
     def parse(self, parser, stream, container, nextargs=None):
         if stream.eos:
+            budget = stream.budget
             block_found = False
             while (not block_found):
                 parser_token = parser.next_token()
                 stream = self.lexer.tokenize(parser_token.contents)
+                stream.budget = budget
                 if parser_token.token_type == TOKEN_BLOCK:
                     if stream.current.type == "name" and stream.current.value == "comment":
                         parser.parse(("endcomment",))
@@ -633,13 +813,9 @@ class BlockTag(MultiArgument):
 class Optional(MultiArgument):
 
     def parse(self, parser, stream, container, nextargs=None):
+        probe(stream, self)
         stream_copy = copy(stream)
-        if hasattr(parser, 'tokens'):
-            parser_copy = DjangoParser(list(parser.tokens))
-            parser_copy.tags    = copy(parser.tags)
-            parser_copy.filters = copy(parser.filters)
-        else:
-            parser_copy = FakeParser(parser)
+        parser_copy = copy_parser(parser, stream)
 
         try:
             self._do_parse(parser_copy, stream_copy, Container(), nextargs)
@@ -663,6 +839,8 @@ class Optional(MultiArgument):
 
 
 class RepContainer(object):
+    __slots__ = ('tag_args', 'tag_kwargs', 'tag_nodelists', 'args', 'kwargs', '_resolved')
+
     def __init__(self):
         self.tag_args = ListValue()
         self.tag_kwargs = DictValue()
@@ -698,18 +876,16 @@ class Repetition(Optional):
         super(Optional, self).__init__(*args, **kwargs)
 
     def parse(self, parser, stream, container, nextargs=None):
+        probe(stream, self)
         stream_copy = copy(stream)
-        if hasattr(parser, 'tokens'):
-            parser_copy = DjangoParser(list(parser.tokens))
-            parser_copy.tags    = copy(parser.tags)
-            parser_copy.filters = copy(parser.filters)
-        else:
-            parser_copy = FakeParser(parser)
+        parser_copy = copy_parser(parser, stream)
 
         reps = ListValue() 
         add_reps = True
         while (add_reps):
             try:
+                if reps:
+                    probe(stream_copy, self)
                 self._do_parse(parser_copy, stream_copy, Container(), nextargs)
             except BaseError, e:
                 add_reps = False
@@ -804,9 +980,7 @@ def next_contained_first(argument_list):
         yield first_arg
 
 def next_contained_argument(argument_list, firsts_only=False):
-    top_args = list(argument_list)
-    while len(top_args) > 0:
-        current_arg = top_args.pop(0)
+    for current_arg in argument_list:
         if isinstance(current_arg, Optional):
             for inner_arg in next_contained_argument(current_arg.arguments, firsts_only):
                 yield inner_arg
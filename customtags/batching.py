@@ -0,0 +1,249 @@
+"""
+Batched calls of functions from template expressions.
+
+A function fetching the values of many keys at once may be registered as
+batchable; it takes a list of keys and returns the list of their values::
+
+    @batchable
+    def price_for(ids):
+        prices = dict(Price.objects.filter(product__in=ids).values_list('product', 'amount'))
+        return [prices.get(id) for id in ids]
+
+Expressions call it with a single key, ``price_for(p.id)``.  Outside of a
+batch, each call fetches its key alone.  A loop whose body calls batchable
+functions, such as ``ct_for``, renders in two phases instead: for every item,
+a ``Batch`` collects the keys of the calls in the body, resolving only their
+arguments, fetches all of them with one call per function, and then the body
+is rendered, the calls reading the values fetched::
+
+    {% ct_for p in products %}
+        {% ct_with price_for(p.id) as price %}{{ price }}{% endwith %}
+    {% endfor %}
+
+Nothing else in the body runs while keys are collected, so tags such as
+``{% cycle %}``, queries and other calls run once per item.  The keys of the
+calls in branches the body doesn't render are fetched too.  Keys are only
+collected for calls of a single argument which calls nothing and doesn't
+refer to names the body binds itself; errors resolving it are left to the
+render.  The keys of the calls of loops nested in the body, over lists and
+tuples, join the batch; keys first seen while the body renders are fetched
+one by one.  Templates included by the body render outside of the batch.
+"""
+from collections import OrderedDict
+from functools import update_wrapper
+
+from django.template import VariableDoesNotExist
+
+from customtags import introspection, nodes
+from customtags.core import Tag
+
+BATCH_KEY = nodes.BATCH_KEY
+
+
+class Batchable(object):
+    """
+    A function fetching the values of a list of keys at once, called with a
+    single key.
+    """
+    def __init__(self, func):
+        self.func = func
+        update_wrapper(self, func)
+
+    def __repr__(self):
+        return '<Batchable: %s>' % self.__name__
+
+    def __call__(self, key):
+        return self.fetch([key])[0]
+
+    def fetch(self, keys):
+        """
+        Returns the values of *keys*, in the same order.
+        """
+        values = list(self.func(keys))
+        if len(values) != len(keys):
+            raise ValueError("%s returned %d values for %d keys." % (
+                self.__name__, len(values), len(keys)))
+        return values
+
+    def call_batched(self, context, key):
+        """
+        Returns the value of *key*, from the batch of *context* if there is
+        one.
+        """
+        batch = get_batch(context)
+        if batch is None:
+            return self(key)
+        return batch.call(self, key)
+
+
+def batchable(func):
+    """
+    Registers *func*, a function taking a list of keys and returning their
+    values, as batchable.
+    """
+    return Batchable(func)
+
+
+class Batch(object):
+    """
+    The keys called by the body of a loop, collected before it renders, and
+    their values once fetched.
+    """
+    def __init__(self):
+        self.keys = OrderedDict()
+        self.values = {}
+
+    def add(self, function, key):
+        """
+        Collects *key* to be fetched with *function*.
+        """
+        try:
+            if (function, key) in self.values:
+                return
+        except TypeError:
+            return
+        self.keys.setdefault(function, OrderedDict())[key] = None
+
+    def call(self, function, key):
+        try:
+            return self.values[function, key]
+        except KeyError:
+            pass
+        except TypeError:
+            return function(key)
+        value = self.values[function, key] = function(key)
+        return value
+
+    def fetch(self):
+        """
+        Fetches the keys collected, with one call per function.
+        """
+        for function, keys in self.keys.items():
+            keys = list(keys)
+            for key, value in zip(keys, function.fetch(keys)):
+                self.values[function, key] = value
+        self.keys.clear()
+
+
+def get_batch(context):
+    render_context = getattr(context, 'render_context', None)
+    if render_context is None:
+        return None
+    return render_context.get(BATCH_KEY)
+
+
+def start_batch(context):
+    batch = context.render_context[BATCH_KEY] = Batch()
+    return batch
+
+
+def stop_batch(context):
+    del context.render_context[BATCH_KEY]
+
+
+class CallWalker(introspection.Walker):
+    """
+    Walks a nodelist, collecting the dotted paths of the functions its
+    expressions call.
+    """
+    def __init__(self):
+        super(CallWalker, self).__init__()
+        self.functions = set()
+
+    def visit(self, obj):
+        if isinstance(obj, nodes.Call):
+            path = introspection.get_path(obj.node)
+            if path is not None:
+                self.functions.add(path)
+        super(CallWalker, self).visit(obj)
+
+
+def get_function_paths(nodelist):
+    """
+    Returns the sorted dotted paths of the functions *nodelist* calls.
+    """
+    walker = CallWalker()
+    walker.visit(nodelist)
+    return sorted(walker.functions)
+
+
+def calls_batchables(paths, context):
+    """
+    Whether any of the functions at *paths* in *context* is batchable.
+    """
+    for path in paths:
+        try:
+            function = introspection.lookup(path, context)
+        except VariableDoesNotExist:
+            continue
+        if isinstance(function, Batchable):
+            return True
+    return False
+
+
+class KeyWalker(introspection.Walker):
+    """
+    Walks a nodelist, collecting its calls, and the tags collecting the keys
+    of their own bodies, such as nested loops, without walking into them.
+    """
+    def __init__(self):
+        super(KeyWalker, self).__init__()
+        self.calls = []
+        self.collectors = []
+
+    def visit(self, obj):
+        if isinstance(obj, nodes.Call):
+            self.calls.append(obj)
+        elif isinstance(obj, Tag) and getattr(type(obj), 'collect_keys', None) is not None:
+            if id(obj) not in self.seen:
+                self.seen.add(id(obj))
+                self.collectors.append(obj)
+            return
+        super(KeyWalker, self).visit(obj)
+
+
+def is_collectable(call, bound):
+    """
+    Whether the key of *call* can be collected before the body binding the
+    names *bound* renders.
+    """
+    if len(call.args) != 1 or call.kwargs or call.dyn_args or call.dyn_kwargs:
+        return False
+    path = introspection.get_path(call.node)
+    if path is None or path.split('.', 1)[0] in bound:
+        return False
+    walker = KeyWalker()
+    walker.visit(call.args[0])
+    if walker.calls or walker.collectors:
+        return False
+    return not any(path.split('.', 1)[0] in bound for path in walker.paths)
+
+
+def get_key_plan(nodelist):
+    """
+    Returns the calls of *nodelist* whose keys can be collected, and the tags
+    collecting the keys of their own bodies.
+    """
+    walker = KeyWalker()
+    walker.visit(nodelist)
+    calls = [call for call in walker.calls if is_collectable(call, walker.bound)]
+    return calls, walker.collectors
+
+
+def collect_keys(context, batch, plan):
+    """
+    Adds the keys of the calls of a plan of ``get_key_plan``, resolved in
+    *context*, to *batch*.
+    """
+    calls, collectors = plan
+    for call in calls:
+        try:
+            function = call.node.resolve(context, call_callable=False)
+            if not isinstance(function, Batchable):
+                continue
+            key = call.args[0].resolve(context)
+        except Exception:
+            continue
+        batch.add(function, key)
+    for tag in collectors:
+        tag.collect_keys(context, batch)
@@ -0,0 +1,142 @@
+"""
+Parse budgets guard ``Options.parse`` against grammars that backtrack heavily.
+
+Nested ``Optional``/``Repetition`` arguments and the lookahead performed by
+``MultiValueArgument`` over ``OneOf`` branches can make parsing a single tag
+exponential in the number of its tokens.  Every ``Options.parse`` call attaches
+a ``ParseBudget`` to its token stream; arguments charge it one step for each
+probe of the stream, and the stream charges it for every snapshot it makes of
+itself.  When the combined cost exceeds the limit, ``ParseBudgetExceeded`` is
+raised naming the tag and the argument that was being probed.
+
+The limit is read from the ``CUSTOMTAGS_PARSE_BUDGET`` setting, and may be
+overridden per tag with ``Options(..., parse_budget=<int>)``.  A limit of
+``None`` disables the check but still records the counters.
+"""
+from django.conf import settings
+
+from customtags.exceptions import ParseBudgetExceeded
+from customtags._compat import allocate_lock
+
+DEFAULT_PARSE_BUDGET = 10000
+
+_stats = {}
+_stats_lock = allocate_lock()
+
+
+def get_default_limit():
+    return getattr(settings, 'CUSTOMTAGS_PARSE_BUDGET', DEFAULT_PARSE_BUDGET)
+
+
+class ParseBudget(object):
+    """
+    Counts the probe steps and stream snapshots spent parsing one tag.
+    """
+    def __init__(self, tagname, limit=None):
+        self.tagname = tagname
+        self.limit = limit
+        self.steps = 0
+        self.snapshots = 0
+        self.argument = None
+
+    def __repr__(self):
+        return "<ParseBudget(tagname=%s): %s/%s>" % (self.tagname, self.cost, self.limit)
+
+    @property
+    def cost(self):
+        return self.steps + self.snapshots
+
+    def step(self, argument):
+        self.steps += 1
+        self.argument = argument
+        self.check()
+
+    def snapshot(self):
+        self.snapshots += 1
+        self.check()
+
+    def check(self):
+        if self.limit is not None and self.cost > self.limit:
+            raise ParseBudgetExceeded(self.tagname, self.argument, self.limit)
+
+
+class ParseStats(object):
+    """
+    Running counters over every parse of a single tag.
+    """
+    def __init__(self, tagname):
+        self.tagname = tagname
+        self.parses = 0
+        self.exceeded = 0
+        self.total_cost = 0
+        self.max_cost = 0
+        self.max_steps = 0
+        self.max_snapshots = 0
+        self.limit = None
+
+    def add(self, budget, exceeded=False):
+        self.parses += 1
+        self.exceeded += exceeded and 1 or 0
+        self.total_cost += budget.cost
+        self.max_cost = max(self.max_cost, budget.cost)
+        self.max_steps = max(self.max_steps, budget.steps)
+        self.max_snapshots = max(self.max_snapshots, budget.snapshots)
+        self.limit = budget.limit
+
+    def as_dict(self):
+        usage = None
+        if self.limit:
+            usage = float(self.max_cost) / self.limit
+        return {
+            'tagname': self.tagname,
+            'parses': self.parses,
+            'exceeded': self.exceeded,
+            'mean_cost': float(self.total_cost) / self.parses if self.parses else 0.0,
+            'max_cost': self.max_cost,
+            'max_steps': self.max_steps,
+            'max_snapshots': self.max_snapshots,
+            'limit': self.limit,
+            'usage': usage,
+        }
+
+
+def probe(stream, argument):
+    """
+    Charge the budget attached to *stream*, if any, for one probe by *argument*.
+    """
+    budget = getattr(stream, 'budget', None)
+    if budget is not None:
+        budget.step(argument)
+
+
+def record(budget, exceeded=False):
+    _stats_lock.acquire()
+    try:
+        stats = _stats.get(budget.tagname)
+        if stats is None:
+            stats = _stats[budget.tagname] = ParseStats(budget.tagname)
+        stats.add(budget, exceeded)
+    finally:
+        _stats_lock.release()
+
+
+def get_parse_stats():
+    """
+    Returns the counters of every tag parsed so far, the tags that came
+    closest to their limit first.
+    """
+    _stats_lock.acquire()
+    try:
+        result = [stats.as_dict() for stats in _stats.values()]
+    finally:
+        _stats_lock.release()
+    result.sort(key=lambda s: (s['usage'] or 0.0, s['max_cost']), reverse=True)
+    return result
+
+
+def reset_parse_stats():
+    _stats_lock.acquire()
+    try:
+        _stats.clear()
+    finally:
+        _stats_lock.release()
@@ -0,0 +1,200 @@
+"""
+Compiles a template's nodes to a single Python render function.
+
+``compile_nodelist`` walks a nodelist and writes the source of a function
+rendering it in one pass, in the manner of Jinja2's code generator: text
+nodes become constants, variable nodes a call resolving their filter
+expression, and customtags ``Tag`` nodes that don't override ``render``
+nor memoize their output a call binding their arguments followed by a call
+to ``render_tag``, with the bodies of the tag compiled the same way.  Every
+other node is rendered with its own ``render``.  The values the function refers to are passed to the
+function that builds it, so they are closure variables at render time.
+
+``compile_template`` replaces the nodelist of a template with a
+``CompiledNodeList`` holding the nodes and the function; the nodes
+themselves are left untouched.  ``customtags.loaders.Loader`` compiles the
+templates it loads when ``CUSTOMTAGS_CODEGEN`` is set.  Templates compiled
+in debug mode are left as they are, so that errors still point at their
+source.
+
+Tags are only compiled while ``customtags.timing`` is disabled, since a
+compiled tag calls ``render_tag`` without going through ``Tag.render``.
+The tags of templates compiled before timing is enabled stay compiled, and
+aren't timed until the templates are compiled again, such as after the
+template cache is reset.
+"""
+from django.conf import settings
+from django.template.base import Node, NodeList, TextNode, VariableNode, \
+     render_value_in_context
+from django.template.debug import DebugNodeList
+from django.utils.encoding import force_text
+from django.utils.safestring import mark_safe
+
+from customtags import timing
+from customtags.core import Tag
+
+INDENT = '    '
+
+
+def is_enabled():
+    return getattr(settings, 'CUSTOMTAGS_CODEGEN', False)
+
+
+class CompiledNodeList(NodeList):
+    """
+    A nodelist rendered by the function ``compile_nodelist`` made of it.
+    """
+    def __init__(self, nodelist, render_function):
+        super(CompiledNodeList, self).__init__(nodelist)
+        self.contains_nontext = nodelist.contains_nontext
+        self.render_function = render_function
+
+    def render(self, context):
+        return self.render_function(context)
+
+    def __reduce__(self):
+        # pickled as the nodelist it was compiled from
+        state = dict(self.__dict__)
+        del state['render_function']
+        return NodeList, (list(self),), state
+
+
+def is_compilable_tag(node):
+    # compiled tags would not be timed
+    return isinstance(node, Tag) and node.render_cache is None and \
+        type(node).render.im_func is Tag.render.im_func and not timing.is_enabled()
+
+
+class CodeGenerator(object):
+    """
+    Writes the source of the render function of a nodelist.  The values the
+    source refers to are collected in ``names``, under the names they are
+    referred to by, and bound to locals of the function building it.
+    """
+    def __init__(self):
+        self.lines = []
+        self.names = {
+            'force_text': force_text,
+            'mark_safe': mark_safe,
+            'render_value_in_context': render_value_in_context,
+        }
+        self.indentation = 0
+
+    def name(self, prefix, value):
+        name = '%s_%d' % (prefix, len(self.names))
+        self.names[name] = value
+        return name
+
+    def writeline(self, line):
+        self.lines.append(INDENT * self.indentation + line)
+
+    def indent(self):
+        self.indentation += 1
+
+    def outdent(self):
+        self.indentation -= 1
+
+    def visit_nodelist(self, nodelist):
+        for node in nodelist:
+            if not isinstance(node, Node):
+                self.writeline('append(%s)' % self.name('text', force_text(node)))
+            elif type(node) is TextNode:
+                self.writeline('append(%s)' % self.name('text', force_text(node.s)))
+            elif type(node) is VariableNode:
+                self.visit_variable(node)
+            elif is_compilable_tag(node):
+                self.visit_tag(node)
+            else:
+                self.writeline('append(force_text(%s(context)))' % self.name(
+                    'render', node.render))
+
+    def visit_variable(self, node):
+        resolve = self.name('resolve', node.filter_expression.resolve)
+        self.writeline('try:')
+        self.indent()
+        self.writeline('value = %s(context)' % resolve)
+        self.outdent()
+        self.writeline('except UnicodeDecodeError:')
+        self.indent()
+        self.writeline('pass')
+        self.outdent()
+        self.writeline('else:')
+        self.indent()
+        self.writeline('append(render_value_in_context(value, context))')
+        self.outdent()
+
+    def visit_tag(self, node):
+        plan = node.container.freeze()
+        compiled = dict((id(nodelist), compile_nodelist(nodelist))
+                        for nodelist in plan.tag_nodelists
+                        if isinstance(nodelist, NodeList))
+
+        args = [compiled.get(id(arg), arg) for arg in plan.args]
+        arguments = []
+        dynamic_args = dict(plan.dynamic_args)
+        for index, arg in enumerate(args):
+            if index in dynamic_args:
+                arguments.append('%s(context)' % self.name(
+                    'resolve', dynamic_args[index].resolve))
+            else:
+                arguments.append(self.name('arg', arg))
+
+        kwargs = dict((key, compiled.get(id(value), value))
+                      for key, value in plan.kwargs.iteritems())
+        if kwargs or plan.dynamic_kwargs:
+            self.writeline('kwargs = %s.copy()' % self.name('kwargs', kwargs))
+            for key, value in plan.dynamic_kwargs:
+                self.writeline('kwargs[%r] = %s(context)' % (
+                    key, self.name('resolve', value.resolve)))
+            arguments.append('**kwargs')
+
+        self.writeline('append(force_text(%s(%s)))' % (
+            self.name('render_tag', node.render_tag), ', '.join(['context'] + arguments)))
+
+    def generate(self, nodelist):
+        """
+        Returns the source of the function building the render function of
+        *nodelist* from ``names``.
+        """
+        self.indentation = 2
+        self.visit_nodelist(nodelist)
+        body = self.lines
+
+        self.lines = []
+        self.indentation = 0
+        self.writeline('def build(names):')
+        self.indent()
+        for name in sorted(self.names):
+            self.writeline('%s = names[%r]' % (name, name))
+        self.writeline('def render(context):')
+        self.indent()
+        self.writeline('bits = []')
+        self.writeline('append = bits.append')
+        self.lines.extend(body)
+        self.writeline("return mark_safe(u''.join(bits))")
+        self.outdent()
+        self.writeline('return render')
+        return '\n'.join(self.lines)
+
+
+def compile_nodelist(nodelist):
+    """
+    Returns *nodelist* as a ``CompiledNodeList``, or *nodelist* itself if it
+    was compiled in debug mode or already is compiled.
+    """
+    if isinstance(nodelist, (CompiledNodeList, DebugNodeList)):
+        return nodelist
+    generator = CodeGenerator()
+    source = generator.generate(nodelist)
+    namespace = {}
+    exec compile(source, '<template>', 'exec') in namespace
+    render = namespace['build'](generator.names)
+    return CompiledNodeList(nodelist, render)
+
+
+def compile_template(template):
+    """
+    Compiles the nodelist of *template* in place, and returns the template.
+    """
+    template.nodelist = compile_nodelist(template.nodelist)
+    return template
@@ -1,18 +1,30 @@
 import re
+import threading
 
 from functools import update_wrapper
 from copy import deepcopy
 from collections import deque
-from django.template import Node, NodeList as DjangoNodeList
+from django.template import Node, NodeList as DjangoNodeList, TemplateSyntaxError
+from django.template.base import TextNode
 from django.core.exceptions import ImproperlyConfigured
+from django.conf import settings
+from django.utils.encoding import force_text
 
-from customtags.arguments import NodeList, BlockTag, TagName, Optional
+from customtags.arguments import NodeList, BlockTag, TagName, Optional, EndTag
 from customtags.parser import structure_arguments
-from customtags.utils import get_default_name, Container
-from customtags.lexer import Lexer
+from customtags.utils import get_default_name, Container, NULL
+from customtags.lexer import get_lexer
+from customtags.budget import ParseBudget, get_default_limit, record
+from customtags.exceptions import ParseBudgetExceeded
+from customtags.rendering import get_writer
+from customtags import analysis
 
 INDENT = ' '
 
+# guards the deferred initialization of Options on first parse; reentrant
+# since a deferred subclass initializes its parent first
+_deferred_lock = threading.RLock()
+
 class classonlymethod(classmethod):
     def __get__(self, instance, owner):
         if instance is not None:
@@ -23,17 +35,31 @@ class classonlymethod(classmethod):
 class Options(object):
     """
     Option class holding the arguments of a tag.
+
+    Lazy options (``Options(..., lazy=True)``, or the ``CUSTOMTAGS_LAZY_OPTIONS``
+    setting) only record their tag name when the tag class is created, and
+    build their grammar on the first call to ``parse``.
+
+    The body of a block may be given as a ``NodeList`` argument instead of its
+    name, as in ``blocks=[('empty', NodeList('pre_empty', lazy=True)), ...]``.
     """
     def __init__(self, *args, **kwargs):
         self.initialized = False
+        self.deferred = False
+        self.base = None
         self.arguments = deque(args)
-        self.lexer = Lexer()
+        self.lexer = get_lexer()
+        self.parse_budget = kwargs.get('parse_budget', NULL)
+        self.lazy = kwargs.get('lazy', NULL)
         
         blocks = []
         for block in kwargs.get('blocks', []):
             if isinstance(block, basestring):
                 blocks.append(NodeList(block))
                 blocks.append(BlockTag(block))
+            elif isinstance(block[1], NodeList):
+                blocks.append(block[1])
+                blocks.append(BlockTag(block[0]))
             else:
                 blocks.append(NodeList(block[1]))
                 blocks.append(BlockTag(block[0]))
@@ -52,7 +78,53 @@ class Options(object):
             if isinstance(self.arguments[0], basestring) and \
                self.arguments[0] == self.tagname:
                 arguments.popleft()
-        return Options(*arguments)
+        return Options(*arguments, parse_budget=self.parse_budget, lazy=self.lazy)
+
+    def inherit(self, tagname):
+        """
+        Returns initialized Options for a subclass tag named *tagname*.  The
+        structured arguments are shared with this object, and only the tag
+        name and the parser built on it are the subclass' own.  Grammars that
+        depend on the tag name, such as an EndTag named after it, are copied
+        and structured again instead.
+        """
+        if not self.initialized and self.deferred:
+            options = type(self)(parse_budget=self.parse_budget, lazy=self.lazy)
+            options.base = self
+            options.defer(tagname)
+            return options
+
+        if not self.initialized or self.depends_on_tagname:
+            options = deepcopy(self)
+            options.initialize(tagname)
+            return options
+
+        options = type(self).__new__(type(self))
+        options.initialized = True
+        options.deferred = False
+        options.base = None
+        options.tagname = tagname
+        options.grammar_tagname = self.grammar_tagname
+        options.lexer = self.lexer
+        options.parse_budget = self.parse_budget
+        options.lazy = self.lazy
+        options.depends_on_tagname = False
+        options.arguments = deque(self.arguments)
+        options.arguments[0] = tagname
+        options.parser = BlockTag(tagname)
+        options.parser.arguments = self.parser.arguments
+        return options
+
+    def _depends_on_tagname(self):
+        if not isinstance(self.arguments[0], basestring):
+            return True
+        stack = list(self.arguments)
+        while stack:
+            argument = stack.pop()
+            if isinstance(argument, EndTag) and not argument.init_name:
+                return True
+            stack.extend(getattr(argument, 'arguments', ()))
+        return False
 
     def __arg_repr(self, args, depth):
         indent = INDENT * depth
@@ -86,6 +158,7 @@ class Options(object):
     def initialize(self, tagname):
         if not self.initialized:
             self.tagname = tagname
+            self.grammar_tagname = tagname
             self.arguments = structure_arguments(self.arguments, self.tagname)
 
             if len(self.arguments) > 0: 
@@ -110,19 +183,106 @@ class Options(object):
                 self.arguments.appendleft(tagname)
 
             self.parser = BlockTag(*self.arguments)
+            self.depends_on_tagname = self._depends_on_tagname()
             self.initialized = True
 
+            if analysis.is_enabled():
+                analysis.warn_about(self)
+
+    def get_end_tagname(self):
+        """
+        Returns the name of the tag closing the tag, or None if it isn't a
+        block tag.  Doesn't build deferred grammars.
+        """
+        options = self
+        while not options.initialized and options.base is not None:
+            options = options.base
+        if not options.arguments:
+            return None
+        last = options.arguments[-1]
+        if isinstance(last, EndTag):
+            return last.init_name or 'end' + self.tagname
+        if isinstance(last, BlockTag):
+            return last.tagname
+        return None
+
+    def is_lazy(self):
+        if self.lazy is NULL:
+            return getattr(settings, 'CUSTOMTAGS_LAZY_OPTIONS', False)
+        return self.lazy
+
+    def defer(self, tagname):
+        """
+        Records *tagname* for the initialization done by the first ``parse``.
+        """
+        if not self.initialized:
+            self.tagname = tagname
+            self.deferred = True
+
+    def ensure_initialized(self, tagname=None):
+        """
+        Initializes deferred options under the name they were deferred with,
+        or other options under *tagname*.  Safe to call from several threads.
+        """
+        if self.initialized:
+            return
+        _deferred_lock.acquire()
+        try:
+            if self.initialized:
+                return
+            if self.base is not None:
+                self.base.ensure_initialized()
+                inherited = self.base.inherit(self.tagname)
+                state = dict(inherited.__dict__)
+                initialized = state.pop('initialized')
+                self.__dict__.update(state)
+                self.initialized = initialized
+            else:
+                self.initialize(self.tagname if self.deferred else tagname)
+        finally:
+            _deferred_lock.release()
+
+    def get_parse_budget(self):
+        if self.parse_budget is NULL:
+            return get_default_limit()
+        return self.parse_budget
+
     def parse(self, parser, tokens, container):
         """
         Parse template tokens into a dictionary
         """
+        if self.deferred and not self.initialized:
+            self.ensure_initialized()
+
         if not hasattr(self, "parser") or not self.parser:
             raise ImproperlyConfigured("'initialize(<tagname>)' must be called on an "
                                        "Options object before 'parse()' may be called.")
 
         stream = self.lexer.tokenize(tokens.contents)
-        self.original_string = tokens.contents
-        self.parser.parse(parser, stream, container)
+        stream.budget = ParseBudget(self.tagname, self.get_parse_budget())
+        exceeded = False
+        try:
+            self.parser.parse(parser, stream, container)
+        except ParseBudgetExceeded:
+            exceeded = True
+            raise
+        except TemplateSyntaxError, e:
+            if self.grammar_tagname != self.tagname:
+                overlay_tagname(e, self.grammar_tagname, self.tagname)
+            raise
+        finally:
+            record(stream.budget, exceeded)
+
+
+def overlay_tagname(error, grammar_tagname, tagname):
+    """
+    The arguments of a grammar shared with a parent tag raise errors naming
+    the parent; this renames them after the tag that was being parsed.
+    """
+    if getattr(error, 'tagname', None) == grammar_tagname:
+        error.tagname = tagname
+    error.args = tuple([tagname if arg == grammar_tagname else arg
+                        for arg in error.args])
 
 
 class TagMeta(type):
@@ -131,15 +291,17 @@ class TagMeta(type):
         attrs['name'] = tag_name
 
         if 'options' in attrs:
-            attrs['options'].initialize(tag_name)
+            if attrs['options'].is_lazy():
+                attrs['options'].defer(tag_name)
+            else:
+                attrs['options'].initialize(tag_name)
         else:
             parents = [base for base in bases if isinstance(base, TagMeta)]
             options = None
             while options == None and len(parents) > 0:
                 parent = parents.pop(0)
                 if hasattr(parent, 'options'):
-                    options = deepcopy(parent.options)
-                    options.initialize(tag_name)
+                    options = parent.options.inherit(tag_name)
             if not isinstance(options, Options):
                 raise ImproperlyConfigured(
                     "None of the parents of Tag (%s), nor the "
@@ -151,13 +313,49 @@ class TagMeta(type):
         return ret
 
 
+def is_constant_nodelist(nodelist):
+    """
+    Whether *nodelist* is compiled and only made of text and constant tags.
+    """
+    if not isinstance(nodelist, DjangoNodeList):
+        return False
+    for node in nodelist:
+        if isinstance(node, Tag):
+            if not node.is_constant():
+                return False
+        elif not isinstance(node, TextNode):
+            return False
+    return True
+
+
 class Tag(Node):
     """
     Tag class.
+
+    A tag whose ``render_tag`` returns the same output for the same
+    arguments, and neither reads nor changes the context, may declare itself
+    ``pure``; ``customtags.prerender`` then renders it once when the template
+    is compiled if its arguments and bodies are constant.
+
+    A tag may memoize its output per resolved arguments by declaring a
+    ``customtags.render_cache.RenderCache`` as its ``render_cache``.
+
+    A tag may render in chunks by implementing ``stream_tag``, a generator
+    taking the arguments of ``render_tag``, and write its output into a
+    list or file-like object by implementing ``write_tag``, taking that
+    object after the context; see ``customtags.rendering``.
     """
     __metaclass__ = TagMeta
     
     options = Options()
+
+    pure = False
+
+    render_cache = None
+
+    stream_tag = None
+
+    write_tag = None
     
     def __init__(self, **kwargs):
         """
@@ -174,33 +372,84 @@ class Tag(Node):
         """
         Manner in which to generate a tag function that can be registered.
         """
-        if not cls.options.initialized:
-            cls.options.initialize(self.name)
+        if not cls.options.deferred:
+            cls.options.ensure_initialized(cls.name)
 
         def tag(parser, tokens):
             self = cls(**initkwargs)
-            self.tagname = self.name
-            self.container = Container()
-            self.options.parse(parser, tokens, self.container)
+            self.parse(parser, tokens)
             return self
 
         update_wrapper(tag, cls)
         tag.__name__ = cls.name
+        tag.tag_class = cls
         return tag
 
+    def parse(self, parser, tokens):
+        """
+        Parses the arguments and bodies of the tag.
+        """
+        container = Container()
+        self.options.parse(parser, tokens, container)
+        self.container = container.freeze()
+
+    @property
+    def tagname(self):
+        return self.__dict__.get('tagname', self.name)
+
+    @tagname.setter
+    def tagname(self, value):
+        self.__dict__['tagname'] = value
+
     @property
     def nodelist(self):
         return DjangoNodeList(node for nodelist in self.container.tag_nodelists for node in nodelist)
             
+    def is_constant(self):
+        """
+        Whether the tag renders the same output on every render: it is pure,
+        and its arguments and the bodies it renders are constant.
+        """
+        if not self.pure:
+            return False
+        plan = self.container.freeze()
+        if plan.dynamic_args or plan.dynamic_kwargs:
+            return False
+        return all(is_constant_nodelist(nodelist) for nodelist in plan.tag_nodelists)
+
     def render(self, context):
         """
         INTERNAL method to prepare rendering
         """
-        args   = [v.resolve(context) for v in self.container.tag_args]
-        kwargs = dict([(k, v.resolve(context)) for k,v in self.container.tag_kwargs.items()])
-   
+        args, kwargs = self.container.bind(context)
+
+        if self.render_cache is not None:
+            return self.render_cache.render(self, context, args, kwargs)
         return self.render_tag(context, *args, **kwargs)
         
+    def render_stream(self, context):
+        """
+        Yields the rendered tag in chunks: those of ``stream_tag`` if the tag
+        has one, else the output of ``render``.
+        """
+        if self.stream_tag is None or self.render_cache is not None:
+            yield force_text(self.render(context))
+            return
+        args, kwargs = self.container.bind(context)
+        for chunk in self.stream_tag(context, *args, **kwargs):
+            yield force_text(chunk)
+
+    def render_into(self, context, out):
+        """
+        Writes the rendered tag into *out*: with ``write_tag`` if the tag has
+        one, else the output of ``render``.
+        """
+        if self.write_tag is None or self.render_cache is not None:
+            get_writer(out)(force_text(self.render(context)))
+            return
+        args, kwargs = self.container.bind(context)
+        self.write_tag(context, out, *args, **kwargs)
+
     def render_tag(self, context, *args, **kwargs):
         """
         The method you should override in your custom tags
@@ -11,24 +11,31 @@ from customtags.utils import process_decorator_args_kwargs
 class TagFactory(object):
    
     @staticmethod 
-    def get_class(options, callback, name=None):
+    def get_class(options, callback, name=None, pure=False):
         name = name if name is not None else callback.__name__
 
         def render_tag(self, context, *args, **kwargs):
             return callback(context, *args, **kwargs)
 
+        def is_constant(self):
+            # a value rendered 'as' a name is set in the context
+            plan = self.container.freeze()
+            return plan.kwargs.get('__as_name__') is None and Tag.is_constant(self)
+
         options = Options(*options) if not isinstance(options, Options) else options
-        tag_class = type(name, (Tag,), { 'options':options, 'render_tag':render_tag })
+        tag_class = type(name, (Tag,), { 'options':options, 'render_tag':render_tag,
+                                         'is_constant':is_constant, 'pure':pure })
         tag_class.__module__ = callback.__module__
         return tag_class
 
 
-def block_decorator(register=register, name=None):
+def block_decorator(register=register, name=None, pure=False):
     assert isinstance(name, basestring) or name is None 
     assert isinstance(register, template.Library)
 
     outer_name = name
     outer_register = register
+    outer_pure = pure
 
     def decorator(*args, **kwargs):
         kwargs = process_decorator_args_kwargs(Options, *args, **kwargs)
@@ -39,9 +46,10 @@ def block_decorator(register=register, name=None):
 
         register = outer_register if 'register' not in kwargs else kwargs['register']
         name = outer_name if 'name' not in kwargs else kwargs['name']
+        pure = outer_pure if 'pure' not in kwargs else kwargs['pure']
 
         if 'function' not in kwargs:
-            return block_decorator(register, name)
+            return block_decorator(register, name, pure)
 
         function = kwargs['function']
         def callback(context, *args, **kwargs):
@@ -60,7 +68,7 @@ def block_decorator(register=register, name=None):
                    NodeList("__nodelist__"),
                    EndTag()]
 
-        tag_class = TagFactory.get_class(options, callback, name)
+        tag_class = TagFactory.get_class(options, callback, name, pure)
         register.tag(tag_class.as_tag())
 
         return tag_class
@@ -69,12 +77,13 @@ def block_decorator(register=register, name=None):
 block = block_decorator()
 
 
-def function_decorator(register=register, name=None):
+def function_decorator(register=register, name=None, pure=False):
     assert isinstance(name, basestring) or name is None 
     assert isinstance(register, template.Library)
 
     outer_name = name
     outer_register = register
+    outer_pure = pure
 
     def decorator(*args, **kwargs):
         kwargs = process_decorator_args_kwargs(Options, *args, **kwargs)
@@ -85,9 +94,10 @@ def function_decorator(register=register, name=None):
 
         register = outer_register if 'register' not in kwargs else kwargs['register']
         name = outer_name if 'name' not in kwargs else kwargs['name']
+        pure = outer_pure if 'pure' not in kwargs else kwargs['pure']
 
         if 'function' not in kwargs:
-            return function_decorator(register, name)
+            return function_decorator(register, name, pure)
 
         function = kwargs['function']
         def callback(context, *args, **kwargs):
@@ -106,7 +116,7 @@ def function_decorator(register=register, name=None):
                    MultiValueKeywordArgument(), 
                    Optional(Constant("as"), Argument("__as_name__", resolve=False))]
 
-        tag_class = TagFactory.get_class(options, callback, name)
+        tag_class = TagFactory.get_class(options, callback, name, pure)
         register.tag(tag_class.as_tag())
 
         return tag_class
@@ -2,7 +2,7 @@ from django.template import TemplateSyntaxError
 
 __all__ =  ['BaseError', 'TagNameError', 'ArgumentRequiredError', 'InvalidArgument', 
             'InvalidFlag', 'BreakpointExpected', 'TooManyArguments', 'TooFewArguments', 
-            'KeywordInUse', 'FormatError', 'UnexpectedElement']
+            'KeywordInUse', 'FormatError', 'UnexpectedElement', 'ParseBudgetExceeded']
 
 
 class BaseError(TemplateSyntaxError):
@@ -113,8 +113,32 @@ class UnexpectedTokenError(BaseError):
         self.current = current
 
 
+class ParseBudgetExceeded(TemplateSyntaxError):
+    """
+    Deliberately not a BaseError: the lookahead in Optional, OneOf and the
+    MultiValue arguments treats a BaseError as "this branch does not match",
+    which would only lead to more backtracking.
+    """
+    template = ("Parsing the tag '%(tagname)s' exceeded its budget of %(limit)s "
+                "steps while probing %(argument)s.")
+
+    def __init__(self, tagname, argument, limit):
+        self.tagname = tagname
+        self.argument = argument.__repr__()
+        self.limit = limit
+
+    def __str__(self): # pragma: no cover
+        return self.template % self.__dict__
+
+
 class TemplateSyntaxWarning(Warning):
     """
     Used for variable cleaning TemplateSyntaxErrors when in non-debug-mode.
     """
 
+
+class GrammarWarning(Warning):
+    """
+    Used by the grammar analyzer for tag options that force heavy backtracking.
+    """
+
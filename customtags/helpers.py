@@ -2,6 +2,7 @@ from django.template.loader import render_to_string
 from django.core.exceptions import ImproperlyConfigured
 
 from customtags.core import Tag
+from customtags.rendering import stream_template, write_template
 from customtags.arguments import Argument, Constant, NodeList, next_contained_argument
 
 
@@ -69,6 +70,16 @@ class InclusionTag(Tag):
         template = self.get_template(context, **kwargs)
         data = self.get_context(context, **kwargs)
         return render_to_string(template, data)
+
+    def stream_tag(self, context, **kwargs):
+        template = self.get_template(context, **kwargs)
+        data = self.get_context(context, **kwargs)
+        return stream_template(template, data)
+
+    def write_tag(self, context, out, **kwargs):
+        template = self.get_template(context, **kwargs)
+        data = self.get_context(context, **kwargs)
+        write_template(template, out, data)
     
     def get_template(self, context, **kwargs):
         return self.template
@@ -0,0 +1,347 @@
+"""
+Static inspection of compiled template bodies.
+
+``get_dependencies`` lists the context variables a nodelist refers to, as
+dotted paths: the variables of django's filter expressions, in variable
+nodes, tag arguments and filter arguments, and the names, attributes and
+constant items looked up by the expressions of customtags' arguments.  It
+walks the attributes of django's and customtags' template objects, so it also
+sees the variables of builtin tags such as ``{% if %}`` and ``{% for %}``.
+Tags reading the context other than through their arguments, and templates
+included by name, are not seen.
+
+``get_fingerprint`` hashes the structure of a nodelist: the classes of its
+nodes and objects, their scalar attributes, and the names of the functions
+they refer to.  Lists, tuples, sets and dicts are recorded by their builtin
+type, so a nodelist compiled by ``customtags.codegen`` has the fingerprint
+of the nodelist it was compiled from.  Equal bodies have equal fingerprints
+in every process.
+
+Paths rooted at names the body binds itself are left out: the loop
+variables of ``{% for %}`` and ``{% ct_for %}``, the names of ``{% with %}``,
+those that django's tags store ``as`` a variable, and the unresolved names of
+customtags' arguments, such as the *varname* of ``{% ct_with ... as varname %}``.
+Their values derive from the expressions they are bound from, which are
+dependencies themselves.
+
+``resolve_dependencies`` looks the paths up in a context and returns texts
+standing for their values in a cache key, without calling the methods they
+end with.  Only values whose text identifies them are keyed: ``None``,
+booleans, numbers, strings, dates and times, saved model instances by their
+primary key, querysets and managers by their query, functions and classes by
+their name, bound methods by their object, and lists, tuples, sets and dicts
+item by item.  Other values raise ``OpaqueValue``, since their ``repr`` may
+be the same for different contents.  The ``ct_cache`` tag keys the bodies it
+caches with both.
+"""
+import datetime
+import re
+import types
+from decimal import Decimal
+from hashlib import sha1
+
+from django.template.base import Variable, VariableDoesNotExist, Origin
+from django.template.defaulttags import ForNode, WithNode
+from django.template.engine import Engine
+from django.template.smartif import TokenBase
+from django.utils.encoding import force_bytes
+
+from customtags import nodes
+from customtags.arguments import LazyNodeList
+from customtags.core import Tag
+from customtags.values import ListValue, StaticValue, StringValue
+
+#: attributes pointing outside of the template, or at where it was read
+SKIPPED_ATTRIBUTES = frozenset(['source', 'origin', 'engine', 'parser', 'lock'])
+
+#: names the expression parser resolves without looking them up
+RESERVED_NAMES = frozenset(['none', 'None', 'true', 'True', 'false', 'False', '_'])
+
+#: the attributes of django's nodes naming the variable they store a value in
+BINDING_ATTRIBUTES = ('asvar', 'variable_name', 'var_name')
+
+#: values whose repr identifies them
+KEYABLE_TYPES = (type(None), bool, int, long, float, Decimal, basestring,
+                 datetime.date, datetime.time, datetime.timedelta)
+
+#: the containers walked item by item, recorded by the name of their type
+CONTAINER_TYPES = (list, tuple, set, frozenset, dict)
+
+MISSING = '<missing>'
+
+identifier_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class OpaqueValue(ValueError):
+    """
+    Raised for values a cache key can't be derived from.
+    """
+    def __init__(self, value, path=None):
+        self.value = value
+        self.path = path
+        ValueError.__init__(self, value, path)
+
+
+def get_path(expression):
+    """
+    Returns the dotted path looked up by a customtags *expression*, or None
+    if it isn't a lookup of constant names and items.
+    """
+    if isinstance(expression, nodes.Name):
+        if expression.name in RESERVED_NAMES:
+            return None
+        return expression.name
+    if isinstance(expression, nodes.Getattr):
+        path = get_path(expression.node)
+        return path and '%s.%s' % (path, expression.attr)
+    if isinstance(expression, nodes.Getitem):
+        arg = expression.arg
+        if isinstance(arg, nodes.Const):
+            arg = arg.value
+        if isinstance(arg, (basestring, int, long)):
+            path = get_path(expression.node)
+            return path and '%s.%s' % (path, arg)
+    return None
+
+
+def get_container_name(obj):
+    for container_type in CONTAINER_TYPES:
+        if isinstance(obj, container_type):
+            return container_type.__name__
+
+
+def is_template_object(obj):
+    module = getattr(type(obj), '__module__', None) or ''
+    return module.startswith('django.template') or module.startswith('customtags')
+
+
+class Walker(object):
+    """
+    Walks the objects reachable from a nodelist, collecting the variable
+    paths they look up, and a description of their structure.
+    """
+    def __init__(self):
+        self.paths = set()
+        self.bound = set()
+        self.parts = []
+        self.seen = set()
+
+    def visit(self, obj):
+        if obj is None or isinstance(obj, (bool, int, long, float, basestring)):
+            self.parts.append(repr(obj))
+            return
+        if isinstance(obj, (Origin, Engine)):
+            return
+        if id(obj) in self.seen:
+            self.parts.append('<seen>')
+            return
+        self.seen.add(id(obj))
+
+        if isinstance(obj, Variable):
+            if obj.lookups is not None:
+                self.paths.add('.'.join(obj.lookups))
+            self.parts.append('Variable(%s)' % obj.var)
+            return
+        if isinstance(obj, nodes.Expr):
+            path = get_path(obj)
+            if path is not None:
+                self.paths.add(path)
+                self.parts.append('Lookup(%s)' % path)
+                return
+
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            self.parts.append('%s[' % get_container_name(obj))
+            items = sorted(obj) if isinstance(obj, (set, frozenset)) else obj
+            for item in items:
+                self.visit(item)
+            self.parts.append(']')
+            return
+        if isinstance(obj, dict):
+            self.parts.append('%s{' % get_container_name(obj))
+            for key in sorted(obj):
+                self.visit(key)
+                self.visit(obj[key])
+            self.parts.append('}')
+            return
+
+        if callable(obj) and not is_template_object(obj) or isinstance(obj, type):
+            # functions and classes the template refers to
+            name = getattr(obj, '__name__', None) or type(obj).__name__
+            self.parts.append('%s.%s' % (getattr(obj, '__module__', None), name))
+            return
+        if not is_template_object(obj):
+            self.parts.append('%s(%r)' % (type(obj).__name__, obj))
+            return
+
+        self.bound.update(get_bound_names(obj))
+        cls = type(obj)
+        self.parts.append('%s.%s(' % (cls.__module__, cls.__name__))
+        if isinstance(obj, TokenBase):
+            # the operators of {% if %} only differ by a class attribute
+            self.parts.append(repr(obj.id))
+        if isinstance(obj, LazyNodeList):
+            self.visit(obj.nodelist)
+        else:
+            for name in self.get_attribute_names(obj):
+                if name in SKIPPED_ATTRIBUTES:
+                    continue
+                try:
+                    value = getattr(obj, name)
+                except AttributeError:
+                    continue
+                self.parts.append(name)
+                self.visit(value)
+        self.parts.append(')')
+
+    def get_attribute_names(self, obj):
+        if isinstance(obj, nodes.Node):
+            return obj.fields if not isinstance(obj.fields, basestring) else (obj.fields,)
+        names = set(getattr(obj, '__dict__', ()))
+        for cls in type(obj).__mro__:
+            names.update(getattr(cls, '__slots__', ()))
+        return sorted(names)
+
+
+def get_static_names(value):
+    """
+    Returns the names of the unresolved arguments in *value*.
+    """
+    if isinstance(value, ListValue):
+        return [name for item in value for name in get_static_names(item)]
+    if isinstance(value, StringValue) and isinstance(value.var, StaticValue):
+        name = value.var.value
+        if isinstance(name, basestring) and identifier_re.match(name):
+            return [name]
+    return []
+
+
+def get_constant_names(value):
+    """
+    Returns the strings in the resolved constant *value* that could be names.
+    """
+    if isinstance(value, (list, tuple)):
+        return [name for item in value for name in get_constant_names(item)]
+    if isinstance(value, basestring) and identifier_re.match(value):
+        return [value]
+    return []
+
+
+def get_bound_names(node):
+    """
+    Returns the names of the variables *node* binds for its body or the rest
+    of the template.
+    """
+    if isinstance(node, ForNode):
+        return list(node.loopvars)
+    if isinstance(node, WithNode):
+        return list(node.extra_context)
+    if isinstance(node, Tag):
+        # the constant arguments of a plan are only kept resolved, so any
+        # constant string that could be a name counts as one
+        plan = node.container.freeze()
+        values = [value for index, value in plan.dynamic_args]
+        values.extend(value for key, value in plan.dynamic_kwargs)
+        names = [name for value in values for name in get_static_names(value)]
+        constants = list(plan.args) + list(plan.kwargs.values())
+        names.extend(name for value in constants for name in get_constant_names(value))
+        return names
+    names = []
+    for attribute in BINDING_ATTRIBUTES:
+        name = getattr(node, attribute, None)
+        if isinstance(name, basestring):
+            names.append(name)
+    return names
+
+
+def walk(nodelist):
+    walker = Walker()
+    walker.visit(nodelist)
+    return walker
+
+
+def get_dependencies(nodelist):
+    """
+    Returns the sorted dotted paths of the variables *nodelist* refers to,
+    but for those of the names it binds.
+    """
+    walker = walk(nodelist)
+    return sorted(path for path in walker.paths
+                  if path.split('.', 1)[0] not in walker.bound)
+
+
+def get_fingerprint(nodelist):
+    return sha1(force_bytes('|'.join(walk(nodelist).parts))).hexdigest()
+
+
+def get_key_value(value):
+    """
+    Returns a text standing for *value* in a cache key, or raises
+    ``OpaqueValue`` if it has none.
+    """
+    if isinstance(value, KEYABLE_TYPES):
+        return repr(value)
+    bound_to = getattr(value, '__self__', None)
+    if bound_to is not None and not isinstance(value, type):
+        return '%s.%s' % (get_key_value(bound_to), value.__name__)
+    if isinstance(value, (types.FunctionType, types.BuiltinFunctionType, type)):
+        return '%s.%s' % (value.__module__, value.__name__)
+    meta = getattr(value, '_meta', None)
+    if meta is not None and hasattr(value, 'pk'):
+        if value.pk is None:
+            raise OpaqueValue(value)
+        return '%s.%s:%r' % (meta.app_label, meta.model_name, value.pk)
+    if hasattr(value, 'model') and hasattr(value, 'get_queryset'):
+        value = value.get_queryset()
+    query = getattr(value, 'query', None)
+    if query is not None and hasattr(value, 'model'):
+        return 'query:%s' % query
+    if isinstance(value, dict):
+        return 'dict{%s}' % ','.join('%s:%s' % (get_key_value(key), get_key_value(item))
+                                     for key, item in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return '%s[%s]' % (type(value).__name__, ','.join(get_key_value(item) for item in value))
+    if isinstance(value, (set, frozenset)):
+        return 'set[%s]' % ','.join(sorted(get_key_value(item) for item in value))
+    raise OpaqueValue(value)
+
+
+def lookup(path, context):
+    """
+    Looks the dotted *path* up in *context* like ``Variable.resolve``, but
+    stops at the first callable instead of calling it: the key of a body
+    must not run the methods the body is cached to avoid.
+    """
+    current = context
+    for bit in path.split('.'):
+        try:
+            current = current[bit]
+        except (TypeError, AttributeError, KeyError, ValueError, IndexError):
+            try:
+                current = getattr(current, bit)
+            except (TypeError, AttributeError):
+                try:
+                    current = current[int(bit)]
+                except (IndexError, ValueError, KeyError, TypeError):
+                    raise VariableDoesNotExist(path)
+        if callable(current):
+            break
+    return current
+
+
+def resolve_dependencies(paths, context):
+    """
+    Returns the key values of the variables at *paths* in *context*, or
+    raises ``OpaqueValue`` naming the path of a value without one.
+    """
+    values = []
+    for path in paths:
+        try:
+            value = lookup(path, context)
+        except VariableDoesNotExist:
+            values.append(MISSING)
+            continue
+        try:
+            values.append(get_key_value(value))
+        except OpaqueValue, e:
+            raise OpaqueValue(e.value, path)
+    return values
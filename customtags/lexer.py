@@ -114,11 +114,15 @@ class TokenStream(object):
         self._pushed = deque(generator) if generator is not None else None
         self.closed = False
         self.eof_token = None
+        self.budget = None
 
     def __copy__(self):
         copy = TokenStream()
         copy._pushed = deque(self._pushed)
         copy.closed = self.closed
+        copy.budget = self.budget
+        if self.budget is not None:
+            self.budget.snapshot()
         return copy
 
     def __repr__(self):
@@ -452,3 +456,17 @@ class Lexer(object):
                 raise TemplateSyntaxError('unexpected char %r at %d' %
                                           (source[pos], pos), lineno,
                                           name, filename)
+
+
+_shared_lexer = None
+
+def get_lexer():
+    """
+    Returns a lexer shared by all arguments and options.  A lexer keeps no
+    state between calls to ``tokenize``, and building one is costly enough to
+    show in the import time of libraries with many tags.
+    """
+    global _shared_lexer
+    if _shared_lexer is None:
+        _shared_lexer = Lexer()
+    return _shared_lexer
@@ -0,0 +1,139 @@
+"""
+A cached template loader that also keeps compiled templates on disk.
+
+Configured like django's cached loader::
+
+    'loaders': [
+        ('customtags.loaders.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
+With ``CUSTOMTAGS_TEMPLATE_CACHE_DIR`` set, a template missing from the cache
+in memory is read from its loaders, and looked up in that directory by a hash
+of its name and source before it is compiled; templates it compiles are
+written there with ``customtags.serialization``.  Editing a template changes
+its key.  Changing a tag library does not: clear the directory when deploying
+new tags.  Templates are looked up in the image at ``CUSTOMTAGS_TEMPLATE_STORE``
+first, see ``customtags.store``.  Templates that can't be loaded from either,
+since a tag or filter they use was renamed say, are compiled again.  With ``CUSTOMTAGS_PRERENDER`` set, the
+constant tags of the templates loaded are rendered once, see
+``customtags.prerender``; with ``CUSTOMTAGS_CODEGEN`` set, the templates are
+compiled to render functions, see ``customtags.codegen``.
+"""
+import os
+from hashlib import sha1
+
+import django
+from django.conf import settings
+from django.template import Template, TemplateDoesNotExist
+from django.template.loaders import cached
+from django.utils.encoding import force_bytes
+
+from customtags import codegen, prerender, serialization, store
+from customtags.utils import write_atomic
+
+SUFFIX = '.template'
+
+
+def get_cache_dir():
+    return getattr(settings, 'CUSTOMTAGS_TEMPLATE_CACHE_DIR', None)
+
+
+def get_cache_key(engine, template_name, source):
+    """
+    The key of a compiled template, in the cache directory and in the store.
+    """
+    from customtags import __version__
+    return sha1(force_bytes('|'.join([
+        str(serialization.FORMAT), __version__, django.get_version(),
+        str(engine.debug), template_name, source]))).hexdigest()
+
+
+def find_source(loaders, template_name, template_dirs=None):
+    """
+    Returns the first of *loaders* to find the template *template_name*, its
+    source and its display name.
+    """
+    for loader in loaders:
+        try:
+            source, display_name = loader.load_template_source(
+                template_name, template_dirs)
+        except (TemplateDoesNotExist, NotImplementedError):
+            continue
+        return loader, source, display_name
+    raise TemplateDoesNotExist(template_name)
+
+
+#: the errors of loading a template pickled by an older build, whose tags or
+#: filters may have been renamed since, or a corrupt one
+LOAD_ERRORS = (EnvironmentError, EOFError, ValueError, TypeError, AttributeError,
+               ImportError, serialization.SerializationError,
+               serialization.pickle.UnpicklingError)
+
+
+def _read(path, engine):
+    try:
+        with open(path, 'rb') as f:
+            return serialization.loads(f.read(), engine)
+    except LOAD_ERRORS:
+        return None
+
+
+class Loader(cached.Loader):
+
+    def load_compiled(self, template_name, template_dirs=None):
+        """
+        Returns the template *template_name* compiled, from the template store
+        or the cache directory if it was compiled before.
+        """
+        loader, source, display_name = find_source(
+            self.loaders, template_name, template_dirs)
+        key = get_cache_key(self.engine, template_name, source)
+
+        template_store = store.get_store()
+        if template_store is not None:
+            try:
+                template = template_store.get(key, self.engine)
+            except LOAD_ERRORS:
+                template = None
+            if template is not None:
+                return template
+
+        directory = get_cache_dir()
+        path = os.path.join(directory, key + SUFFIX) if directory is not None else None
+        if path is not None:
+            template = _read(path, self.engine)
+            if template is not None:
+                return template
+
+        origin = self.engine.make_origin(display_name, loader.load_template_source,
+                                         template_name, template_dirs)
+        template = Template(source, origin, template_name, self.engine)
+        if path is not None:
+            try:
+                data = serialization.dumps(template)
+            except (serialization.pickle.PicklingError, TypeError):
+                pass
+            else:
+                write_atomic(path, data)
+        return template
+
+    def load_template(self, template_name, template_dirs=None):
+        key = self.cache_key(template_name, template_dirs)
+        template_tuple = self.template_cache.get(key)
+        if template_tuple is TemplateDoesNotExist:
+            raise TemplateDoesNotExist(template_name)
+        elif template_tuple is None:
+            try:
+                template = self.load_compiled(template_name, template_dirs)
+            except TemplateDoesNotExist:
+                self.template_cache[key] = TemplateDoesNotExist
+                raise
+            if prerender.is_enabled():
+                prerender.prerender_template(template)
+            if codegen.is_enabled():
+                codegen.compile_template(template)
+            self.template_cache[key] = (template, None)
+        return self.template_cache[key]
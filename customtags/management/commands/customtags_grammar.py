@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from customtags import analysis
+from customtags.utils import iter_tag_classes
+
+
+class Command(BaseCommand):
+    help = ("Reports ambiguous branch points, lookahead depth and the estimated "
+            "parse cost of the grammar of every registered customtags tag.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('tagnames', nargs='*',
+            help="Only report on the tags with these names.")
+        parser.add_argument('--tokens', type=int, default=analysis.DEFAULT_TOKENS,
+            help="Number of tokens per tag used to estimate the parse cost.")
+        parser.add_argument('--ambiguous', action='store_true', default=False,
+            help="Only report on tags with ambiguous branch points.")
+        parser.add_argument('--max-cost', type=int, default=None,
+            help="Fail if the estimated cost of any tag exceeds this number of steps.")
+
+    def handle(self, *args, **options):
+        tagnames = set(options['tagnames'])
+        tokens = options['tokens']
+        max_cost = options['max_cost']
+
+        too_expensive = []
+        for libname, tagname, tag_class in iter_tag_classes():
+            if tagnames and tagname not in tagnames:
+                continue
+            tag_class.options.ensure_initialized(tag_class.name)
+            report = analysis.analyze(tag_class.options)
+            if options['ambiguous'] and not report.ambiguous:
+                continue
+
+            self.stdout.write("[%s] %s" % (libname or 'builtins', report.format(tokens)))
+            if max_cost is not None and report.estimated_cost(tokens) > max_cost:
+                too_expensive.append(tagname)
+
+        if too_expensive:
+            raise CommandError("Estimated parse cost exceeds %s steps for: %s" % (
+                max_cost, ', '.join(sorted(too_expensive))))
@@ -0,0 +1,90 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Context, loader
+
+from customtags import timing
+
+SORT_KEYS = ('total', 'count', 'mean', 'p50', 'p95', 'p99', 'max')
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    return '%.3f' % (seconds * 1000)
+
+
+class Command(BaseCommand):
+    help = ("Reports the parse and render times of every customtags tag, from "
+            "snapshots written by customtags.timing.write_timings, or by "
+            "rendering templates with timing enabled.  Render times cover tags "
+            "rendered whole, into an output and in chunks.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('snapshots', nargs='*',
+            help="Snapshot files to merge and report on.")
+        parser.add_argument('--template', action='append', dest='templates', default=[],
+            help="Render this template, with an empty context, and report on its tags.")
+        parser.add_argument('--iterations', type=int, default=100,
+            help="Number of times each template is rendered.")
+        parser.add_argument('--sample-rate', type=float, default=1.0,
+            help="Fraction of the parses and renders timed.")
+        parser.add_argument('--sort', choices=SORT_KEYS, default='total',
+            help="Sort the tags by this column, largest first.")
+        parser.add_argument('--limit', type=int, default=None,
+            help="Only report this many tags.")
+        parser.add_argument('--phase', choices=('parse', 'render'), default=None,
+            help="Only report on parsing or rendering.")
+
+    def handle(self, *args, **options):
+        snapshots = []
+        for path in options['snapshots']:
+            try:
+                with open(path) as snapshot:
+                    snapshots.append(json.load(snapshot))
+            except (IOError, ValueError), e:
+                raise CommandError("Could not read the snapshot %s: %s" % (path, e))
+        if options['templates']:
+            snapshots.append(self.time_templates(
+                options['templates'], options['iterations'], options['sample_rate']))
+        if not snapshots:
+            raise CommandError("Give snapshot files or templates to render.")
+
+        timings = timing.merge_timings(snapshots)
+        if options['phase'] is not None:
+            timings = [data for data in timings if data['phase'] == options['phase']]
+        timings.sort(key=lambda data: data[options['sort']], reverse=True)
+        if options['limit'] is not None:
+            timings = timings[:options['limit']]
+
+        self.stdout.write("%-8s %8s %10s %9s %9s %9s %9s %9s  %s" % (
+            'phase', 'count', 'total(ms)', 'mean', 'p50', 'p95', 'p99', 'max', 'tag'))
+        for data in timings:
+            self.stdout.write("%-8s %8d %10s %9s %9s %9s %9s %9s  %s (%s)" % (
+                data['phase'], data['count'], format_duration(data['total']),
+                format_duration(data['mean']), format_duration(data['p50']),
+                format_duration(data['p95']), format_duration(data['p99']),
+                format_duration(data['max']), data['name'], data['tag']))
+
+    def time_templates(self, names, iterations, sample_rate):
+        """
+        Compiles and renders the templates *names* with timing enabled, and
+        returns the snapshot of their histograms.  Timing, and the histograms
+        recorded before, are put back the way they were afterwards.
+        """
+        previous_rate = timing.get_enabled_sample_rate()
+        previous_timings = timing.swap_timings({})
+        timing.enable(sample_rate)
+        try:
+            for name in names:
+                template = loader.get_template(name)
+                template = getattr(template, 'template', template)
+                for i in range(iterations):
+                    template.render(Context())
+            return timing.get_timings()
+        finally:
+            timing.swap_timings(previous_timings)
+            if previous_rate is None:
+                timing.disable()
+            else:
+                timing.enable(previous_rate)
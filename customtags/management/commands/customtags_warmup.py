@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from customtags import store, warmup
+
+
+class Command(BaseCommand):
+    help = ("Compiles every template found in the template directories of the "
+            "default engine in a pool of processes, and reports the time spent "
+            "on each template and the templates that failed to compile.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*',
+            help="Only compile the templates with these names.")
+        parser.add_argument('--processes', type=int, default=None,
+            help="Number of worker processes, one per core by default.")
+        parser.add_argument('--slowest', type=int, default=None,
+            help="Only report this many of the slowest templates.")
+        parser.add_argument('--store', default=None,
+            help="Write the compiled templates into a template store at this path.")
+
+    def handle(self, *args, **options):
+        names = options['names'] or warmup.find_templates()
+        reports = warmup.warm_up(names, options['processes'], priming=False)
+
+        timed = sorted(reports, key=lambda report: report.elapsed, reverse=True)
+        if options['slowest'] is not None:
+            timed = timed[:options['slowest']]
+        if int(options['verbosity']) > 0:
+            for report in timed:
+                self.stdout.write("%8.2fms  %s" % (report.elapsed * 1000, report.name))
+
+        failed = [report for report in reports if report.error is not None]
+        for report in failed:
+            self.stderr.write("%s: %s" % (report.name, report.error))
+
+        self.stdout.write("Compiled %d templates in %.2fms of worker time." % (
+            len(reports), sum(report.elapsed for report in reports) * 1000))
+
+        if options['store'] is not None:
+            entries = [(report.key, report.data) for report in reports
+                       if report.data is not None]
+            if not store.build(options['store'], entries):
+                raise CommandError("Could not write the template store %s." % options['store'])
+            self.stdout.write("Stored %d templates in %s." % (len(entries), options['store']))
+        if failed:
+            raise CommandError("%d templates failed to compile: %s" % (
+                len(failed), ', '.join(report.name for report in failed)))
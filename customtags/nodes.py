@@ -52,6 +52,9 @@ _cmpop_to_func = {
     'notin':    lambda a, b: a not in b
 }
 
+#: the key of the batch of a loop in the render context, see customtags.batching
+BATCH_KEY = 'customtags.batch'
+
 _allop_to_func = {}
 _allop_to_func.update(_binop_to_func)
 _allop_to_func.update(_uaop_to_func)
@@ -358,6 +361,12 @@ class Call(Expr):
                 name = self.dyn_kwargs.name
                 raise ValueError("Dynamic kwargs '%s' must not be undefined." % name)
 
+        render_context = getattr(context, 'render_context', None)
+        if render_context is not None and BATCH_KEY in render_context:
+            # a loop batches calls, see customtags.batching
+            call_batched = getattr(func, 'call_batched', None)
+            if call_batched is not None:
+                return call_batched(context, *args, **kwargs)
         return func(*args, **kwargs)
 
 
@@ -7,90 +7,104 @@ and structured as a result of initialization
 """
 
 
-def structure_arguments(arguments, tagname, nextargs_outside=None, is_optional=False):
+class ArgumentSuffix(object):
     """
-    This function scans backwards through the arguments, validating each one, and then
-    attaching whatever configuration may be required for each according to type.  
-    Also, for MultiArguments, it calls itself recursively, to allow all nested arguments
-    to be visited.
+    An immutable view of the arguments that follow a position in the grammar,
+    including those outside of the enclosing MultiArgument.  Suffixes are
+    cons cells, so the views of neighbouring positions share their tails
+    rather than copying them.
     """
-    # fixes the python bug where the default [] is treated as a mutable global
-    nextargs_outside = nextargs_outside if nextargs_outside is not None else []
+    __slots__ = ('head', 'tail')
 
-    len_arguments = len(arguments)
-    if len_arguments == 0:
-        return arguments
+    def __init__(self, head=None, tail=None):
+        self.head = head
+        self.tail = tail
 
-    # this is to allow scanning beyond the current list
-    extended_args = list(arguments) + list(nextargs_outside)
+    def __iter__(self):
+        suffix = self
+        while suffix is not EMPTY_SUFFIX:
+            yield suffix.head
+            suffix = suffix.tail
 
-    last_arg = arguments[len_arguments-1]
-    if isinstance(last_arg, basestring):
-        last_arg = arguments[len_arguments-1] = \
-                   extended_args[len_arguments-1] = Constant(last_arg)
+    def __nonzero__(self):
+        return self is not EMPTY_SUFFIX
 
-    last_arg.initialize(tagname)
+    @classmethod
+    def from_list(cls, arguments):
+        suffix = EMPTY_SUFFIX
+        for argument in reversed(list(arguments)):
+            suffix = cls(argument, suffix)
+        return suffix
 
-    if isinstance(last_arg, MultiArgument):
-        last_arg.arguments = structure_arguments(
-            last_arg.arguments, last_arg.tagname, nextargs_outside,
-            isinstance(last_arg, Optional)
-        )
+EMPTY_SUFFIX = ArgumentSuffix()
 
-    structure_exclude_constant(exclusive_arg=last_arg, 
-                               possible_constants=nextargs_outside)
-    structure_possible_nodelist(possible_nodelist=last_arg, 
-                                possible_block_tags=nextargs_outside)
 
-    i = len_arguments-2
-    j = len_arguments-1
-    while i >= 0:
+def structure_arguments(arguments, tagname, nextargs_outside=None, is_optional=False):
+    """
+    This function scans backwards through the arguments, validating each one, and then
+    attaching whatever configuration may be required for each according to type.  
+    Also, for MultiArguments, it calls itself recursively, to allow all nested arguments
+    to be visited.
+
+    The scan is a single pass: the argument visited last is kept "pending", since
+    it may still be merged with the one before it into a single Optional, and
+    only then is it pushed onto the shared suffix of finished arguments.  A new
+    sequence of the same type as *arguments* is returned.
+    """
+    if len(arguments) == 0:
+        return arguments
 
-        current_arg = arguments[i] 
-        visited_arg = arguments[j]
-        already_visited_list = extended_args[j:]
+    if isinstance(nextargs_outside, ArgumentSuffix):
+        finished_suffix = nextargs_outside
+    else:
+        finished_suffix = ArgumentSuffix.from_list(nextargs_outside or [])
 
-        if isinstance(current_arg, EndTag):
-            raise ImproperlyConfigured("EndTag should be the last argument.")
+    finished = []
+    pending = None
+    for current_arg in reversed(arguments):
+        if pending is None:
+            already_visited = finished_suffix
+        else:
+            if isinstance(current_arg, EndTag):
+                raise ImproperlyConfigured("EndTag should be the last argument.")
+            already_visited = ArgumentSuffix(pending, finished_suffix)
 
         if isinstance(current_arg, basestring):
-            current_arg = arguments[i] = extended_args[i] = Constant(current_arg)
+            current_arg = Constant(current_arg)
 
         current_arg.initialize(tagname)
 
         if isinstance(current_arg, MultiArgument):
             current_arg.arguments = structure_arguments(
-                current_arg.arguments, current_arg.tagname, already_visited_list,
+                current_arg.arguments, current_arg.tagname, already_visited,
                 isinstance(current_arg, Optional)
             )
 
         # set up for parsing
         structure_exclude_constant(exclusive_arg=current_arg, 
-                                   possible_constants=already_visited_list)
+                                   possible_constants=already_visited)
         structure_possible_nodelist(possible_nodelist=current_arg, 
-                                    possible_block_tags=already_visited_list)
-
-        if not is_optional:
-            current_arg, visited_arg = not_required_to_optional(current_arg, visited_arg)
-            arguments[i] = extended_args[i] = current_arg
+                                    possible_block_tags=already_visited)
 
-            # visited_arg is None when current_arg and visited_arg are merged into
-            # a single Optional argument.  Here it is deleted from the trailing lists.
+        if pending is not None:
+            if not is_optional:
+                # pending is None when current_arg and pending are merged into
+                # a single Optional argument.
+                current_arg, pending = not_required_to_optional(current_arg, pending)
 
-            if visited_arg is None:
-                del arguments[j]
-                del extended_args[j]
-            else:
-                arguments[j] = extended_args[j] = visited_arg 
+            if pending is not None:
+                finished.append(pending)
+                finished_suffix = ArgumentSuffix(pending, finished_suffix)
 
-        i -= 1
-        j -= 1
+        pending = current_arg
 
     # If the first argument is not required, then this will wrap it in "optional".
     if not is_optional:
-        throw_away, arguments[0] = not_required_to_optional(None, arguments[0])
+        throw_away, pending = not_required_to_optional(None, pending)
+    finished.append(pending)
 
-    return arguments
+    finished.reverse()
+    return type(arguments)(finished)
 
 
 def structure_exclude_constant(exclusive_arg, possible_constants):
@@ -0,0 +1,100 @@
+"""
+Prefetch planning for loops over querysets.
+
+``get_paths`` lists the dotted paths a loop body looks up on its loop
+variable, as found by ``customtags.introspection``: those of django's
+variables and of customtags' expressions, such as ``item.author.name`` or
+``item.tags.all``.  ``get_lookups`` maps them to the relations of the model
+iterated: chains of foreign keys and one-to-one relations are joined with
+``select_related``, and chains reaching a many-to-many field or a reverse
+foreign key are fetched with ``prefetch_related``.  ``prefetch_queryset``
+applies them to a queryset that hasn't been evaluated yet, so that the loop
+doesn't run queries for every item::
+
+    {% ct_for book in books prefetch %}{{ book.author.name }}{% endfor %}
+
+Paths that aren't relations are left alone, and so are sequences other than
+querysets of model instances.  Relations read by tags looking at the
+context directly, or by included templates, are not seen.
+"""
+from django.db.models.query import QuerySet
+
+from customtags import introspection
+
+
+def get_paths(nodelist, name):
+    """
+    Returns the paths *nodelist* looks up on the variable *name*, as tuples
+    of the names following it.
+    """
+    prefix = name + '.'
+    return [tuple(path[len(prefix):].split('.'))
+            for path in introspection.get_dependencies(nodelist)
+            if path.startswith(prefix)]
+
+
+def get_relations(model):
+    """
+    Returns the relations of *model* by the name of the attributes giving
+    access to them.
+    """
+    relations = {}
+    for field in model._meta.get_fields():
+        if not field.is_relation or field.related_model is None:
+            continue
+        if field.auto_created and not field.concrete:
+            relations[field.get_accessor_name()] = field
+        else:
+            relations[field.name] = field
+    return relations
+
+
+def get_lookups(model, paths):
+    """
+    Returns the sorted ``select_related`` and ``prefetch_related`` lookups
+    following the relations looked up by *paths* from *model*.
+    """
+    selected = set()
+    prefetched = set()
+    for path in paths:
+        attributes = []
+        query_names = []
+        selectable = True
+        current = model
+        for name in path:
+            field = get_relations(current).get(name)
+            if field is None:
+                break
+            attributes.append(name)
+            if selectable and (field.many_to_one or field.one_to_one):
+                if field.concrete:
+                    query_names.append(field.name)
+                else:
+                    query_names.append(field.field.related_query_name())
+            else:
+                selectable = False
+            current = field.related_model
+        if query_names:
+            selected.add('__'.join(query_names))
+        if not selectable:
+            prefetched.add('__'.join(attributes))
+    return sorted(selected), sorted(prefetched)
+
+
+def prefetch_queryset(queryset, paths):
+    """
+    Returns *queryset* fetching the relations looked up by *paths* along with
+    its objects, or *queryset* itself if it isn't an unevaluated queryset of
+    model instances.
+    """
+    if not isinstance(queryset, QuerySet) or queryset._result_cache is not None:
+        return queryset
+    if getattr(queryset, '_fields', None) is not None:
+        # values() and values_list()
+        return queryset
+    selected, prefetched = get_lookups(queryset.model, paths)
+    if selected:
+        queryset = queryset.select_related(*selected)
+    if prefetched:
+        queryset = queryset.prefetch_related(*prefetched)
+    return queryset
@@ -0,0 +1,89 @@
+"""
+Renders the constant parts of compiled templates once.
+
+``prerender_nodelist`` replaces each tag of a nodelist that is constant, see
+``Tag.is_constant``, with a text node of its output, rendered in an empty
+context, and merges adjacent text nodes.  The bodies of the other nodes are
+pre-rendered the same way first, so that a pure tag whose body only holds
+constant tags is itself constant.  A tag failing to render is kept, and fails
+when the template is rendered.
+
+``customtags.loaders.Loader`` pre-renders the templates it loads when
+``CUSTOMTAGS_PRERENDER`` is set, before ``customtags.codegen`` compiles them.
+"""
+from django.conf import settings
+from django.template import Context
+from django.template.base import Node, NodeList, TextNode
+from django.utils.encoding import force_text
+
+from customtags.core import Tag
+
+
+def is_enabled():
+    return getattr(settings, 'CUSTOMTAGS_PRERENDER', False)
+
+
+def get_child_nodelists(node):
+    """
+    Returns the nodelists *node* renders.  Nodelists built by a property on
+    every access, such as ``IfNode.nodelist``, are looked up where the
+    property builds them from.
+    """
+    if isinstance(node, Tag):
+        return list(node.container.freeze().tag_nodelists)
+    nodelists = [nodelist for condition, nodelist
+                 in getattr(node, 'conditions_nodelists', ())]
+    for attr in getattr(node, 'child_nodelists', ()):
+        if isinstance(getattr(type(node), attr, None), property):
+            continue
+        nodelist = getattr(node, attr, None)
+        if nodelist is not None:
+            nodelists.append(nodelist)
+    return nodelists
+
+
+def prerender_node(node):
+    """
+    Returns *node* rendered as a text node if it is constant, else *node*.
+    """
+    if not isinstance(node, Tag) or not node.is_constant():
+        return node
+    try:
+        text = TextNode(force_text(node.render(Context())))
+    except Exception:
+        return node
+    if hasattr(node, 'source'):
+        text.source = node.source
+    return text
+
+
+def prerender_nodelist(nodelist):
+    """
+    Pre-renders *nodelist* in place, and returns it.  Lazy bodies that were
+    not compiled yet are left as they are.
+    """
+    if not isinstance(nodelist, NodeList):
+        return nodelist
+    nodes = []
+    for node in nodelist:
+        if isinstance(node, Node) and not isinstance(node, TextNode):
+            for child in get_child_nodelists(node):
+                prerender_nodelist(child)
+            node = prerender_node(node)
+        if type(node) is TextNode and nodes and type(nodes[-1]) is TextNode:
+            merged = TextNode(nodes[-1].s + node.s)
+            if hasattr(nodes[-1], 'source'):
+                merged.source = nodes[-1].source
+            nodes[-1] = merged
+        else:
+            nodes.append(node)
+    nodelist[:] = nodes
+    return nodelist
+
+
+def prerender_template(template):
+    """
+    Pre-renders the nodelist of *template* in place, and returns the template.
+    """
+    prerender_nodelist(template.nodelist)
+    return template
@@ -0,0 +1,136 @@
+"""
+Memoizes the output of ``render_tag`` for tags that are deterministic in
+their resolved arguments.
+
+A tag opts in by declaring a cache on its class::
+
+    class Price(core.Tag):
+        options = core.Options(arguments.Argument('amount'))
+        render_cache = RenderCache(maxsize=1000, ttl=60)
+
+``Tag.render`` then looks the resolved ``args`` and ``kwargs`` up in the
+cache before calling ``render_tag``, and stores what it returns.  The cache
+keeps at most *maxsize* outputs, evicting the least recently used, and drops
+outputs older than *ttl* seconds if given.  The lists and dicts built by
+multi-value arguments are keyed by their items, the groups of repeated
+arguments by their resolved values, and other values by their type as well,
+so that ``1``, ``1.0`` and ``True`` don't share an output.  Tags given
+template bodies, whose output depends on more than the arguments, and those
+given arguments that can't be hashed are rendered as usual.  Only the output is cached: ``render_tag``
+must not change the context, and may not read it other than through its
+arguments.
+
+A cache declared on a tag class is shared with its subclasses; the tag
+class is part of the key.
+"""
+import time
+from collections import OrderedDict
+
+from django.template.base import Node, NodeList, Template
+
+from customtags._compat import allocate_lock
+from customtags.arguments import LazyNodeList, RepContainer
+
+
+def freeze(value):
+    """
+    Returns a hashable stand-in for *value*, keying the lists and dicts in it
+    by their items.  Raises ``TypeError`` for template bodies and values that
+    can't be hashed.
+    """
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((key, freeze(item)) for key, item in value.items())))
+    if isinstance(value, (NodeList, LazyNodeList, Node, Template)):
+        raise TypeError("Template bodies aren't keyed by their output.")
+    if isinstance(value, list):
+        return (list, tuple(freeze(item) for item in value))
+    if isinstance(value, RepContainer):
+        return (RepContainer, freeze(list(value.args)), freeze(dict(value.kwargs)))
+    hash(value)
+    return (type(value), value)
+
+
+class RenderCache(object):
+    """
+    A bounded LRU cache of rendered tag outputs, with an optional TTL, and
+    counters of its hits, misses, evictions, and of the renders whose
+    arguments could not be hashed.
+    """
+    def __init__(self, maxsize=128, ttl=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = allocate_lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unhashable = 0
+
+    def __repr__(self):
+        return "<RenderCache(maxsize=%s, ttl=%s): %s/%s hits>" % (
+            self.maxsize, self.ttl, self.hits, self.hits + self.misses)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_key(self, tag, args, kwargs):
+        """
+        Returns the key of a render of *tag*, or None if the arguments can't
+        be keyed.
+        """
+        try:
+            return (type(tag), freeze(list(args)), freeze(kwargs))
+        except TypeError:
+            return None
+
+    def render(self, tag, context, args, kwargs):
+        """
+        Returns the output of ``tag.render_tag`` for the arguments, from the
+        cache if it holds a fresh one.
+        """
+        key = self.get_key(tag, args, kwargs)
+        if key is None:
+            with self.lock:
+                self.unhashable += 1
+            return tag.render_tag(context, *args, **kwargs)
+
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                output, expires = entry
+                if expires is None or expires > now:
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return output
+                self.evictions += 1
+            self.misses += 1
+
+        output = tag.render_tag(context, *args, **kwargs)
+        expires = now + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (output, expires)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return output
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'unhashable': self.unhashable,
+            }
@@ -0,0 +1,185 @@
+"""
+Streaming rendering of templates.
+
+``iter_nodelist`` renders a nodelist as a sequence of chunks of text: the
+output of each node, or the chunks yielded by ``render_stream`` for nodes
+that have one.  ``Tag.render_stream`` yields the chunks of tags that
+implement ``stream_tag``, a generator taking the same arguments as
+``render_tag``, and the output of ``render`` for the others; other nodes,
+such as django's ``{% for %}`` or ``{% extends %}``, are rendered whole.
+
+``stream_template`` renders a template by name like ``render_to_string``,
+and ``streaming_response`` sends it in a ``StreamingHttpResponse``, in
+chunks of about ``CHUNK_SIZE`` characters, so that the output doesn't have
+to be held in memory before the first byte is sent::
+
+    def export(request):
+        return streaming_response('export.csv', {'rows': rows},
+                                  request, content_type='text/csv')
+
+``render_into`` writes the output of a nodelist into *out*, a list or a
+file-like object such as ``io.StringIO``, instead of returning it: nested
+bodies are written where they are rendered rather than joined into a string
+at every level and joined again by their parent.  ``Tag.render_into``
+calls ``write_tag`` for tags that implement it, a method taking *out* after
+the context and then the arguments of ``render_tag``, and writes the output
+of ``render`` for the others.  ``write_template`` renders a template by name
+into *out*::
+
+    out = []
+    write_template('page.html', out, {'rows': rows})
+    output = u''.join(out)
+"""
+from contextlib import contextmanager
+
+from django.http import StreamingHttpResponse
+from django.template import loader
+from django.template.base import Node
+from django.template.context import make_context
+from django.utils.encoding import force_text
+
+#: the number of characters buffered before a chunk is sent
+CHUNK_SIZE = 8192
+
+
+def iter_nodelist(nodelist, context):
+    """
+    Yields the rendered chunks of *nodelist*, leaving out empty ones.
+    """
+    for node in nodelist:
+        if hasattr(node, 'render_stream'):
+            for chunk in node.render_stream(context):
+                if chunk:
+                    yield chunk
+            continue
+        if isinstance(node, Node):
+            chunk = force_text(node.render(context))
+        else:
+            chunk = force_text(node)
+        if chunk:
+            yield chunk
+
+
+@contextmanager
+def binding_template(template, context):
+    """
+    Sets up *context* for rendering the compiled django ``Template``
+    *template* like ``Template.render``: a render context of its own, and,
+    if no template is bound yet, the template and its name, which are put
+    back afterwards.
+    """
+    context.render_context.push()
+    try:
+        if context.template is None:
+            template_name = getattr(context, 'template_name', None)
+            with context.bind_template(template):
+                context.template_name = template.name
+                try:
+                    yield
+                finally:
+                    context.template_name = template_name
+        else:
+            yield
+    finally:
+        context.render_context.pop()
+
+
+def iter_template(template, context):
+    """
+    Yields the rendered chunks of a compiled django ``Template``, rendering
+    it with *context* like ``Template.render``.
+    """
+    with binding_template(template, context):
+        for chunk in iter_nodelist(template.nodelist, context):
+            yield chunk
+
+
+def get_writer(out):
+    """
+    Returns the function writing a text to *out*, a list or a file-like
+    object.
+    """
+    write = getattr(out, 'write', None)
+    if write is None:
+        return out.append
+    return write
+
+
+def render_into(nodelist, context, out):
+    """
+    Writes the rendered nodes of *nodelist* into *out*.
+    """
+    write = get_writer(out)
+    for node in nodelist:
+        if hasattr(node, 'render_into'):
+            node.render_into(context, out)
+        elif isinstance(node, Node):
+            write(force_text(node.render(context)))
+        else:
+            write(force_text(node))
+
+
+def render_template_into(template, context, out):
+    """
+    Writes a compiled django ``Template``, rendered with *context* like
+    ``Template.render``, into *out*.
+    """
+    with binding_template(template, context):
+        render_into(template.nodelist, context, out)
+
+
+def buffer_chunks(chunks, size=CHUNK_SIZE):
+    """
+    Joins *chunks* into chunks of at least *size* characters, but for the
+    last one.
+    """
+    buffered = []
+    length = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield u''.join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield u''.join(buffered)
+
+
+def get_template(template_name, using=None):
+    """
+    Returns the compiled django ``Template`` named *template_name*, or the
+    first of a list of names that exists.
+    """
+    if isinstance(template_name, (list, tuple)):
+        template = loader.select_template(template_name, using=using)
+    else:
+        template = loader.get_template(template_name, using=using)
+    return getattr(template, 'template', template)
+
+
+def stream_template(template_name, context=None, request=None, using=None):
+    """
+    Yields the rendered chunks of the template *template_name*, or of the
+    first of a list of names that exists, with the dict *context*.
+    """
+    template = get_template(template_name, using)
+    return iter_template(template, make_context(context or {}, request))
+
+
+def write_template(template_name, out, context=None, request=None, using=None):
+    """
+    Writes the template *template_name*, or the first of a list of names
+    that exists, rendered with the dict *context*, into *out*.
+    """
+    template = get_template(template_name, using)
+    render_template_into(template, make_context(context or {}, request), out)
+
+
+def streaming_response(template_name, context=None, request=None,
+                       content_type=None, status=None, using=None):
+    """
+    Returns a ``StreamingHttpResponse`` of the template *template_name*.
+    """
+    chunks = buffer_chunks(stream_template(template_name, context, request, using))
+    return StreamingHttpResponse(chunks, content_type=content_type, status=status)
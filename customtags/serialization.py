@@ -0,0 +1,159 @@
+"""
+Pickling of compiled templates.
+
+A compiled ``Template`` refers to things that don't pickle, or that shouldn't
+be pickled along with it: filter functions and tag classes that were created
+at runtime (lambdas, tags made by the decorators), the ``Engine`` it was
+compiled by, with all of its loaders and their caches, and in debug mode the
+bound loader methods kept by the origins of its nodes.
+
+``dumps`` stores those by reference: a registered filter by the name of its
+library and its name in it, the tag class of a registered tag by the name of
+its library and of the tag, and the engine and its loaders by a marker.
+``loads`` looks the filters and tags up again in the libraries of the
+loading process, and hands the template and its origins the engine it is
+given, the default engine if None.
+
+``customtags.loaders.Loader`` uses these to keep compiled templates in the
+``CUSTOMTAGS_TEMPLATE_CACHE_DIR`` directory, and ``customtags.warmup`` to
+send the templates compiled by its workers back to the parent process.
+"""
+try:
+    import cPickle as pickle
+except ImportError: # pragma: no cover
+    import pickle
+from cStringIO import StringIO
+
+from django.template import Engine, TemplateDoesNotExist
+from django.template.base import builtins, libraries, get_library, \
+     InvalidTemplateLibrary
+from django.template.loaders.base import Loader as BaseLoader
+
+from customtags.utils import iter_loaders
+
+#: bumped whenever the format written by ``dumps`` changes
+FORMAT = 1
+
+ENGINE = 'engine'
+LOADER = 'loader'
+FILTER = 'filter'
+TAG = 'tag'
+
+_index = {}
+_indexed = [None]
+
+
+class SerializationError(Exception):
+    pass
+
+
+def _iter_registered():
+    for library in builtins:
+        yield None, library
+    for name, library in sorted(libraries.items()):
+        yield name, library
+
+
+def _get_index():
+    """
+    Maps every registered filter function, and the tag class of every tag
+    made with ``Tag.as_tag``, to its reference.  Rebuilt whenever a library
+    was loaded since it was last built.
+    """
+    state = (len(builtins), len(libraries))
+    if _indexed[0] != state:
+        index = {}
+        for libname, library in _iter_registered():
+            for name, function in library.filters.items():
+                index.setdefault(function, (FILTER, libname, name))
+            for name, function in library.tags.items():
+                tag_class = getattr(function, 'tag_class', None)
+                if tag_class is not None:
+                    index.setdefault(tag_class, (TAG, libname, name))
+        _index.clear()
+        _index.update(index)
+        _indexed[0] = state
+    return _index
+
+
+class EngineLoader(object):
+    """
+    Stands in for the loaders in the origins of a loaded template: loads the
+    source of a template with the loaders of an engine.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __call__(self, name, dirs=None):
+        for loader in iter_loaders(self.engine.template_loaders):
+            try:
+                return loader.load_template_source(name, dirs)
+            except (TemplateDoesNotExist, NotImplementedError):
+                continue
+        raise TemplateDoesNotExist(name)
+
+
+def _persistent_id(obj):
+    if not callable(obj) and not isinstance(obj, (Engine, BaseLoader)):
+        return None
+    if isinstance(obj, Engine):
+        return (ENGINE,)
+    if isinstance(obj, BaseLoader) or \
+       isinstance(getattr(obj, 'im_self', None), BaseLoader):
+        return (LOADER,)
+    try:
+        return _index.get(obj)
+    except TypeError:
+        return None
+
+
+def _find(kind, libname, name):
+    if libname is None:
+        candidates = builtins
+    else:
+        try:
+            candidates = [get_library(libname)]
+        except InvalidTemplateLibrary:
+            candidates = []
+    for library in candidates:
+        if kind == FILTER and name in library.filters:
+            return library.filters[name]
+        if kind == TAG and name in library.tags:
+            return library.tags[name].tag_class
+    raise SerializationError("The %s '%s' of the library '%s' is not registered." % (
+        kind, name, libname or 'builtins'))
+
+
+def dumps(template):
+    """
+    Returns the pickled *template*.
+    """
+    _get_index()
+    f = StringIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = _persistent_id
+    pickler.dump((FORMAT, template))
+    return f.getvalue()
+
+
+def loads(data, engine=None):
+    """
+    Returns the template pickled by ``dumps`` in *data*, compiled by *engine*.
+    """
+    if engine is None:
+        engine = Engine.get_default()
+    loader = EngineLoader(engine)
+
+    def persistent_load(pid):
+        if pid[0] == ENGINE:
+            return engine
+        if pid[0] == LOADER:
+            return loader
+        return _find(*pid)
+
+    unpickler = pickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = persistent_load
+    format, template = unpickler.load()
+    if format != FORMAT:
+        raise SerializationError("Unsupported format %r." % format)
+    return template
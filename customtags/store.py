@@ -0,0 +1,125 @@
+"""
+A read-only image of compiled templates, which the workers of a server load
+templates from instead of parsing them.
+
+``build`` writes the templates pickled by ``customtags.serialization`` into a
+single file, behind an index of their offsets keyed like the entries of the
+template cache directory: by a hash of the name and source of each template.
+Setting ``CUSTOMTAGS_TEMPLATE_STORE`` to the path of the image makes
+``customtags.loaders.Loader`` map it read-only, and load a template from it
+the first time the template is used; templates whose source changed since the
+image was built, and those that can't be unpickled any more, are compiled as
+usual.
+
+The store saves the time spent parsing templates, not memory: each worker
+unpickles its own copy of the templates it uses, and ``memory.py --workers``
+shows workers loading from a store using a little more memory than workers
+compiling their templates.  To share the compiled templates between the
+workers of a pre-forking server, compile them in the master before forking,
+with ``warmup.warm_up``, which uses the least memory on CPython 2.
+
+An image that can't be read is not mapped again by the process: restart the
+workers once it is built.
+
+    python manage.py customtags_warmup --store /var/cache/app/templates.img
+"""
+import mmap
+import struct
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError: # pragma: no cover
+    import pickle
+
+from django.conf import settings
+
+from customtags import serialization
+from customtags.utils import write_atomic
+
+MAGIC = 'CTSTORE1'
+
+_HEADER = struct.Struct('<8sI')
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class StoreError(Exception):
+    pass
+
+
+def build(path, entries):
+    """
+    Writes the image of *entries*, pairs of a key and a template pickled by
+    ``serialization.dumps``, to *path*.  Returns False if it couldn't be
+    written.
+    """
+    index = {}
+    blobs = []
+    offset = 0
+    for key, data in entries:
+        index[key] = (offset, len(data))
+        blobs.append(data)
+        offset += len(data)
+    header = pickle.dumps(index, pickle.HIGHEST_PROTOCOL)
+    return write_atomic(path, _HEADER.pack(MAGIC, len(header)) + header + ''.join(blobs))
+
+
+class TemplateStore(object):
+    """
+    A template image mapped read-only into memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise StoreError("%s is not a template store." % path)
+        start = _HEADER.size
+        self._index = pickle.loads(self._map[start:start + length])
+        self._start = start + length
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key, engine=None):
+        """
+        Returns the template stored under *key* for *engine*, or None.
+        """
+        try:
+            offset, length = self._index[key]
+        except KeyError:
+            return None
+        start = self._start + offset
+        return serialization.loads(self._map[start:start + length], engine)
+
+    def close(self):
+        self._map.close()
+
+
+def get_store():
+    """
+    Returns the store at ``CUSTOMTAGS_TEMPLATE_STORE``, mapped once per process,
+    or None if the setting is not set or the store couldn't be read.
+    """
+    path = getattr(settings, 'CUSTOMTAGS_TEMPLATE_STORE', None)
+    if path is None:
+        return None
+    try:
+        return _stores[path]
+    except KeyError:
+        pass
+    with _stores_lock:
+        if path not in _stores:
+            try:
+                _stores[path] = TemplateStore(path)
+            except (EnvironmentError, ValueError, StoreError, struct.error,
+                    pickle.UnpicklingError, EOFError):
+                _stores[path] = None
+        return _stores[path]
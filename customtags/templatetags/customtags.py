@@ -1,2 +1,88 @@
+from __future__ import absolute_import
+
+from hashlib import sha1
+
 from django import template
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.encoding import force_bytes
+from django.utils.safestring import mark_safe
+
+from customtags import arguments, core, introspection
+
 register = template.Library()
+
+KEY_PREFIX = 'customtags.ct_cache'
+
+
+class Cache(core.Tag):
+    """
+    Caches the rendered body for *timeout* seconds, in the cache backend
+    named by ``CUSTOMTAGS_FRAGMENT_CACHE`` ('default')::
+
+        {% ct_cache 300 %}...{% endct_cache %}
+        {% ct_cache 300 request.user.pk %}...{% endct_cache %}
+
+    The key is made of a fingerprint of the body and of the values of the
+    variables the body refers to, see ``customtags.introspection``; a key
+    expression replaces those values.  Bodies using variables that can't be
+    seen, such as tags reading the context directly or included templates,
+    need a key expression, and so do bodies referring to values a key can't be
+    derived from, such as objects without a meaningful text, for which the tag
+    raises a ``TemplateSyntaxError``.  A timeout of None caches the body until
+    it is evicted.
+    """
+    name = 'ct_cache'
+
+    options = core.Options(
+        arguments.Argument('timeout'),
+        arguments.Argument('key', required=False),
+        blocks=['endct_cache'],
+    )
+
+    def get_dependencies(self, nodelist):
+        """
+        The fingerprint of the body and the variables it refers to, found
+        the first time the tag is rendered.
+        """
+        dependencies = getattr(self, '_dependencies', None)
+        if dependencies is None:
+            dependencies = self._dependencies = (
+                introspection.get_fingerprint(nodelist),
+                introspection.get_dependencies(nodelist))
+        return dependencies
+
+    def get_cache_key(self, context, key, nodelist):
+        fingerprint, paths = self.get_dependencies(nodelist)
+        try:
+            if key is not None:
+                values = [introspection.get_key_value(key)]
+            else:
+                values = introspection.resolve_dependencies(paths, context)
+        except introspection.OpaqueValue, e:
+            if e.path is None:
+                raise template.TemplateSyntaxError(
+                    "ct_cache can't derive a key from %r; key it by a value "
+                    "such as a string, a number or a saved model." % (e.value,))
+            raise template.TemplateSyntaxError(
+                "ct_cache can't derive a key from the value of %r (%r); give "
+                "the tag a key expression, as in {%% ct_cache 60 key %%}." % (e.path, e.value))
+        digest = sha1(force_bytes('|'.join([fingerprint] + values))).hexdigest()
+        return '%s.%s' % (KEY_PREFIX, digest)
+
+    def render_tag(self, context, timeout, key, endct_cache):
+        if timeout is not None:
+            try:
+                timeout = int(timeout)
+            except (ValueError, TypeError):
+                raise template.TemplateSyntaxError(
+                    "ct_cache timeout must be a number, not %r." % timeout)
+        cache = caches[getattr(settings, 'CUSTOMTAGS_FRAGMENT_CACHE', 'default')]
+        cache_key = self.get_cache_key(context, key, endct_cache)
+        output = cache.get(cache_key)
+        if output is None:
+            output = endct_cache.render(context)
+            cache.set(cache_key, output, timeout)
+        return mark_safe(output)
+
+register.tag('ct_cache', Cache.as_tag())
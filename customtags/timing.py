@@ -0,0 +1,322 @@
+"""
+Timing histograms of the tags parsed and rendered.
+
+``enable`` wraps ``Tag.parse``, which calls ``Options.parse``, and the
+methods rendering tags in functions timing a sample of the calls, one in
+every ``1 / sample_rate``; ``disable`` puts the methods back.  Rendering is
+timed in ``Tag.render``, which calls ``render_tag``, ``Tag.render_into``,
+which calls ``write_tag``, and ``Tag.render_stream``, which yields the
+chunks of ``stream_tag``, timed until the last chunk is consumed, without
+the time the consumer spends between chunks.  The three are recorded
+together as rendering; ``render_into`` and ``render_stream`` falling back to
+``render`` are timed there only.
+
+Tags are timed per class, parsing and rendering apart, in histograms of
+buckets growing by a quarter of a doubling from a microsecond, so that
+percentiles are known within about 19%.  Render times include those of the
+tags nested in the bodies of a tag.  Tags overriding the rendering methods,
+and those compiled by ``customtags.codegen``, which compiles none while
+timing is enabled, aren't timed.  Templates compiled before timing is
+enabled keep their compiled tags, untimed, until they are compiled again.
+
+With the ``CUSTOMTAGS_TIMING`` setting, timing is enabled when django starts,
+sampling ``CUSTOMTAGS_TIMING_SAMPLE_RATE`` (1.0) of the calls.  Otherwise
+none of the methods are wrapped, and timing costs nothing.
+
+``get_timings`` returns a snapshot of the histograms, and ``write_timings``
+writes it to a file, which the ``customtags_timings`` command reports on,
+merging the snapshots of several processes.
+"""
+import itertools
+import json
+import math
+from functools import wraps
+from timeit import default_timer
+
+from django.conf import settings
+
+from customtags._compat import allocate_lock
+from customtags.core import Tag
+
+#: the upper bound of the first bucket, in seconds
+MIN_DURATION = 1e-6
+
+BUCKETS_PER_DOUBLING = 4
+
+#: a microsecond to about 67 seconds, and a last bucket for longer calls
+BUCKET_COUNT = 26 * BUCKETS_PER_DOUBLING + 1
+
+PERCENTILES = (50, 95, 99)
+
+_histograms = {}
+_histograms_lock = allocate_lock()
+_originals = {}
+_enabled_sample_rate = None
+
+
+def get_sample_rate():
+    return getattr(settings, 'CUSTOMTAGS_TIMING_SAMPLE_RATE', 1.0)
+
+
+def get_bucket(duration):
+    if duration <= MIN_DURATION:
+        return 0
+    index = int(math.ceil(math.log(duration / MIN_DURATION, 2) * BUCKETS_PER_DOUBLING))
+    return min(index, BUCKET_COUNT - 1)
+
+
+def get_upper_bound(bucket):
+    return MIN_DURATION * 2 ** (float(bucket) / BUCKETS_PER_DOUBLING)
+
+
+class Histogram(object):
+    """
+    The count, total, maximum and bucketed durations of the timed calls of
+    a tag.
+    """
+    def __init__(self, tag, name, phase):
+        self.tag = tag
+        self.name = name
+        self.phase = phase
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return "<Histogram(%s, %s): %s calls>" % (self.tag, self.phase, self.count)
+
+    def add(self, duration, count=1):
+        self.buckets[get_bucket(duration)] += count
+        self.count += count
+        self.total += duration * count
+        self.max = max(self.max, duration)
+
+    def merge(self, data):
+        """
+        Adds the durations of a histogram snapshot.
+        """
+        for bucket, count in data['buckets'].items():
+            self.buckets[int(bucket)] += count
+        self.count += data['count']
+        self.total += data['total']
+        self.max = max(self.max, data['max'])
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket holding the *percent*
+        percentile, or None if there are no durations.
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(self.count * percent / 100.0)), 1)
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(get_upper_bound(bucket), self.max)
+        return self.max
+
+    def as_dict(self):
+        data = {
+            'tag': self.tag,
+            'name': self.name,
+            'phase': self.phase,
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'buckets': dict((str(bucket), count)
+                            for bucket, count in enumerate(self.buckets) if count),
+        }
+        for percent in PERCENTILES:
+            data['p%d' % percent] = self.percentile(percent)
+        return data
+
+
+def get_tag_label(tag_class):
+    return '%s.%s' % (tag_class.__module__, tag_class.__name__)
+
+
+def record(phase, tag_class, duration):
+    key = (phase, tag_class)
+    _histograms_lock.acquire()
+    try:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(
+                get_tag_label(tag_class), tag_class.name, phase)
+        histogram.add(duration)
+    finally:
+        _histograms_lock.release()
+
+
+def get_timings():
+    """
+    Returns a snapshot of the histograms of every tag timed so far, the tags
+    that took the longest in total first.
+    """
+    _histograms_lock.acquire()
+    try:
+        result = [histogram.as_dict() for histogram in _histograms.values()]
+    finally:
+        _histograms_lock.release()
+    result.sort(key=lambda data: data['total'], reverse=True)
+    return result
+
+
+def reset_timings():
+    _histograms_lock.acquire()
+    try:
+        _histograms.clear()
+    finally:
+        _histograms_lock.release()
+
+
+def swap_timings(histograms):
+    """
+    Replaces the histograms with those of *histograms*, a dictionary returned
+    by an earlier call, and returns the histograms replaced.
+    """
+    _histograms_lock.acquire()
+    try:
+        replaced = dict(_histograms)
+        _histograms.clear()
+        _histograms.update(histograms)
+    finally:
+        _histograms_lock.release()
+    return replaced
+
+
+def write_timings(path):
+    """
+    Writes a snapshot of the histograms to the file at *path*, as JSON.
+    """
+    with open(path, 'w') as snapshot:
+        json.dump(get_timings(), snapshot)
+
+
+def merge_timings(snapshots):
+    """
+    Returns the histograms of a list of snapshots, merged per tag and phase,
+    the tags that took the longest in total first.
+    """
+    histograms = {}
+    for snapshot in snapshots:
+        for data in snapshot:
+            key = (data['phase'], data['tag'])
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(data['tag'], data['name'], data['phase'])
+            histogram.merge(data)
+    result = [histogram.as_dict() for histogram in histograms.values()]
+    result.sort(key=lambda data: data['total'], reverse=True)
+    return result
+
+
+def falls_back(tag, hook):
+    """
+    Whether *tag* renders through ``render`` instead of its method *hook*.
+    """
+    return getattr(tag, hook) is None or tag.render_cache is not None
+
+
+def timed(phase, method, every, hook=None):
+    """
+    Wraps the method *method* of tags in a function timing one in *every*
+    call, but for the calls of tags without the method *hook*, if given.
+    """
+    counter = itertools.count()
+
+    @wraps(method)
+    def wrapper(self, *args):
+        if hook is not None and falls_back(self, hook):
+            return method(self, *args)
+        if next(counter) % every:
+            return method(self, *args)
+        start = default_timer()
+        try:
+            return method(self, *args)
+        finally:
+            record(phase, type(self), default_timer() - start)
+    return wrapper
+
+
+def time_chunks(phase, tag_class, chunks):
+    """
+    Yields the *chunks*, and records the time spent producing them once they
+    are exhausted or closed.
+    """
+    duration = 0.0
+    try:
+        while True:
+            start = default_timer()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                duration += default_timer() - start
+            yield chunk
+    finally:
+        record(phase, tag_class, duration)
+
+
+def timed_stream(phase, method, every, hook):
+    """
+    Wraps the generator method *method* of tags in one timing the chunks of
+    one in *every* call, but for the calls of tags without the method *hook*.
+    """
+    counter = itertools.count()
+
+    @wraps(method)
+    def wrapper(self, *args):
+        if falls_back(self, hook) or next(counter) % every:
+            return method(self, *args)
+        return time_chunks(phase, type(self), method(self, *args))
+    return wrapper
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def get_enabled_sample_rate():
+    """
+    Returns the sample rate timing was enabled with, or None if it's disabled.
+    """
+    return _enabled_sample_rate
+
+
+def enable(sample_rate=None):
+    """
+    Times one in every ``1 / sample_rate`` parse and render of tags, rendered
+    whole, into an output or in chunks.
+    """
+    if sample_rate is None:
+        sample_rate = get_sample_rate()
+    if not 0 < sample_rate <= 1:
+        raise ValueError("The timing sample rate must be more than 0 and at "
+                         "most 1, not %r." % sample_rate)
+    global _enabled_sample_rate
+    every = int(round(1.0 / sample_rate))
+    disable()
+    _enabled_sample_rate = sample_rate
+    for name in ('parse', 'render'):
+        method = _originals[name] = Tag.__dict__[name]
+        setattr(Tag, name, timed(name, method, every))
+    method = _originals['render_into'] = Tag.__dict__['render_into']
+    Tag.render_into = timed('render', method, every, 'write_tag')
+    method = _originals['render_stream'] = Tag.__dict__['render_stream']
+    Tag.render_stream = timed_stream('render', method, every, 'stream_tag')
+
+
+def disable():
+    """
+    Puts back the methods of ``Tag`` that were timed.
+    """
+    global _enabled_sample_rate
+    _enabled_sample_rate = None
+    for name, method in _originals.items():
+        setattr(Tag, name, method)
+    _originals.clear()
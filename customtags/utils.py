@@ -1,5 +1,12 @@
+import os
 import re
+import pkgutil
+import tempfile
+
+from importlib import import_module
 from django import template
+from django.template.base import builtins, get_templatetags_modules, import_library, \
+     InvalidTemplateLibrary
 
 class NULL:
     """
@@ -41,6 +48,11 @@ class FakeParser(object):
 
 
 class Container(object):
+    """
+    Collects the values of a tag while it is being parsed.
+    """
+    __slots__ = ('tag_args', 'tag_kwargs', 'tag_nodelists')
+
     def __init__(self, tag_args=None, tag_kwargs=None, tag_nodelists=None):
         self.tag_args = [] if not tag_args else tag_args
         self.tag_kwargs = {} if not tag_kwargs else tag_kwargs
@@ -48,6 +60,75 @@ class Container(object):
 
     def __repr__(self):
         return "Container(tag_args=%s, tag_kwargs=%s, tag_nodelists=%s)" % (self.tag_args, self.tag_kwargs, self.tag_nodelists)
+
+    def freeze(self):
+        """
+        Returns a BindingPlan of the values parsed into this container.
+        """
+        return BindingPlan(self.tag_args, self.tag_kwargs, self.tag_nodelists)
+
+    def bind(self, context):
+        return self.freeze().bind(context)
+
+
+def is_static(value):
+    is_static = getattr(value, 'is_static', None)
+    return is_static is not None and is_static()
+
+
+class BindingPlan(object):
+    """
+    The frozen container of a parsed tag.  Its arguments are split into
+    constant slots, which are resolved once when the plan is made, and
+    dynamic slots, which are resolved on every render.  Only the resolved
+    constants and the values of the dynamic slots are kept.
+    """
+    __slots__ = ('tag_nodelists', 'args', 'dynamic_args', 'kwargs', 'dynamic_kwargs')
+
+    def __init__(self, tag_args, tag_kwargs, tag_nodelists=()):
+        self.tag_nodelists = tuple(tag_nodelists)
+
+        args = []
+        dynamic_args = []
+        for index, value in enumerate(tag_args):
+            if is_static(value):
+                args.append(value.resolve(None))
+            else:
+                args.append(None)
+                dynamic_args.append((index, value))
+
+        kwargs = {}
+        dynamic_kwargs = []
+        for key, value in tag_kwargs.iteritems():
+            if is_static(value):
+                kwargs[key] = value.resolve(None)
+            else:
+                dynamic_kwargs.append((key, value))
+
+        self.args = tuple(args)
+        self.dynamic_args = tuple(dynamic_args)
+        self.kwargs = kwargs
+        self.dynamic_kwargs = tuple(dynamic_kwargs)
+
+    def __repr__(self):
+        return "BindingPlan(args=%s, kwargs=%s, dynamic=%s)" % (
+            self.args, self.kwargs, len(self.dynamic_args) + len(self.dynamic_kwargs))
+
+    def freeze(self):
+        return self
+
+    def bind(self, context):
+        """
+        Returns the args and kwargs for ``render_tag``.  The constant slots are
+        copied, since the same node may be rendering more than once at a time.
+        """
+        args = list(self.args)
+        for index, value in self.dynamic_args:
+            args[index] = value.resolve(context)
+        kwargs = self.kwargs.copy()
+        for key, value in self.dynamic_kwargs:
+            kwargs[key] = value.resolve(context)
+        return args, kwargs
  
 
 def process_decorator_args_kwargs(options_class, *args, **kwargs):
@@ -147,6 +228,11 @@ def process_decorator_args_kwargs(options_class, *args, **kwargs):
             has_options = True
             options = new_options
 
+    if "pure" in kwargs:
+        pure = bool(kwargs.pop("pure"))
+    else:
+        pure = None
+
     if len(kwargs) > 0:
         raise TypeError("Unknown keyword '%s' passed to the decorator." % kwargs.keys()[0])
 
@@ -159,5 +245,77 @@ def process_decorator_args_kwargs(options_class, *args, **kwargs):
         result['function'] = function
     if has_options:
         result['options'] = options
+    if pure is not None:
+        result['pure'] = pure
 
     return result
+
+
+def iter_loaders(loaders):
+    """
+    Yields *loaders*, and the loaders wrapped by each of them, depth first.
+    """
+    for loader in loaders:
+        yield loader
+        for inner in iter_loaders(getattr(loader, 'loaders', ())):
+            yield inner
+
+
+def write_atomic(path, data):
+    """
+    Writes *data* to a temporary file next to *path*, and renames it into
+    place, so that other processes never read a partial file.  Returns False
+    if the file couldn't be written.
+    """
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    except (IOError, OSError):
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def iter_libraries():
+    """
+    Yields a (name, Library) pair for each of django's builtin libraries, and
+    for every tag library found in the templatetags package of an installed app.
+    """
+    for library in builtins:
+        yield None, library
+
+    for package_name in get_templatetags_modules():
+        package = import_module(package_name)
+        for loader, name, is_pkg in pkgutil.iter_modules(package.__path__):
+            try:
+                library = import_library('%s.%s' % (package_name, name))
+            except InvalidTemplateLibrary:
+                continue
+            if library is not None:
+                yield name, library
+
+
+def iter_tag_classes():
+    """
+    Yields a (library name, tag name, Tag subclass) triple for every registered
+    tag that was created with ``Tag.as_tag()``.
+    """
+    seen = set()
+    for libname, library in iter_libraries():
+        for tagname, function in sorted(library.tags.items()):
+            tag_class = getattr(function, 'tag_class', None)
+            if tag_class is None or (tagname, tag_class) in seen:
+                continue
+            seen.add((tagname, tag_class))
+            yield libname, tagname, tag_class
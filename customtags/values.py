@@ -5,6 +5,7 @@ from django.template import VariableDoesNotExist
 from django.conf import settings
 
 from customtags.exceptions import TemplateSyntaxWarning
+from customtags.nodes import Const
 
 
 class StaticValue(object):
@@ -12,6 +13,8 @@ class StaticValue(object):
     A 'constant' internal template variable which basically allows 'resolving'
     returning it's initial value
     """
+    __slots__ = ('value',)
+
     def __init__(self, value):
         if isinstance(value, basestring):
             self.value = value.strip('"\'')
@@ -21,6 +24,9 @@ class StaticValue(object):
     def __repr__(self): # pragma: no cover
         return '<StaticValue: %s>' % repr(self.value)
 
+    def is_static(self):
+        return True
+
     def resolve(self, context):
         try:
             return self.value
@@ -29,22 +35,59 @@ class StaticValue(object):
 
 
 class NullValue(object):
+    __slots__ = ()
+
     def __repr__(self):
         return 'NullValue()'
 
+    def is_static(self):
+        return True
+
     def resolve(self, context):
         return None
 
 
-class StringValue(object):
+class BaseValue(object):
+    """
+    Cleaning and error reporting shared by the values that resolve template
+    variables.  It holds no state, so that the list and dict values can
+    derive from it as well as from their builtin types.
+    """
+    __slots__ = ()
     errors = {}
     value_on_error = ""
+
+    def is_static(self):
+        return False
+
+    def clean(self, value):
+        return value
+
+    def error(self, value, category):
+        message = self.errors.get(category, "") % {'value': repr(value)}
+        if settings.DEBUG:
+            raise template.TemplateSyntaxError(message)
+        else:
+            warnings.warn(message, TemplateSyntaxWarning)
+            return self.value_on_error
+
+
+class StringValue(BaseValue):
+    __slots__ = ('var',)
     
     def __init__(self, var):
         self.var = var
 
     def __repr__(self):
         return "<%s(%s)>" % (self.__class__.__name__, self.var.__repr__())
+
+    def is_static(self):
+        """
+        True when resolving never depends on the context, so that the value may
+        be resolved once.  Values that may report errors on cleaning are left
+        to be resolved, and warn, on every render.
+        """
+        return not self.errors and isinstance(self.var, (StaticValue, Const))
         
     def resolve(self, context):
         try:
@@ -63,17 +106,10 @@ class StringValue(object):
         if value == "" and not isinstance(self.var, StaticValue):
             return None
         return value
-    
-    def error(self, value, category):
-        message = self.errors.get(category, "") % {'value': repr(value)}
-        if settings.DEBUG:
-            raise template.TemplateSyntaxError(message)
-        else:
-            warnings.warn(message, TemplateSyntaxWarning)
-            return self.value_on_error
 
 
 class IntegerValue(StringValue):
+    __slots__ = ()
     errors = {
         "clean": "%(value)s could not be converted to Integer",
     }
@@ -87,10 +123,13 @@ class IntegerValue(StringValue):
             return self.error(value, "clean")
 
 
-class ListValue(list, StringValue):
+class ListValue(list, BaseValue):
     """
-    A list of template variables for easy resolving
+    A list of template variables for easy resolving.  Its resolved list is a
+    new object on every render, so it is never static.
     """
+    __slots__ = ()
+
     def __init__(self, value=None):
         list.__init__(self)
         if value is not None:
@@ -104,10 +143,12 @@ class ListValue(list, StringValue):
             return None
 
 
-class DictValue(dict, StringValue):
+class DictValue(dict, BaseValue):
     """
     A dict of template variables for easy resolving
     """
+    __slots__ = ()
+
     def __init__(self, key=None, value=None):
         dict.__init__(self)
         if key is not None and value is not None:
@@ -0,0 +1,168 @@
+"""
+Compiles every template of a project ahead of its first request.
+
+Templates found by the filesystem and app directories loaders of the default
+engine are compiled in a pool of worker processes, one template at a time, and
+each worker sends back a ``TemplateReport`` with the time spent compiling the
+template, the error it raised if any, and the template pickled with
+``customtags.serialization``.  ``warm_up`` then primes the cached loaders of
+the calling process with every template that compiled, so that a server
+calling it at startup doesn't compile on its first requests; the
+``customtags_warmup`` management command only reports, or writes the
+templates into an image for ``customtags.store``.
+
+Templates that can't be pickled are compiled again by the calling process
+when it is primed.
+
+Only cached loaders are primed.  An engine without one, such as one with
+``APP_DIRS: True`` and no ``loaders`` in django 1.8, has its loaders wrapped
+in a cached loader by ``prime``, which then keeps every template it loads
+until the process exits, as the cached loader does: edits to the templates
+are not seen until the server restarts.  Errors compiling or pickling a
+template are reported by its ``TemplateReport``, and don't stop the others.
+"""
+import os
+import multiprocessing
+from collections import namedtuple
+from timeit import default_timer
+
+from django.db import connections
+from django.template import Engine
+from django.template.loaders import app_directories, cached, filesystem
+from django.template.utils import get_app_template_dirs
+
+from customtags import serialization
+from customtags.loaders import find_source, get_cache_key
+from customtags.utils import iter_loaders
+
+
+TemplateReport = namedtuple('TemplateReport', ['name', 'elapsed', 'error', 'data', 'key'])
+
+
+def get_template_dirs(engine):
+    """
+    Returns the directories searched by the filesystem and app directories
+    loaders of *engine*, in the order they are searched.
+    """
+    dirs = []
+    for loader in iter_loaders(engine.template_loaders):
+        if isinstance(loader, filesystem.Loader):
+            candidates = engine.dirs
+        elif isinstance(loader, app_directories.Loader):
+            candidates = get_app_template_dirs('templates')
+        else:
+            continue
+        for directory in candidates:
+            if directory not in dirs:
+                dirs.append(directory)
+    return dirs
+
+
+def find_templates(engine=None):
+    """
+    Returns the sorted names of the templates in the template directories of
+    *engine*, the default engine if None.
+    """
+    if engine is None:
+        engine = Engine.get_default()
+    names = set()
+    for directory in get_template_dirs(engine):
+        for root, subdirs, files in os.walk(directory):
+            subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+            for filename in files:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.relpath(os.path.join(root, filename), directory)
+                names.add(path.replace(os.sep, '/'))
+    return sorted(names)
+
+
+def compile_template(name):
+    """
+    Compiles the template *name* with the default engine, and returns its
+    ``TemplateReport``.
+    """
+    engine = Engine.get_default()
+    start = default_timer()
+    try:
+        template = engine.get_template(name)
+    except Exception, e:
+        return TemplateReport(name, default_timer() - start, describe_error(e), None, None)
+    elapsed = default_timer() - start
+    try:
+        data = serialization.dumps(template)
+    except (serialization.pickle.PicklingError, TypeError):
+        return TemplateReport(name, elapsed, None, None, None)
+    except Exception, e:
+        # a RuntimeError recursing through a deeply nested template, say
+        return TemplateReport(name, elapsed, 'Could not pickle: %s' % describe_error(e),
+                              None, None)
+    try:
+        loader, source, display_name = find_source(
+            iter_loaders(engine.template_loaders), name)
+    except Exception, e:
+        return TemplateReport(name, elapsed, describe_error(e), None, None)
+    return TemplateReport(name, elapsed, None, data,
+                          get_cache_key(engine, name, source))
+
+
+def describe_error(error):
+    return '%s: %s' % (error.__class__.__name__, error)
+
+
+def get_cached_loaders(engine):
+    """
+    Returns the cached loaders of *engine*, wrapping its loaders in one if it
+    has none.
+    """
+    loaders = [loader for loader in iter_loaders(engine.template_loaders)
+               if isinstance(loader, cached.Loader)]
+    if not loaders:
+        loader = cached.Loader(engine, engine.loaders)
+        engine.template_loaders = [loader]
+        loaders = [loader]
+    return loaders
+
+
+def prime(reports, engine=None):
+    """
+    Loads the templates of the *reports* without errors into the cached
+    loaders of *engine*, wrapping its loaders in one if it has none, and
+    returns the number of cached loaders primed.
+    """
+    if engine is None:
+        engine = Engine.get_default()
+    loaders = get_cached_loaders(engine)
+    for report in reports:
+        if report.error is not None:
+            continue
+        if report.data is None:
+            for loader in loaders:
+                loader.load_template(report.name)
+            continue
+        template = serialization.loads(report.data, engine)
+        for loader in loaders:
+            loader.template_cache[loader.cache_key(report.name, None)] = (template, None)
+    return len(loaders)
+
+
+def warm_up(names=None, processes=None, priming=True):
+    """
+    Compiles the templates *names*, all the templates of the default engine if
+    None, in *processes* worker processes, one per core if None.  Returns the
+    list of ``TemplateReport``, and primes the cached loaders of this process
+    with the templates that compiled unless *priming* is False.
+    """
+    if names is None:
+        names = find_templates()
+    # the workers inherit the connections of this process; they don't need them
+    connections.close_all()
+    pool = multiprocessing.Pool(processes)
+    try:
+        reports = pool.map(compile_template, names, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if priming:
+        prime(reports)
+    return reports
@@ -15,3 +15,5 @@ INSTALLED_APPS = ['customtags_tests']
 TEMPLATE_DIRS = [os.path.join(os.path.dirname(__file__), 'templates')]
 
 DEBUG = False
+
+SECRET_KEY = 'performance'
@@ -0,0 +1,254 @@
+"""
+Reports the memory held by the tag nodes of a large generated template, in
+the frozen layout used after parsing versus the dict-backed layout in which
+each node kept its parse-time Container.
+
+tracemalloc is not available on Python 2, so the sizes are the sum of
+sys.getsizeof over every object reachable from the template's nodes, each
+counted once; modules, classes and functions shared with the rest of the
+process are not counted.
+
+With ``--workers``, reports the memory of forked workers that render a set
+of generated templates: compiled by each worker, compiled by the master
+before forking, or loaded from a template store.  The sizes are read from
+/proc/self/smaps, so this only runs on Linux.
+"""
+from _settings_patcher import *
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import types
+import multiprocessing
+
+import django
+django.setup()
+
+from django import template
+
+from customtags.core import Tag
+from customtags.utils import Container
+
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType,
+                types.BuiltinFunctionType, types.ClassType)
+
+SOURCE = ('{% ct_with "x" as x %}{{ x }}{% endwith %}'
+          '{% ct_with input|upper as y %}{{ y }}{% endwith %}'
+          '{% ct_now "jS o F" %}'
+          '{% ct_cycle "a" "b" as c %}')
+
+
+class DictContainer(object):
+    """
+    The per-node layout before containers were frozen: the parse-time lists
+    and dict, alongside the binding plan made from them.
+    """
+    def __init__(self, container):
+        self.tag_args = list(container.tag_args)
+        self.tag_kwargs = dict(container.tag_kwargs)
+        self.tag_nodelists = list(container.tag_nodelists)
+
+
+def build_template(repeat):
+    source = '{% load ct_with ct_now ct_cycle %}' + SOURCE * repeat
+    return template.Template(source)
+
+
+def iter_tags(nodelist):
+    for node in nodelist:
+        if isinstance(node, Tag):
+            yield node
+        for attr in getattr(node, 'child_nodelists', ()):
+            for child in iter_tags(getattr(node, attr, None) or ()):
+                yield child
+        if isinstance(node, Tag):
+            for child_nodelist in node.container.tag_nodelists:
+                for child in iter_tags(child_nodelist):
+                    yield child
+
+
+def build_thawed_template(repeat):
+    """
+    Builds the template of ``build_template`` with its tag nodes in the
+    dict-backed layout.
+    """
+    parse = Tag.__dict__['parse']
+
+    def thawed_parse(self, parser, tokens):
+        container = Container()
+        self.options.parse(parser, tokens, container)
+        self.container = DictContainer(container)
+        self.binding = container.freeze()
+        self.__dict__['tagname'] = self.name
+
+    Tag.parse = thawed_parse
+    try:
+        return build_template(repeat)
+    finally:
+        Tag.parse = parse
+
+
+def deep_size(root):
+    seen = set()
+    size = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__') and not isinstance(obj, SHARED_TYPES):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return size
+
+
+def run(prnt, repeat):
+    frozen = build_template(repeat)
+    nodes = len(list(iter_tags(frozen.nodelist)))
+    frozen_size = deep_size(frozen.nodelist)
+
+    thawed = build_thawed_template(repeat)
+    thawed_size = deep_size(thawed.nodelist)
+
+    table = [
+        ("dict-backed", thawed_size, float(thawed_size) / nodes),
+        ("frozen", frozen_size, float(frozen_size) / nodes),
+    ]
+    if prnt:
+        print
+        print "Memory held by %s tag nodes." % nodes
+        print
+        print "%-12s %12s %16s" % ("Layout", "Bytes", "Bytes per tag")
+        for name, size, per_node in table:
+            print "%-12s %12d %16.1f" % (name, size, per_node)
+    else:
+        return table
+
+
+def read_smaps():
+    """
+    Returns the resident, proportional and private memory of this process,
+    in kB.
+    """
+    sizes = {'Rss': 0, 'Pss': 0, 'Private_Clean': 0, 'Private_Dirty': 0}
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            field, _, value = line.partition(':')
+            if field in sizes:
+                sizes[field] += int(value.split()[0])
+    return sizes['Rss'], sizes['Pss'], sizes['Private_Clean'] + sizes['Private_Dirty']
+
+
+def build_engine(template_dir):
+    from django.template import Engine
+    return Engine(dirs=[template_dir], loaders=[
+        ('customtags.loaders.Loader', ['django.template.loaders.filesystem.Loader']),
+    ])
+
+
+def render_all(engine, names, queue):
+    for name in names:
+        engine.get_template(name).render(template.Context({'input': 'x'}))
+    queue.put(read_smaps())
+
+
+def build_store(template_dir, names, path):
+    from customtags import serialization, store
+    from customtags.loaders import get_cache_key
+    engine = build_engine(template_dir)
+    entries = []
+    for name in names:
+        with open(os.path.join(template_dir, name)) as f:
+            source = f.read().decode('utf-8')
+        data = serialization.dumps(engine.get_template(name))
+        entries.append((get_cache_key(engine, name, source), data))
+    store.build(path, entries)
+
+
+def run_workers(prnt, workers, templates, repeat):
+    from django.test.utils import override_settings
+    from customtags import store
+
+    template_dir = tempfile.mkdtemp()
+    names = []
+    for index in range(templates):
+        name = 'template_%d.html' % index
+        with open(os.path.join(template_dir, name), 'w') as f:
+            f.write('{% load ct_with ct_now ct_cycle %}' + SOURCE * repeat)
+        names.append(name)
+    store_path = os.path.join(template_dir, 'templates.img')
+
+    table = []
+    try:
+        for setup in ('idle', 'compiled per worker', 'compiled before fork',
+                      'template store'):
+            engine = build_engine(template_dir)
+            store_setting = None
+            rendered = names
+            if setup == 'idle':
+                rendered = []
+            elif setup == 'compiled before fork':
+                for name in names:
+                    engine.get_template(name)
+            elif setup == 'template store':
+                # built by another process, like customtags_warmup --store
+                builder = multiprocessing.Process(target=build_store,
+                                                  args=(template_dir, names, store_path))
+                builder.start()
+                builder.join()
+                store_setting = store_path
+            gc.collect()
+
+            with override_settings(CUSTOMTAGS_TEMPLATE_STORE=store_setting):
+                # mapped before forking, so that the workers share the mapping
+                store.get_store()
+                queue = multiprocessing.Queue()
+                processes = [multiprocessing.Process(target=render_all,
+                                                     args=(engine, rendered, queue))
+                             for i in range(workers)]
+                for process in processes:
+                    process.start()
+                results = [queue.get() for process in processes]
+                for process in processes:
+                    process.join()
+            table.append((setup,) + tuple(
+                sum(result[i] for result in results) / float(workers) for i in range(3)))
+    finally:
+        shutil.rmtree(template_dir)
+
+    if prnt:
+        print
+        print "Memory per worker of %d workers rendering %d templates of %d tags." % (
+            workers, templates, repeat * 4)
+        print
+        print "%-22s %10s %10s %14s" % ("Setup", "RSS (kB)", "PSS (kB)", "Private (kB)")
+        for setup, rss, pss, private in table:
+            print "%-22s %10d %10d %14d" % (setup, rss, pss, private)
+    else:
+        return table
+
+
+def do_memory(repeat=2500):
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('--repeat', type='int', default=repeat,
+                      help="How often the tags of the template are repeated.")
+    parser.add_option('--workers', type='int', default=None,
+                      help="Compare the memory of this many forked workers.")
+    parser.add_option('--templates', type='int', default=20,
+                      help="Number of templates rendered by each worker.")
+    options, args = parser.parse_args()
+    if options.workers:
+        run_workers(True, options.workers, options.templates, options.repeat)
+    else:
+        run(True, options.repeat)
@@ -1,11 +1,18 @@
 """
 Tests the performance of django builtin tags versus customtags implementations
-of them.
+of them, with and without compiling the templates to render functions, the
+time spent structuring the grammars of tags at startup, compiling
+templates with lazy block bodies, and rendering deeply nested blocks into a
+single list.
 """
 from _settings_patcher import *
-from utils import pool, Benchmark
+from utils import pool, Benchmark, GrammarBenchmark, StartupBenchmark, \
+     CompileBenchmark, NestingBenchmark
 import sys
 
+import django
+django.setup()
+
 def format_num(num):
     try:
         return "%0.3f" % num
@@ -30,21 +37,111 @@ def pprint_table(out, table):
             print >> out, col,
         print >> out
 
-def run(prnt, iterations):
+def run(prnt, iterations, tagnames=None, compiled=False):
     print
     print "Performance of django tags versus customtags. %s iterations." % iterations
     print
     pool.autodiscover()
     table = []
-    table.append(["Tagname", "Django", "Classytags", "Ratio"])
+    header = ["Tagname", "Django", "Classytags", "Ratio"]
+    if compiled:
+        header.extend(["Compiled", "Compiled ratio"])
+    table.append(header)
     for tagname, data in pool:
+        if tagnames and tagname not in tagnames:
+            continue
         bench = Benchmark(data['tag']) 
         django = bench.django(iterations)
         classy = bench.classy(iterations)
         ratio = classy / django
         if tagname.startswith('ct_'):
             tagname = tagname[3:]
-        table.append([tagname, django, classy, ratio])
+        row = [tagname, django, classy, ratio]
+        if compiled:
+            compiled_time = bench.compiled(iterations)
+            row.extend([compiled_time, compiled_time / django])
+        table.append(row)
+    if prnt:
+        pprint_table(sys.stdout, table)
+    else:
+        return table
+
+GRAMMAR_SIZES = (10, 50, 100, 200, 1000)
+
+def run_grammars(prnt, iterations):
+    print
+    print "Time to initialize tag options and to subclass a tag, by number of arguments. " \
+          "%s iterations." % iterations
+    print
+    table = []
+    table.append(["Arguments", "Total", "Per argument (ms)", "Subclass (ms)"])
+    for size in GRAMMAR_SIZES:
+        bench = GrammarBenchmark(size)
+        total = bench.structure(iterations)
+        subclass = bench.subclass(iterations)
+        table.append([str(size), total, total * 1000 / (size * iterations),
+                      subclass * 1000 / iterations])
+    if prnt:
+        pprint_table(sys.stdout, table)
+    else:
+        return table
+
+STARTUP_SIZES = (100, 300, 1000)
+
+def run_startup(prnt):
+    print
+    print "Time to import a templatetag library, with and without lazy options."
+    print
+    table = []
+    table.append(["Tags", "Eager (ms)", "Lazy (ms)", "Ratio"])
+    for size in STARTUP_SIZES:
+        bench = StartupBenchmark(size)
+        eager = bench.import_library(False) * 1000
+        lazy = bench.import_library(True) * 1000
+        table.append([str(size), eager, lazy, lazy / eager])
+    if prnt:
+        pprint_table(sys.stdout, table)
+    else:
+        return table
+
+COMPILE_SIZES = (10, 100, 1000)
+
+def run_compile(prnt):
+    print
+    print "Time to compile a template of loops with large {% empty %} bodies,"
+    print "and to render it once without them, with and without lazy bodies."
+    print
+    table = []
+    table.append(["Loops", "Eager (ms)", "Lazy (ms)", "Ratio",
+                  "Eager render (ms)", "Lazy render (ms)"])
+    for size in COMPILE_SIZES:
+        bench = CompileBenchmark(size)
+        eager, eager_render = bench.compile_template(False)
+        lazy, lazy_render = bench.compile_template(True)
+        table.append([str(size), eager * 1000, lazy * 1000, lazy / eager,
+                      eager_render * 1000, lazy_render * 1000])
+    if prnt:
+        pprint_table(sys.stdout, table)
+    else:
+        return table
+
+NESTING_DEPTHS = (2, 4, 6, 8)
+
+def run_nesting(prnt, iterations):
+    print
+    print "Time to render nested ct_with/ct_for blocks returning their output,"
+    print "and writing it into a single list with render_into."
+    print
+    table = []
+    table.append(["Depth", "Output (KB)", "render (ms)", "render_into (ms)",
+                  "Ratio"])
+    for depth in NESTING_DEPTHS:
+        bench = NestingBenchmark(depth)
+        size = len(bench.template.render(bench.get_context())) / 1024.0
+        render = bench.render(iterations)
+        render_into = bench.render_into(iterations)
+        table.append([str(depth), size, render * 1000, render_into * 1000,
+                      render_into / render])
     if prnt:
         pprint_table(sys.stdout, table)
     else:
@@ -53,8 +150,29 @@ def run(prnt, iterations):
 def do_performance(iterations=10000):
     import optparse
     parser = optparse.OptionParser()
+    parser.add_option('--grammars', action='store_true', default=False,
+                      help="Benchmark the structuring of large tag grammars.")
+    parser.add_option('--startup', action='store_true', default=False,
+                      help="Benchmark importing a library of hundreds of tags.")
+    parser.add_option('--compile', action='store_true', default=False,
+                      help="Benchmark compiling templates with lazy bodies.")
+    parser.add_option('--nesting', action='store_true', default=False,
+                      help="Benchmark rendering nested blocks with render_into.")
+    parser.add_option('--codegen', action='store_true', default=False,
+                      help="Also time the templates compiled to render functions.")
+    parser.add_option('--tag', action='append', dest='tagnames', default=[],
+                      help="Only run the suite of this tag, e.g. ct_with.")
     options, args = parser.parse_args()
-    run(True, iterations)
+    if options.grammars:
+        run_grammars(True, max(iterations / 100, 1))
+    elif options.startup:
+        run_startup(True)
+    elif options.compile:
+        run_compile(True)
+    elif options.nesting:
+        run_nesting(True, max(iterations / 100, 1))
+    else:
+        run(True, iterations, options.tagnames, options.codegen)
 
 if __name__ == '__main__':
     iterations = 10000
@@ -1,4 +1,5 @@
-from customtags import core, arguments, values
+from customtags import core, arguments, values, rendering, introspection, utils, \
+     batching, prefetch as prefetching
 from django import template
 from customtags_tests.utils import pool
 import re
@@ -14,19 +15,118 @@ register = template.Library()
 
 
 class CommaSeperatableSequence(values.ListValue):        
+    def is_static(self):
+        """
+        The names of the loop variables are never looked up, so they are
+        split once, when the tag is parsed.
+        """
+        return all(utils.is_static(item) for item in self)
+
     def resolve(self, context):
         resolved = []
         base = super(CommaSeperatableSequence, self).resolve(context)
         for thing in re.sub(r' *, *', ',', ', '.join(base)).split(','):
             if thing:
                 resolved.append(thing)
-        return resolved
+        return tuple(resolved)
 
 
 class CommaSeperatableMultiValueArgument(arguments.MultiValueArgument):
     sequence_class = CommaSeperatableSequence
 
 
+def lookahead(iterable):
+    """
+    Yields the items of *iterable* with whether each is the last one,
+    reading one item ahead.
+    """
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    for next_item in iterator:
+        yield item, False
+        item = next_item
+    yield item, True
+
+
+def compile_unpacking(loopvars):
+    """
+    Returns a function setting the loop variables *loopvars* to the values
+    of an item in a context frame.  The variables an item has no value for
+    are removed from the frame, so that none is left over from the previous
+    item.
+    """
+    if len(loopvars) == 1:
+        name = loopvars[0]
+        def unpack(frame, item):
+            frame[name] = item
+        return unpack
+
+    def unpack(frame, item):
+        pairs = zip(loopvars, item)
+        frame.update(pairs)
+        for name in loopvars[len(pairs):]:
+            frame.pop(name, None)
+    return unpack
+
+
+def is_length_path(path):
+    """
+    Whether the dotted *path* looks up a reverse counter of a loop, or a
+    whole loop.
+    """
+    bits = path.split('.')
+    if bits[0] != 'forloop':
+        return False
+    bits = [bit for bit in bits[1:] if bit != 'parentloop']
+    return not bits or bits[0] in ('revcounter', 'revcounter0')
+
+
+class ForLoop(dict):
+    """
+    The ``forloop`` of a ``ct_for`` loop: a dict computing the counters of
+    the current iteration when they are looked up, rather than storing them
+    for every item.  ``parentloop``, and the keys other tags store in it,
+    such as those of ``{% ifchanged %}``, are kept as usual.
+    """
+    def __init__(self, parentloop, length=None):
+        super(ForLoop, self).__init__(parentloop=parentloop)
+        self.length = length
+        self.index = 0
+        self.is_last = False
+
+    def __missing__(self, key):
+        if key == 'counter':
+            return self.index + 1
+        if key == 'counter0':
+            return self.index
+        if key == 'first':
+            return self.index == 0
+        if key == 'last':
+            return self.is_last
+        if self.length is not None:
+            if key == 'revcounter':
+                return self.length - self.index
+            if key == 'revcounter0':
+                return self.length - self.index - 1
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
 class For(core.Tag):
     name = 'ct_for'
     
@@ -34,57 +134,200 @@ class For(core.Tag):
         CommaSeperatableMultiValueArgument('loopvars', resolve=False),
         'in',
         arguments.Argument('values'),
+        arguments.Flag('prefetch', true_values=['prefetch'], default=False),
         blocks=[('empty', 'pre_empty'), ('endfor', 'post_empty')],
     )
 
     def __init__(self, *args, **kwargs):
         return super(For, self).__init__(*args, **kwargs)
     
-    def render_tag(self, context, loopvars, values, pre_empty, post_empty):
+    def needs_length(self, nodelist):
+        """
+        Whether the body refers to ``revcounter``, ``revcounter0`` or the
+        whole ``forloop``, which need the length of the sequence.
+        """
+        needs = getattr(self, '_needs_length', None)
+        if needs is None:
+            needs = self._needs_length = any(
+                is_length_path(path) for path in introspection.get_dependencies(nodelist))
+        return needs
+
+    def get_unpacking(self, loopvars):
+        """
+        The unpacking function of the loop variables, compiled the first time
+        the tag is rendered: the variables are constant, split when the tag
+        is parsed.
+        """
+        compiled = getattr(self, '_unpacking', None)
+        if compiled is None or compiled[0] is not loopvars:
+            compiled = self._unpacking = (loopvars, compile_unpacking(loopvars))
+        return compiled[1]
+
+    def get_prefetch_paths(self, loopvars, nodelist):
+        """
+        The paths the body looks up on the loop variable, found the first
+        time the tag is rendered.
+        """
+        paths = getattr(self, '_prefetch_paths', None)
+        if paths is None:
+            if len(loopvars) == 1:
+                paths = prefetching.get_paths(nodelist, loopvars[0])
+            else:
+                paths = []
+            self._prefetch_paths = paths
+        return paths
+
+    def get_function_paths(self, nodelist):
+        """
+        The functions the body calls, found the first time the tag is
+        rendered.
+        """
+        paths = getattr(self, '_function_paths', None)
+        if paths is None:
+            paths = self._function_paths = batching.get_function_paths(nodelist)
+        return paths
+
+    def get_key_plan(self, nodelist):
+        """
+        The batchable calls of the body and the nested loops collecting keys,
+        found the first time the tag is rendered.
+        """
+        plan = getattr(self, '_key_plan', None)
+        if plan is None:
+            plan = self._key_plan = batching.get_key_plan(nodelist)
+        return plan
+
+    def collect_keys(self, context, batch):
+        """
+        Collects the keys of the batchable calls of the body for every item,
+        when the loop is nested in a batched one.  Only lists and tuples are
+        iterated, other sequences may be read once or query the database.
+        """
+        try:
+            args, kwargs = self.container.bind(context)
+        except Exception:
+            return
+        values, nodelist = kwargs['values'], kwargs['pre_empty']
+        if not isinstance(values, (list, tuple)) or not values:
+            return
+        plan = self.get_key_plan(nodelist)
+        for forloop in self.iterate(context, kwargs['loopvars'], values, nodelist):
+            batching.collect_keys(context, batch, plan)
+
+    def batches(self, context, values, nodelist):
+        """
+        Whether the body calls batchable functions, and isn't in the body of
+        a loop batching them already.
+        """
+        if hasattr(values, '__len__') and not len(values):
+            # the body isn't rendered, nor compiled if it is lazy
+            return False
+        if batching.get_batch(context) is not None:
+            return False
+        paths = self.get_function_paths(nodelist)
+        return bool(paths) and batching.calls_batchables(paths, context)
+
+    def loop(self, context, loopvars, values, nodelist, prefetch=False):
+        """
+        Yields once per item of *values*, with ``forloop`` and the loop
+        variables set in *context*.  With *prefetch*, querysets fetch the
+        relations the body looks up along with their objects.  If the body
+        calls batchable functions, the keys of the calls are first collected
+        for every item, to fetch all of them at once, see
+        ``customtags.batching``.
+        """
+        if prefetch:
+            values = prefetching.prefetch_queryset(
+                values, self.get_prefetch_paths(loopvars, nodelist))
+        if not self.batches(context, values, nodelist):
+            for forloop in self.iterate(context, loopvars, values, nodelist):
+                yield forloop
+            return
+
+        if not hasattr(values, '__len__'):
+            values = list(values)
+        plan = self.get_key_plan(nodelist)
+        batch = batching.start_batch(context)
+        try:
+            for forloop in self.iterate(context, loopvars, values, nodelist):
+                batching.collect_keys(context, batch, plan)
+            batch.fetch()
+            for forloop in self.iterate(context, loopvars, values, nodelist):
+                yield forloop
+        finally:
+            batching.stop_batch(context)
+
+    def iterate(self, context, loopvars, values, nodelist):
+        """
+        Sets ``forloop`` and the loop variables for every item of *values*.
+        Sequences without a length are iterated one item ahead, to know the
+        last one, and are only turned into a list if the body needs their
+        length.
+        """
         if 'forloop' in context:
             parentloop = context['forloop']
         else:
             parentloop = {}
-        context.push()
-        if not hasattr(values, '__len__'):
+        if not hasattr(values, '__len__') and self.needs_length(nodelist):
             values = list(values)
-        len_values = len(values)
-        if len_values < 1:
+        if hasattr(values, '__len__'):
+            len_values = len(values)
+        else:
+            len_values = None
+        unpack = self.get_unpacking(loopvars)
+        # A single frame holds the loop's variables, overwritten for every
+        # item.  Names the body sets in it, as tags storing a value in the
+        # current context do, stay set for the next items, as with django's
+        # {% for %}, unless the loop unpacks several variables: those loops
+        # gave every item a frame of its own, and the names are removed
+        # after each item.
+        clear = len(loopvars) > 1
+        frame = context.push()
+        try:
+            # Create a forloop value in the context, computing the counters
+            # from the index and the length when they are looked up.
+            loop = frame['forloop'] = ForLoop(parentloop, len_values)
+            for i, (item, last) in enumerate(lookahead(values)):
+                loop.index = i
+                loop.is_last = last
+                unpack(frame, item)
+                size = len(frame)
+                yield loop
+                if clear and len(frame) != size:
+                    for name in [name for name in frame
+                                 if name != 'forloop' and name not in loopvars]:
+                        del frame[name]
+        finally:
             context.pop()
-            return post_empty.render(context)
+
+    def render_tag(self, context, loopvars, values, prefetch, pre_empty, post_empty):
         nodelist = template.NodeList()
-        unpack = len(loopvars) > 1
-        # Create a forloop value in the context.  We'll update counters on each
-        # iteration just below.
-        loop_dict = context['forloop'] = {'parentloop': parentloop}
-        for i, item in enumerate(values):
-            # Shortcuts for current loop iteration number.
-            loop_dict['counter0'] = i
-            loop_dict['counter'] = i+1
-            # Reverse counter iteration numbers.
-            loop_dict['revcounter'] = len_values - i
-            loop_dict['revcounter0'] = len_values - i - 1
-            # Boolean values designating first and last times through loop.
-            loop_dict['first'] = (i == 0)
-            loop_dict['last'] = (i == len_values - 1)
-
-            if unpack:
-                # If there are multiple loop variables, unpack the item into
-                # them.
-                context.update(dict(zip(loopvars, item)))
-            else:
-                context[loopvars[0]] = item
+        empty = True
+        for forloop in self.loop(context, loopvars, values, pre_empty, prefetch):
+            empty = False
             for node in pre_empty:
                 nodelist.append(node.render(context))
-            if unpack:
-                # The loop variables were pushed on to the context so pop them
-                # off again. This is necessary because the tag lets the length
-                # of loopvars differ to the length of each set of items and we
-                # don't want to leave any vars from the previous loop on the
-                # context.
-                context.pop()
-        context.pop()
+        if empty:
+            return post_empty.render(context)
         return nodelist.render(context)
+
+    def stream_tag(self, context, loopvars, values, prefetch, pre_empty, post_empty):
+        empty = True
+        for forloop in self.loop(context, loopvars, values, pre_empty, prefetch):
+            empty = False
+            for chunk in rendering.iter_nodelist(pre_empty, context):
+                yield chunk
+        if empty:
+            for chunk in rendering.iter_nodelist(post_empty, context):
+                yield chunk
+
+    def write_tag(self, context, out, loopvars, values, prefetch, pre_empty, post_empty):
+        empty = True
+        for forloop in self.loop(context, loopvars, values, pre_empty, prefetch):
+            empty = False
+            rendering.render_into(pre_empty, context, out)
+        if empty:
+            rendering.render_into(post_empty, context, out)
 register.tag('ct_for', For.as_tag())
 
 
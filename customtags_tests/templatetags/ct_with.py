@@ -1,4 +1,4 @@
-from customtags import core, arguments
+from customtags import core, arguments, rendering
 from django import template
 from customtags_tests.utils import pool
 
@@ -27,6 +27,14 @@ class With(core.Tag):
         output = endwith.render(context)
         context.pop()
         return output
+
+    def write_tag(self, context, out, value, varname, endwith):
+        context.push()
+        context[varname] = value
+        try:
+            rendering.render_into(endwith, context, out)
+        finally:
+            context.pop()
     
 register.tag('ct_with', With.as_tag())
 
@@ -1608,6 +1608,1685 @@ class CustomtagsTests(TestCase):
         self.assertRaises(exceptions.BaseError, arguments.BaseArgument, True, False)
 
 
+    def test_28_parse_budget(self):
+        from customtags import budget
+
+        def get_options(parse_budget):
+            options = core.Options(
+                arguments.MultiValueArgument('values', required=False),
+                arguments.Flag('one', true_values=['one'], default=False),
+                arguments.Flag('two', true_values=['two'], default=False),
+                arguments.Flag('three', true_values=['three'], default=False),
+                parse_budget=parse_budget
+            )
+            options.initialize('budget_tag')
+            return options
+
+        budget.reset_parse_stats()
+        dummy_tokens = DummyTokens('a', 'b', 'c', 'd', 'two', tagname='budget_tag')
+
+        options = get_options(None)
+        dummy_container = DummyContainer('budget_tag')
+        options.parse(dummy_parser, dummy_tokens, dummy_container)
+        self.assertEqual(dummy_container.tag_kwargs['two'].resolve({}), True)
+
+        stats = budget.get_parse_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['tagname'], 'budget_tag')
+        self.assertEqual(stats[0]['parses'], 1)
+        cost = stats[0]['max_cost']
+        self.assertTrue(cost > 0)
+        self.assertEqual(stats[0]['usage'], None)
+
+        options = get_options(cost)
+        options.parse(dummy_parser, dummy_tokens, DummyContainer('budget_tag'))
+        self.assertEqual(budget.get_parse_stats()[0]['usage'], 1.0)
+
+        options = get_options(cost - 1)
+        try:
+            options.parse(dummy_parser, dummy_tokens, DummyContainer('budget_tag'))
+        except exceptions.ParseBudgetExceeded, e:
+            self.assertTrue("'budget_tag'" in str(e))
+            self.assertTrue('Optional' in str(e) or 'Flag' in str(e))
+        else: # pragma: no cover
+            self.fail("ParseBudgetExceeded not raised")
+        self.assertEqual(budget.get_parse_stats()[0]['exceeded'], 1)
+        budget.reset_parse_stats()
+
+    def test_29_grammar_analysis(self):
+        from django.conf import settings
+        from customtags import analysis
+
+        options = core.Options(
+            arguments.Argument('value'),
+            'as',
+            arguments.Argument('varname', resolve=False),
+        )
+        options.initialize('dummy_tag')
+        report = analysis.analyze(options)
+        self.assertEqual(report.ambiguous, [])
+        self.assertEqual(report.max_lookahead_depth, 0)
+        self.assertEqual(report.complexity, 'O(1)')
+
+        options = core.Options(
+            arguments.MultiValueArgument('values', required=False),
+            arguments.Flag('one', true_values=['one'], default=False),
+            arguments.Flag('two', true_values=['two'], default=False),
+            'as',
+            arguments.Argument('varname', resolve=False, required=False),
+        )
+        options.initialize('dummy_tag')
+        report = analysis.analyze(options)
+        kinds = [point.kind for point in report.ambiguous]
+        self.assertEqual(kinds, ['optional', 'multi_value'])
+        self.assertEqual(report.ambiguous[1].overlap, 'one, two, as')
+        self.assertEqual(report.max_lookahead_width, 3)
+        self.assertTrue(report.max_lookahead_depth >= 2)
+        self.assertTrue(report.estimated_cost(20) > report.estimated_cost(10))
+
+        options = core.Options(
+            arguments.OneOf(
+                arguments.MultiValueKeywordArgument("newcontext", required=True),
+                arguments.Argument("newcontext")
+            ),
+            arguments.NodeList("nodelist"),
+            arguments.EndTag()
+        )
+        options.initialize('dummy_tag')
+        report = analysis.analyze(options)
+        self.assertEqual([point.kind for point in report.ambiguous], ['one_of'])
+
+        old = getattr(settings, 'CUSTOMTAGS_ANALYZE_GRAMMARS', False)
+        settings.CUSTOMTAGS_ANALYZE_GRAMMARS = True
+        try:
+            options = core.Options(
+                arguments.MultiValueArgument('values', required=True),
+                arguments.Flag('one', true_values=['one'], default=False),
+            )
+            message = ("Tag 'dummy_tag': the multi value branch "
+                       "<MultiValueArgument(name=values): tagname=dummy_tag> "
+                       "overlaps what follows it on one.")
+            self.assertWarns(exceptions.GrammarWarning, message,
+                             options.initialize, 'dummy_tag')
+        finally:
+            settings.CUSTOMTAGS_ANALYZE_GRAMMARS = old
+
+    def test_30_structure_large_grammar(self):
+        from utils import build_grammar_arguments
+
+        options = core.Options(*build_grammar_arguments(60))
+        options.initialize('big_tag')
+        structured = list(options.arguments)
+        # the tag name, then every argument with the non-required ones
+        # wrapped in Optional
+        self.assertEqual(structured[0], 'big_tag')
+        self.assertEqual(len(structured), 61)
+        self.assertTrue(isinstance(structured[1], arguments.Constant))
+        self.assertTrue(isinstance(structured[2], arguments.Argument))
+        for argument in structured[3:7]:
+            self.assertTrue(isinstance(argument, arguments.Optional))
+        self.assertEqual(structured[4].arguments[0].exclude, ['opt4', 'kw6'])
+        self.assertEqual(structured[6].arguments[0].exclude, ['kw6'])
+        self.assertEqual(structured[-1].arguments[0].name, 'm59')
+        for argument in structured[1:]:
+            self.assertEqual(argument.tagname, 'big_tag')
+
+        args = [arguments.Argument('value'), 'as', arguments.Argument('varname')]
+        outside = [arguments.Constant('only')]
+        structured = parser.structure_arguments(args, 'dummy_tag', outside)
+        self.assertEqual(type(structured), list)
+        self.assertEqual(structured[0].exclude, ['as'])
+        self.assertEqual(structured[2].exclude, ['only'])
+
+    def test_31_binding_plan(self):
+        from customtags.nodes import Const, Name
+
+        container = utils.Container(
+            tag_args=[values.StringValue(Const("static")),
+                      values.StringValue(Name("myvar"))],
+            tag_kwargs={
+                'nodelist': values.StaticValue(['node']),
+                'null': values.NullValue(),
+                'number': values.IntegerValue(Const("12")),
+                'items': values.ListValue(values.StaticValue("item")),
+            }
+        )
+        plan = container.freeze()
+        self.assertEqual(plan.args, ("static", None))
+        self.assertEqual([index for index, value in plan.dynamic_args], [1])
+        self.assertEqual(plan.kwargs, {'nodelist': ['node'], 'null': None})
+        self.assertEqual(sorted(key for key, value in plan.dynamic_kwargs),
+                         ['items', 'number'])
+
+        args, kwargs = plan.bind(template.Context({'myvar': 'dynamic'}))
+        self.assertEqual(args, ["static", "dynamic"])
+        self.assertEqual(kwargs, {'nodelist': ['node'], 'null': None,
+                                  'number': 12, 'items': ['item']})
+
+        # the constant slots are not shared between renders
+        args.append('extra')
+        kwargs['extra'] = 'extra'
+        args, kwargs = plan.bind(template.Context({'myvar': 'other'}))
+        self.assertEqual(args, ["static", "other"])
+        self.assertFalse('extra' in kwargs)
+
+        class BindingTag(core.Tag):
+            name = 'binding_tag'
+            options = core.Options(
+                arguments.Argument('value'),
+                arguments.Argument('static'),
+            )
+
+            def render_tag(self, context, value, static):
+                return '%s-%s' % (value, static)
+
+        tpls = [
+            ('{% binding_tag myvar "x" %}', 'a-x', {'myvar': 'a'}),
+            ('{% binding_tag myvar "x" %}', 'b-x', {'myvar': 'b'}),
+        ]
+        self._tag_tester(tpls, BindingTag)
+
+    def test_32_frozen_containers(self):
+        import memory
+
+        tpl = memory.build_template(2)
+        tags = list(memory.iter_tags(tpl.nodelist))
+        self.assertEqual(len(tags), 8)
+        for node in tags:
+            self.assertTrue(isinstance(node.container, utils.BindingPlan))
+            self.assertFalse(hasattr(node.container, '__dict__'))
+            self.assertEqual(node.tagname, node.name)
+            self.assertFalse('tagname' in node.__dict__)
+            self.assertFalse(hasattr(node.container, 'tag_args'))
+            dynamic = node.container.dynamic_args + node.container.dynamic_kwargs
+            for key, value in dynamic:
+                if type(value) in (values.StaticValue, values.StringValue, values.ListValue):
+                    self.assertFalse(hasattr(value, '__dict__'))
+        self.assertEqual(len(tags[0].nodelist), 1)
+        tags[0].tagname = 'renamed'
+        self.assertEqual((tags[0].tagname, tags[1].tagname), ('renamed', tags[1].name))
+        self.assertEqual(type(tags[0])(tagname='given').tagname, 'given')
+        self.assertFalse(hasattr(arguments.RepContainer(), '__dict__'))
+        self.assertFalse(hasattr(utils.Container(), '__dict__'))
+
+        (thawed_name, thawed, thawed_per_tag), (frozen_name, frozen, frozen_per_tag) = \
+            memory.run(False, 5)
+        self.assertTrue(frozen < thawed)
+
+    def test_33_options_inheritance(self):
+        class ParentTag(core.Tag):
+            name = 'parent_tag'
+            options = core.Options(
+                arguments.IntegerArgument('number'),
+                arguments.Argument('varname', required=False, resolve=False),
+            )
+
+            def render_tag(self, context, number, varname):
+                return '%s:%s:%s' % (self.name, number, varname)
+
+        class ChildTag(ParentTag):
+            name = 'child_tag'
+
+        self.assertFalse(ChildTag.options is ParentTag.options)
+        self.assertTrue(ChildTag.options.parser.arguments is
+                        ParentTag.options.parser.arguments)
+        self.assertEqual(ChildTag.options.tagname, 'child_tag')
+        self.assertEqual(ChildTag.options.arguments[0], 'child_tag')
+        self.assertEqual(ParentTag.options.arguments[0], 'parent_tag')
+
+        tpls = [
+            ('{% child_tag 1 %}', 'child_tag:1:None', {}),
+            ('{% parent_tag 2 x %}', 'parent_tag:2:x', {}),
+        ]
+        self._tag_tester(tpls, ParentTag, ChildTag)
+
+        # errors raised by the shared arguments name the subclass
+        dummy_tokens = DummyTokens(tagname='child_tag')
+        try:
+            ChildTag.options.parse(dummy_parser, dummy_tokens, utils.Container())
+        except exceptions.ArgumentRequiredError, e:
+            self.assertEqual(e.tagname, 'child_tag')
+        else: # pragma: no cover
+            self.fail("ArgumentRequiredError not raised")
+
+        # a grammar whose end tag is named after the tag is copied
+        class BlockParent(core.Tag):
+            name = 'block_parent'
+            options = core.Options(
+                arguments.NodeList('nodelist'),
+                arguments.EndTag(),
+            )
+
+            def render_tag(self, context, nodelist):
+                return nodelist.render(context)
+
+        class BlockChild(BlockParent):
+            name = 'block_child'
+
+        self.assertFalse(BlockChild.options.parser.arguments is
+                         BlockParent.options.parser.arguments)
+        self.assertEqual(BlockChild.options.arguments[-1].tagname, 'endblock_child')
+        self.assertEqual(BlockParent.options.arguments[-1].tagname, 'endblock_parent')
+
+    def test_34_lazy_options(self):
+        import threading
+
+        class LazyTag(core.Tag):
+            name = 'lazy_tag'
+            options = core.Options(
+                arguments.Argument('value'),
+                arguments.NodeList('nodelist'),
+                arguments.EndTag(),
+                lazy=True,
+            )
+
+            def render_tag(self, context, value, nodelist):
+                return '%s(%s)' % (value, nodelist.render(context))
+
+        class LazyChild(LazyTag):
+            name = 'lazy_child'
+
+        self.assertFalse(LazyTag.options.initialized)
+        self.assertTrue(LazyTag.options.deferred)
+        self.assertFalse(LazyChild.options.initialized)
+        self.assertTrue(LazyChild.options.base is LazyTag.options)
+
+        tag_function = LazyChild.as_tag()
+        self.assertFalse(LazyChild.options.initialized)
+
+        # the first parse initializes the child, and the parent before it
+        initialized = []
+        initialize = core.Options.initialize
+        def counting_initialize(options, tagname):
+            initialized.append(tagname)
+            return initialize(options, tagname)
+        core.Options.initialize = counting_initialize
+        try:
+            threads = [threading.Thread(target=LazyChild.options.ensure_initialized)
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            core.Options.initialize = initialize
+
+        self.assertEqual(initialized.count('lazy_tag'), 1)
+        self.assertTrue(LazyTag.options.initialized)
+        self.assertTrue(LazyChild.options.initialized)
+        self.assertEqual(LazyChild.options.arguments[-1].tagname, 'endlazy_child')
+
+        tpls = [
+            ('{% lazy_tag "a" %}x{% endlazy_tag %}', 'a(x)', {}),
+            ('{% lazy_child "b" %}y{% endlazy_child %}', 'b(y)', {}),
+        ]
+        self._tag_tester(tpls, LazyTag, LazyChild)
+
+        options = core.Options(arguments.Argument('value'))
+        self.assertFalse(options.is_lazy())
+        with self.settings(CUSTOMTAGS_LAZY_OPTIONS=True):
+            self.assertTrue(options.is_lazy())
+            self.assertFalse(core.Options(lazy=False).is_lazy())
+
+    def test_36_concurrent_compilation(self):
+        from multiprocessing.pool import ThreadPool
+
+        pool.autodiscover()
+        jobs = []
+        for tagname, data in pool:
+            renderer = Renderer(data['tag'])
+            for djstring, ctstring, ctx in data.get('controls', None) or ():
+                jobs.append((renderer.classify(ctstring), ctx))
+        jobs.append(('{% load ct_with %}{% ct_with x|upper with y %}{% endwith %}', {}))
+
+        def compile_and_render(job):
+            source, ctx = job
+            try:
+                return template.Template(source).render(template.Context(ctx))
+            except template.TemplateSyntaxError, e:
+                return 'error: %s' % e
+
+        expected = [compile_and_render(job) for job in jobs]
+
+        # switch threads as often as possible, to interleave the parsers
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        workers = ThreadPool(8)
+        try:
+            results = workers.map(compile_and_render, jobs * 5, chunksize=1)
+        finally:
+            workers.close()
+            workers.join()
+            sys.setcheckinterval(check_interval)
+        self.assertEqual(results, expected * 5)
+
+    def test_37_warm_up(self):
+        import os
+        import shutil
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command, CommandError
+        from django.template import Engine
+        from django.template.loaders import cached
+        from customtags import serialization, warmup
+
+        template_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(template_dir, 'sub'))
+            sources = {
+                'ok.html': '{% load ct_with %}{% ct_with "x" as y %}{{ y }}{% endwith %}',
+                'sub/plain.html': 'plain',
+                'broken.html': '{% load ct_with %}{% ct_with "x" %}{% endwith %}',
+            }
+            for name, source in sources.items():
+                with open(os.path.join(template_dir, name), 'w') as f:
+                    f.write(source)
+
+            templates = [{
+                'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                'DIRS': [template_dir],
+                'OPTIONS': {'loaders': [
+                    ('django.template.loaders.cached.Loader', [
+                        'django.template.loaders.filesystem.Loader',
+                    ]),
+                ]},
+            }]
+            with self.settings(TEMPLATES=templates):
+                self.assertEqual(warmup.find_templates(),
+                                 ['broken.html', 'ok.html', 'sub/plain.html'])
+
+                reports = warmup.warm_up(processes=2)
+                self.assertEqual([report.name for report in reports],
+                                 ['broken.html', 'ok.html', 'sub/plain.html'])
+                self.assertTrue(reports[0].error.startswith('TooFewArguments'))
+                self.assertEqual([report.error for report in reports[1:]], [None, None])
+
+                loader = Engine.get_default().template_loaders[0]
+                self.assertEqual(sorted(loader.template_cache),
+                                 ['ok.html', 'sub/plain.html'])
+                self.assertEqual(Engine.get_default().get_template('ok.html').render(
+                    template.Context()), 'x')
+
+                out = StringIO()
+                call_command('customtags_warmup', 'ok.html', processes=1, stdout=out)
+                self.assertTrue('ok.html' in out.getvalue())
+                self.assertTrue('Compiled 1 templates' in out.getvalue())
+                self.assertRaises(CommandError, call_command, 'customtags_warmup',
+                                  processes=1, stdout=StringIO(), stderr=StringIO())
+
+            # the loaders of an engine without cached loaders are wrapped in one
+            templates = [{
+                'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                'DIRS': [template_dir],
+                'APP_DIRS': True,
+            }]
+            with self.settings(TEMPLATES=templates):
+                engine = Engine.get_default()
+                self.assertEqual(warmup.prime(reports[1:]), 1)
+                loader = engine.template_loaders[0]
+                self.assertTrue(isinstance(loader, cached.Loader))
+                self.assertEqual(sorted(loader.template_cache),
+                                 ['ok.html', 'sub/plain.html'])
+                self.assertEqual(engine.get_template('sub/plain.html').render(
+                    template.Context()), 'plain')
+                self.assertEqual(warmup.prime(reports[1:]), 1)
+                self.assertEqual(len(engine.template_loaders), 1)
+
+            # errors pickling a template are reported with it
+            dumps = serialization.dumps
+            def recursing(template):
+                raise RuntimeError("maximum recursion depth exceeded")
+            serialization.dumps = recursing
+            try:
+                with self.settings(TEMPLATES=templates):
+                    reports = [warmup.compile_template(name)
+                               for name in ('ok.html', 'sub/plain.html')]
+            finally:
+                serialization.dumps = dumps
+            self.assertEqual([report.error for report in reports],
+                             ['Could not pickle: RuntimeError: maximum recursion depth exceeded'] * 2)
+        finally:
+            shutil.rmtree(template_dir)
+
+    def test_38_serialization(self):
+        import os
+        import pickle
+        import shutil
+        import tempfile
+        from django.template import Engine
+        from customtags import serialization, loaders
+
+        lib = template.Library()
+        lib.filter('shout', lambda value: '%s!' % value)
+        block = decorators.block_decorator(lib)
+
+        @block
+        def greet(context, nodelist, name="world", as_name="message"):
+            context.push()
+            context[as_name] = "hello %s" % name
+            rendered = nodelist.render(context)
+            context.pop()
+            return rendered
+
+        source = ('{% load ct_with %}{% greet name|shout %}{{ message|shout }}{% endgreet %}'
+                  '{% ct_with input|upper as output %}{{ output }}{% endwith %}')
+        context = {'name': 'you', 'input': 'x'}
+
+        builtins.append(lib)
+        try:
+            tpl = template.Template(source)
+            expected = tpl.render(template.Context(context))
+            self.assertEqual(expected, 'hello you!!X')
+            self.assertRaises(Exception, pickle.dumps, tpl, 2)
+
+            data = serialization.dumps(tpl)
+            loaded = serialization.loads(data)
+            self.assertTrue(loaded.engine is Engine.get_default())
+            self.assertEqual(loaded.render(template.Context(context)), expected)
+        finally:
+            builtins.remove(lib)
+        self.assertRaises(serialization.SerializationError, serialization.loads, data)
+
+        template_dir = tempfile.mkdtemp()
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(template_dir, 'with.html'), 'w') as f:
+                f.write('{% load ct_with %}{% ct_with input|upper as output %}'
+                        '{{ output }}{% endwith %}')
+            def load(debug):
+                engine = Engine(dirs=[template_dir], debug=debug, loaders=[
+                    ('customtags.loaders.Loader', ['django.template.loaders.filesystem.Loader']),
+                ])
+                return engine.get_template('with.html')
+
+            with self.settings(CUSTOMTAGS_TEMPLATE_CACHE_DIR=cache_dir):
+                for debug in (False, True):
+                    compiled = load(debug)
+                    self.assertEqual(len([name for name in os.listdir(cache_dir)
+                                          if name.endswith(loaders.SUFFIX)]), 1 + debug)
+
+                    # a new engine loads the template from the cache, without compiling it
+                    compile_template = loaders.Template
+                    def failing_template(*args, **kwargs):
+                        raise AssertionError("compiled again")
+                    loaders.Template = failing_template
+                    try:
+                        cached = load(debug)
+                    finally:
+                        loaders.Template = compile_template
+                    self.assertFalse(cached is compiled)
+                    self.assertEqual(cached.render(template.Context(context)), 'X')
+                    if debug:
+                        node = list(cached.nodelist)[-1]
+                        origin = node.source[0]
+                        self.assertTrue('ct_with' in origin.reload())
+        finally:
+            shutil.rmtree(template_dir)
+            shutil.rmtree(cache_dir)
+
+    def test_39_template_store(self):
+        import os
+        import shutil
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.template import Engine
+        from customtags import loaders, serialization, store
+
+        template_dir = tempfile.mkdtemp()
+        try:
+            sources = {
+                'a.html': '{% load ct_with %}{% ct_with "a" as x %}{{ x }}{% endwith %}',
+                'b.html': '{% load ct_now %}b',
+            }
+            for name, source in sources.items():
+                with open(os.path.join(template_dir, name), 'w') as f:
+                    f.write(source)
+            path = os.path.join(template_dir, 'store', 'templates.img')
+            templates = [{
+                'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                'DIRS': [template_dir],
+                'OPTIONS': {'loaders': [
+                    ('customtags.loaders.Loader', [
+                        'django.template.loaders.filesystem.Loader',
+                    ]),
+                ]},
+            }]
+            with self.settings(TEMPLATES=templates):
+                out = StringIO()
+                call_command('customtags_warmup', 'a.html', 'b.html', processes=1,
+                             store=path, stdout=out)
+                self.assertTrue('Stored 2 templates' in out.getvalue())
+
+            with self.settings(TEMPLATES=templates, CUSTOMTAGS_TEMPLATE_STORE=path):
+                template_store = store.get_store()
+                self.assertEqual(len(template_store), 2)
+                self.assertTrue(store.get_store() is template_store)
+
+                # every template is loaded from the store, none is compiled
+                compile_template = loaders.Template
+                def failing_template(*args, **kwargs):
+                    raise AssertionError("compiled again")
+                loaders.Template = failing_template
+                try:
+                    engine = Engine.get_default()
+                    self.assertEqual(engine.get_template('a.html').render(
+                        template.Context()), 'a')
+                    self.assertEqual(engine.get_template('b.html').render(
+                        template.Context()), 'b')
+
+                    # a template edited since the store was built is compiled
+                    with open(os.path.join(template_dir, 'b.html'), 'w') as f:
+                        f.write('edited')
+                    self.assertRaises(AssertionError, Engine(
+                        dirs=[template_dir], loaders=templates[0]['OPTIONS']['loaders']
+                    ).get_template, 'b.html')
+                finally:
+                    loaders.Template = compile_template
+
+            # entries that can't be loaded any more are compiled
+            broken = os.path.join(template_dir, 'store', 'broken.img')
+            key = loaders.get_cache_key(Engine(dirs=[template_dir]), 'a.html', sources['a.html'])
+            store.build(broken, [(key, serialization.dumps(template.Template('x'))[:-5])])
+            with self.settings(TEMPLATES=templates, CUSTOMTAGS_TEMPLATE_STORE=broken):
+                self.assertTrue(key in store.get_store())
+                self.assertEqual(Engine.get_default().get_template('a.html').render(
+                    template.Context()), 'a')
+
+            # an image that can't be read isn't opened again
+            opened = []
+            template_store_class = store.TemplateStore
+            def opening_store(path):
+                opened.append(path)
+                return template_store_class(path)
+            not_a_store = os.path.join(template_dir, 'a.html')
+            with open(not_a_store, 'wb') as f:
+                f.write('not a store')
+            store.TemplateStore = opening_store
+            try:
+                with self.settings(CUSTOMTAGS_TEMPLATE_STORE=not_a_store):
+                    self.assertEqual(store.get_store(), None)
+                    self.assertEqual(store.get_store(), None)
+            finally:
+                store.TemplateStore = template_store_class
+            self.assertEqual(opened, [not_a_store])
+            template_store.close()
+        finally:
+            shutil.rmtree(template_dir)
+
+    def test_40_lazy_nodelists(self):
+        from multiprocessing.pool import ThreadPool
+        from customtags import serialization
+
+        sources = [
+            '{% load ct_for %}{% ct_for x in seq %}{{ x }}'
+            '{% ct_for y in seq %}{{ y }}{% empty %}-{% endfor %}'
+            '{% for z in seq %}{% if z %}{{ z }}{% else %}!{% endif %}{% empty %}?{% endfor %}'
+            '{% comment %}{% empty %}{% endcomment %}'
+            '{% empty %}{% with "e" as e %}{{ e }}{% endwith %}{% endfor %}',
+            '{% load ct_with %}{% ct_with "a" as a %}{{ a }}'
+            '{% ct_with "b" as b %}{{ a }}{{ b }}{% endwith %}{% endwith %}',
+        ]
+        contexts = [{'seq': [0, 1, 2]}, {'seq': []}]
+        expected = [template.Template(source).render(template.Context(ctx))
+                    for source in sources for ctx in contexts]
+
+        with self.settings(CUSTOMTAGS_LAZY_NODELISTS=True):
+            compiled = [template.Template(source) for source in sources]
+            self.assertEqual([tpl.render(template.Context(ctx))
+                              for tpl in compiled for ctx in contexts], expected)
+
+            tpl = template.Template(sources[0])
+            pre_empty, post_empty = tpl.nodelist[1].container.tag_nodelists
+            self.assertTrue(isinstance(pre_empty, arguments.LazyNodeList))
+            self.assertFalse(pre_empty.compiled)
+            self.assertFalse(post_empty.compiled)
+            self.assertEqual(tpl.render(template.Context({'seq': []})), 'e')
+            self.assertFalse(pre_empty.compiled)
+            self.assertTrue(post_empty.compiled)
+
+            # errors in a body are raised by its first render
+            tpl = template.Template('{% load ct_with %}'
+                                    '{% ct_with 1 as a %}{% unknown %}{% endwith %}')
+            self.assertRaises(template.TemplateSyntaxError, tpl.render, template.Context())
+
+            # bodies loading libraries are compiled with the template
+            tpl = template.Template('{% load ct_with %}{% ct_with 1 as a %}'
+                                    '{% load ct_now %}{% endwith %}{% ct_now "Y" %}')
+            body, = tpl.nodelist[1].container.tag_nodelists
+            self.assertFalse(isinstance(body, arguments.LazyNodeList))
+
+            # a body is compiled once, and by a single thread
+            tpl = template.Template(sources[1])
+            body, = tpl.nodelist[1].container.tag_nodelists
+            parsed = []
+            parser_class = body.parser_class
+            class CountingParser(parser_class):
+                def parse(self, parse_until=None):
+                    parsed.append(parse_until)
+                    return super(CountingParser, self).parse(parse_until)
+            body.parser_class = CountingParser
+            check_interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+            workers = ThreadPool(8)
+            try:
+                results = workers.map(lambda i: tpl.render(template.Context()),
+                                      range(40), chunksize=1)
+            finally:
+                workers.close()
+                workers.join()
+                sys.setcheckinterval(check_interval)
+            self.assertEqual(results, [expected[2]] * 40)
+            # the body, then the body nested in it
+            self.assertEqual(parsed, [None, None])
+
+            # lazy bodies are pickled compiled
+            tpl = template.Template(sources[0])
+            loaded = serialization.loads(serialization.dumps(tpl))
+            self.assertEqual(loaded.render(template.Context(contexts[0])), expected[0])
+            body = loaded.nodelist[1].container.tag_nodelists[0]
+            self.assertFalse(isinstance(body, arguments.LazyNodeList))
+
+        # options may make a single body lazy
+        options = core.Options(
+            arguments.Argument('value'),
+            blocks=[('otherwise', arguments.NodeList('body', lazy=True)), 'end_lazy'],
+        )
+        self.assertTrue(options.arguments[1].lazy)
+        self.assertEqual(options.arguments[-1].tagname, 'end_lazy')
+
+    def test_41_codegen(self):
+        import pickle
+        from django.template.base import NodeList
+        from customtags import codegen
+
+        lib = template.Library()
+        block = decorators.block_decorator(lib)
+        function = decorators.function_decorator(lib)
+
+        @block
+        def greet(context, nodelist, name="world", as_name="message"):
+            context.push()
+            context[as_name] = "hello %s" % name
+            rendered = nodelist.render(context)
+            context.pop()
+            return rendered
+
+        @function
+        def shout(context, value=""):
+            return value.upper()
+
+        rendered_bodies = []
+        @block
+        def track(context, nodelist):
+            rendered_bodies.append(nodelist)
+            return nodelist.render(context)
+
+        tpls = [
+            ('a{{ x }}{% greet name=x %}<{{ message|upper }}>{% endgreet %}b', {'x': '<y>'}),
+            ('{% shout x %}{% shout x as y %}[{{ y }}]{% shout "z" %}', {'x': 'q'}),
+            ('{% greet as m %}{% for i in seq %}{% shout m %}{{ i }}{% endfor %}{% endgreet %}',
+             {'seq': [1, 2]}),
+            ('{% track %}{% track %}{{ x }}{% endtrack %}{% endtrack %}', {'x': 1}),
+            ('{% load ct_for %}{% ct_for i in seq %}{{ i }}{% empty %}-{% endfor %}',
+             {'seq': []}),
+            ('{% if x %}{{ x.missing }}{% endif %}', {'x': 'x'}),
+        ]
+        builtins.append(lib)
+        try:
+            for source, ctx in tpls:
+                tpl = template.Template(source)
+                expected = tpl.render(template.Context(ctx))
+                self.assertTrue(codegen.compile_template(tpl) is tpl)
+                self.assertTrue(isinstance(tpl.nodelist, codegen.CompiledNodeList))
+                self.assertEqual(tpl.render(template.Context(ctx)), expected)
+                self.assertEqual(tpl.render(template.Context(ctx)), expected)
+
+            # bodies of compilable tags are compiled too
+            self.assertTrue(all(isinstance(body, codegen.CompiledNodeList)
+                                for body in rendered_bodies[-2:]))
+
+            # the generated source names every node
+            tpl = template.Template(tpls[0][0])
+            source = codegen.CodeGenerator().generate(tpl.nodelist)
+            self.assertTrue('def render(context):' in source)
+            self.assertTrue('render_tag_' in source)
+
+            # compiled nodelists pickle as plain nodelists
+            tpl = codegen.compile_template(template.Template('a{{ x }}'))
+            nodelist = pickle.loads(pickle.dumps(tpl.nodelist, pickle.HIGHEST_PROTOCOL))
+            self.assertEqual(type(nodelist), NodeList)
+            self.assertEqual(nodelist.render(template.Context({'x': 1})), 'a1')
+
+            # templates compiled in debug mode are left as they are
+            engine = template.Engine(debug=True)
+            tpl = engine.from_string(tpls[0][0])
+            nodelist = tpl.nodelist
+            self.assertTrue(codegen.compile_template(tpl).nodelist is nodelist)
+
+            # the customtags loader compiles the templates it loads
+            engine = template.Engine(loaders=[
+                ('customtags.loaders.Loader', [
+                    ('django.template.loaders.locmem.Loader', {'a.html': tpls[0][0]}),
+                ]),
+            ])
+            with self.settings(CUSTOMTAGS_CODEGEN=True):
+                tpl = engine.get_template('a.html')
+            self.assertTrue(isinstance(tpl.nodelist, codegen.CompiledNodeList))
+            self.assertEqual(tpl.render(template.Context(tpls[0][1])),
+                             'a&lt;y&gt;<HELLO &lt;Y&gt;>b')
+        finally:
+            builtins.remove(lib)
+
+    def test_42_prerender(self):
+        from django.template.base import TextNode
+        from customtags import prerender
+
+        lib = template.Library()
+        block = decorators.block_decorator(lib)
+        function = decorators.function_decorator(lib)
+
+        @function(pure=True)
+        def label(context, value=""):
+            return (value or "").title()
+
+        calls = []
+        @function
+        def count(context):
+            calls.append(1)
+            return len(calls)
+
+        @block(pure=True)
+        def box(context, nodelist):
+            return "[%s]" % nodelist.render(context)
+
+        @function(pure=True)
+        def broken(context):
+            raise ValueError("broken")
+
+        tpls = [
+            ('a{% label "x y" %}b{{ v }}', 2),
+            ('{% label v %}{% label "c" %}', 2),
+            ('{% box %}{% label "q" %}-{% box %}r{% endbox %}{% endbox %}', 1),
+            ('{% box %}{{ v }}{% endbox %}', 1),
+            ('{% if v %}{% label "i" %}{% else %}{% label "e" %}{% endif %}', 1),
+            ('{% label "z" as w %}<{{ w }}>', 4),
+            ('{% load ct_with %}{% ct_with "a" as x %}{% label "k" %}{{ x }}{% endwith %}', 2),
+            ('{% count %}{% count %}', 2),
+        ]
+        contexts = [{'v': 'value'}, {'v': ''}, {}]
+        builtins.append(lib)
+        try:
+            for source, length in tpls:
+                expected = [template.Template(source).render(template.Context(ctx))
+                            for ctx in contexts]
+                del calls[:]
+                tpl = prerender.prerender_template(template.Template(source))
+                self.assertEqual(len(tpl.nodelist), length)
+                self.assertEqual([tpl.render(template.Context(ctx)) for ctx in contexts],
+                                 expected)
+
+            tpl = prerender.prerender_template(template.Template(tpls[2][0]))
+            self.assertTrue(isinstance(tpl.nodelist[0], TextNode))
+            self.assertEqual(tpl.nodelist[0].s, '[Q-[r]]')
+
+            # the body of an if, and of a tag that isn't pure, is pre-rendered
+            tpl = prerender.prerender_template(template.Template(tpls[4][0]))
+            for condition, nodelist in tpl.nodelist[0].conditions_nodelists:
+                self.assertEqual([type(node) for node in nodelist], [TextNode])
+            tpl = prerender.prerender_template(template.Template(tpls[6][0]))
+            body, = tpl.nodelist[1].container.tag_nodelists
+            self.assertEqual(body[0].s, 'K')
+
+            # a tag failing to render fails at render time
+            tpl = prerender.prerender_template(template.Template('a{% broken %}b'))
+            self.assertEqual(len(tpl.nodelist), 3)
+            self.assertRaises(ValueError, tpl.render, template.Context())
+
+            # the customtags loader pre-renders the templates it loads
+            engine = template.Engine(loaders=[
+                ('customtags.loaders.Loader', [
+                    ('django.template.loaders.locmem.Loader', {'a.html': tpls[0][0]}),
+                ]),
+            ])
+            with self.settings(CUSTOMTAGS_PRERENDER=True, CUSTOMTAGS_CODEGEN=True):
+                tpl = engine.get_template('a.html')
+            self.assertEqual(tpl.nodelist[0].s, 'aX Yb')
+            self.assertEqual(tpl.render(template.Context({'v': 1})), 'aX Yb1')
+        finally:
+            builtins.remove(lib)
+
+        self.assertFalse(core.Tag.pure)
+        self.assertRaises(TypeError, decorators.function, pure=True, unknown=1)
+
+    def test_43_render_cache(self):
+        from customtags import codegen
+        from customtags.render_cache import RenderCache
+
+        now = [0]
+        rendered = []
+
+        class Label(core.Tag):
+            name = 'cached_label'
+            options = core.Options(
+                arguments.Argument('value'),
+                arguments.MultiValueKeywordArgument('kwargs', required=False),
+            )
+            render_cache = RenderCache(maxsize=2, ttl=10, clock=lambda: now[0])
+
+            def render_tag(self, context, value, kwargs):
+                rendered.append(value)
+                return '<%s%s>' % (value, ''.join(sorted(kwargs)))
+
+        class OtherLabel(Label):
+            name = 'other_label'
+
+            def render_tag(self, context, value, kwargs):
+                return '(%s)' % value
+
+        lib = template.Library()
+        lib.tag(Label.as_tag())
+        lib.tag(OtherLabel.as_tag())
+        cache = Label.render_cache
+
+        def render(source, **ctx):
+            return template.Template(source).render(template.Context(ctx))
+
+        builtins.append(lib)
+        try:
+            self.assertEqual(render('{% cached_label v %}{% cached_label v %}', v='a'), '<a><a>')
+            self.assertEqual(rendered, ['a'])
+            self.assertEqual(render('{% cached_label "a" %}{% other_label "a" %}'), '<a>(a)')
+            self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 2,
+                                             'misses': 2, 'evictions': 0, 'unhashable': 0})
+
+            # keyword arguments are part of the key
+            self.assertEqual(render('{% cached_label "a" x=1 %}'), '<ax>')
+            self.assertEqual(rendered, ['a', 'a'])
+
+            # the least recently used output is evicted
+            self.assertEqual(cache.stats()['evictions'], 1)
+            render('{% cached_label "a" %}')
+            self.assertEqual(rendered, ['a', 'a', 'a'])
+            self.assertEqual(len(cache), 2)
+
+            # outputs expire after the TTL
+            now[0] = 5
+            render('{% cached_label "a" %}')
+            self.assertEqual(rendered, ['a', 'a', 'a'])
+            now[0] = 20
+            render('{% cached_label "a" %}')
+            self.assertEqual(rendered, ['a', 'a', 'a', 'a'])
+
+            # unhashable arguments are rendered as usual
+            self.assertEqual(render("{% cached_label v %}{% cached_label v %}", v=set([1])),
+                             "<set([1])><set([1])>")
+            self.assertEqual(cache.stats()['unhashable'], 2)
+
+            # code generation keeps the cache
+            tpl = codegen.compile_template(template.Template('{% cached_label "b" %}'))
+            del rendered[:]
+            tpl.render(template.Context())
+            tpl.render(template.Context())
+            self.assertEqual(rendered, ['b'])
+
+            cache.clear()
+            self.assertEqual(len(cache), 0)
+
+            # values of different types don't share an output
+            del rendered[:]
+            self.assertEqual(render('{% cached_label 1 %}{% cached_label True %}'),
+                             '<1><True>')
+            self.assertEqual(rendered, [1, True])
+        finally:
+            builtins.remove(lib)
+        self.assertEqual(core.Tag.render_cache, None)
+
+        # bodies depend on the context, and aren't keyed
+        class Block(core.Tag):
+            name = 'cached_block'
+            options = core.Options(blocks=['end_cached_block'])
+            render_cache = RenderCache()
+
+            def render_tag(self, context, end_cached_block):
+                return end_cached_block.render(context)
+
+        # repeated arguments are keyed by their values
+        class Joined(core.Tag):
+            name = 'cached_joined'
+            options = core.Options(
+                arguments.Repetition('values', arguments.Argument('value')),
+            )
+            render_cache = RenderCache()
+
+            def render_tag(self, context, values):
+                return ','.join(str(value['value']) for value in values)
+
+        lib = template.Library()
+        lib.tag(Block.as_tag())
+        lib.tag(Joined.as_tag())
+        builtins.append(lib)
+        try:
+            tpl = template.Template('{% cached_block %}{{ name }}{% end_cached_block %}')
+            self.assertEqual(tpl.render(template.Context({'name': 'alice'})), 'alice')
+            self.assertEqual(tpl.render(template.Context({'name': 'bob'})), 'bob')
+            self.assertEqual(Block.render_cache.stats()['hits'], 0)
+
+            tpl = template.Template('{% cached_joined x y %}')
+            self.assertEqual(tpl.render(template.Context({'x': 1, 'y': 2})), '1,2')
+            self.assertEqual(tpl.render(template.Context({'x': 3, 'y': 4})), '3,4')
+            self.assertEqual(tpl.render(template.Context({'x': 1, 'y': 2})), '1,2')
+            self.assertEqual(Joined.render_cache.stats()['hits'], 1)
+        finally:
+            builtins.remove(lib)
+
+    def test_44_fragment_cache(self):
+        from customtags import introspection
+        from customtags_tests.models import Author
+
+        calls = []
+        def count():
+            calls.append(1)
+            return len(calls)
+
+        item = {'name': 'a'}
+        item['expensive'] = lambda: item['name'].upper()
+
+        source = ('{% load customtags ct_with %}{% ct_cache 60 %}'
+                  '{% ct_with item.name as n %}{{ n }}{% endwith %}:{{ count }}:'
+                  '{{ item.expensive }}{% if flag %}!{% endif %}{% endct_cache %}')
+        tpl = template.Template(source)
+        body = tpl.nodelist[1].container.tag_nodelists[0]
+        # n is bound by the body itself
+        self.assertEqual(introspection.get_dependencies(body),
+                         ['count', 'flag', 'item.expensive', 'item.name'])
+        self.assertEqual(introspection.get_fingerprint(body), introspection.get_fingerprint(
+            template.Template(source).nodelist[1].container.tag_nodelists[0]))
+        self.assertNotEqual(introspection.get_fingerprint(body), introspection.get_fingerprint(
+            template.Template('{% if flag %}?{% endif %}').nodelist))
+        # a compiled body shares the fingerprint of the body it was compiled from
+        from customtags import codegen
+        compiled = codegen.compile_nodelist(template.NodeList(body))
+        self.assertTrue(isinstance(compiled, codegen.CompiledNodeList))
+        self.assertEqual(introspection.get_fingerprint(compiled),
+                         introspection.get_fingerprint(body))
+
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'fragments': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                          'LOCATION': 'customtags-fragments'},
+        }
+        with self.settings(CACHES=caches, CUSTOMTAGS_FRAGMENT_CACHE='fragments'):
+            render = lambda **ctx: tpl.render(template.Context(dict(
+                {'count': count, 'item': item}, **ctx)))
+
+            self.assertEqual(render(), 'a:1:A')
+            self.assertEqual(render(), 'a:1:A')
+            self.assertEqual(render(unrelated=1), 'a:1:A')
+            # the callables the body ends with are not called for the key
+            self.assertEqual(len(calls), 1)
+
+            # the key follows the values of the dependencies
+            self.assertEqual(render(flag=True), 'a:2:A!')
+            item['name'] = 'b'
+            self.assertEqual(render(flag=True), 'b:3:B!')
+            self.assertEqual(render(), 'b:4:B')
+
+            # a key expression replaces the dependencies
+            keyed = template.Template('{% load customtags %}'
+                                      '{% ct_cache 60 key %}{{ count }}{% endct_cache %}')
+            self.assertEqual(keyed.render(template.Context({'key': 1, 'count': count})), '5')
+            self.assertEqual(keyed.render(template.Context({'key': 1, 'count': count})), '5')
+            self.assertEqual(keyed.render(template.Context({'key': 2, 'count': count})), '6')
+
+            # models are keyed by their primary key, bound methods by their
+            # object, and sequences item by item
+            author = Author.objects.create(name='a')
+            self.assertEqual(introspection.get_key_value(author.save),
+                             'customtags_tests.author:%r.save' % author.pk)
+            self.assertEqual(introspection.get_key_value([1, u'1', (None,)]),
+                             "list[1,u'1',tuple[None]]")
+            self.assertRaises(introspection.OpaqueValue,
+                              introspection.get_key_value, Author(name='unsaved'))
+
+            # lists with the same repr and different contents don't share a
+            # fragment, and the loop variables aren't dependencies
+            class Product(object):
+                def __init__(self, name):
+                    self.name = name
+                def __repr__(self):
+                    return 'Product'
+
+            looped = template.Template('{% load customtags ct_for %}{% ct_cache 60 %}'
+                                       '{% ct_for p in products %}{{ p.pk }}{{ p.name }},'
+                                       '{% endfor %}{% endct_cache %}')
+            body = looped.nodelist[1].container.tag_nodelists[0]
+            self.assertEqual(introspection.get_dependencies(body), ['products'])
+            other = Author.objects.create(name='a')
+            self.assertEqual(repr([author]), repr([other]))
+            self.assertEqual(looped.render(template.Context({'products': [author]})),
+                             '%sa,' % author.pk)
+            self.assertEqual(looped.render(template.Context({'products': [other]})),
+                             '%sa,' % other.pk)
+            # values without a meaningful key need a key expression
+            for products in ([Product('x')], [Product('y')]):
+                self.assertRaises(template.TemplateSyntaxError, looped.render,
+                                  template.Context({'products': products}))
+            keyed = template.Template('{% load customtags ct_for %}{% ct_cache 60 key %}'
+                                      '{% ct_for p in products %}{{ p.name }},'
+                                      '{% endfor %}{% endct_cache %}')
+            self.assertEqual(keyed.render(template.Context(
+                {'key': 'x', 'products': [Product('x')]})), 'x,')
+            self.assertEqual(keyed.render(template.Context(
+                {'key': 'y', 'products': [Product('y')]})), 'y,')
+            self.assertRaises(template.TemplateSyntaxError, keyed.render,
+                              template.Context({'key': Product('z'), 'products': []}))
+
+            tpl = template.Template('{% load customtags %}'
+                                    '{% ct_cache "soon" %}{% endct_cache %}')
+            self.assertRaises(template.TemplateSyntaxError, tpl.render, template.Context())
+
+    def test_45_streaming(self):
+        from customtags import rendering
+
+        log = []
+        class Row(object):
+            def __init__(self, index):
+                self.index = index
+            @property
+            def value(self):
+                log.append(self.index)
+                return self.index
+
+        source = ('{% load ct_for %}<{% ct_for row in rows %}{{ row.value }}'
+                  '{% ct_for x,y in pairs %}{{ x }}{{ y }}{% endfor %},'
+                  '{% empty %}none{% endfor %}{% if rows %}>{% endif %}')
+        contexts = [
+            {'rows': [Row(i) for i in range(50)], 'pairs': [(1, 'a'), (2, 'b')]},
+            {'rows': []},
+        ]
+        for ctx in contexts:
+            tpl = template.Template(source)
+            expected = tpl.render(template.Context(ctx))
+            chunks = list(rendering.iter_template(tpl, template.Context(ctx)))
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(u''.join(chunks), expected)
+
+        # the loop is rendered as the chunks are consumed
+        del log[:]
+        context = template.Context(contexts[0])
+        chunks = rendering.iter_template(template.Template(source), context)
+        self.assertEqual(next(chunks), u'<')
+        self.assertEqual(next(chunks), u'0')
+        self.assertEqual(log, [0])
+        self.assertEqual(u''.join(chunks)[-2:], u',>')
+        self.assertEqual(log, range(50))
+        # the context is left as it was found
+        self.assertFalse('forloop' in context)
+        self.assertFalse('row' in context)
+
+        self.assertEqual(list(rendering.buffer_chunks([u'ab', u'c', u'def', u'g'], 3)),
+                         [u'abc', u'def', u'g'])
+
+        # inclusion tags stream their template
+        class StreamedInc(helpers.InclusionTag):
+            template = 'test.html'
+            options = core.Options(
+                arguments.Argument('var'),
+            )
+            def get_context(self, context, var):
+                return {'var': var}
+        lib = template.Library()
+        lib.tag(StreamedInc.as_tag())
+        builtins.append(lib)
+        try:
+            tpl = template.Template('{% streamed_inc var %}')
+            node = tpl.nodelist[0]
+            self.assertEqual(list(node.render_stream(template.Context({'var': 'v'}))),
+                             list(rendering.stream_template('test.html', {'var': 'v'})))
+            self.assertEqual(u''.join(node.render_stream(template.Context({'var': 'v'}))),
+                             tpl.render(template.Context({'var': 'v'})))
+        finally:
+            builtins.remove(lib)
+
+        templates = [{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {'loaders': [
+                ('django.template.loaders.locmem.Loader', {'rows.html': source}),
+            ]},
+        }]
+        with self.settings(TEMPLATES=templates):
+            response = rendering.streaming_response('rows.html', contexts[0],
+                                                    content_type='text/plain')
+            self.assertTrue(response.streaming)
+            self.assertEqual(response['Content-Type'], 'text/plain')
+            self.assertEqual(''.join(response.streaming_content),
+                             template.Template(source).render(template.Context(contexts[0])))
+
+        # the template's name is bound while it renders, and put back afterwards
+        class TemplateName(core.Tag):
+            def render_tag(self, context):
+                return context.template_name
+        lib = template.Library()
+        lib.tag(TemplateName.as_tag())
+        builtins.append(lib)
+        try:
+            tpl = template.Template('{% template_name %}', name='named.html')
+            context = template.Context()
+            context.template_name = 'outer.html'
+            self.assertEqual(list(rendering.iter_template(tpl, context)), [u'named.html'])
+            self.assertEqual(context.template_name, 'outer.html')
+            out = []
+            context = template.Context()
+            rendering.render_template_into(tpl, context, out)
+            self.assertEqual(out, [u'named.html'])
+            self.assertEqual(context.template_name, None)
+        finally:
+            builtins.remove(lib)
+
+    def test_46_render_into(self):
+        import io
+        from customtags import rendering
+        from customtags_tests.utils import build_nested_source
+
+        sources = [
+            build_nested_source(3, 'text'),
+            '{% load ct_for %}{% ct_for x,y in pairs %}{{ x }}{{ y }}{% empty %}none{% endfor %}',
+            '{% load ct_with %}{% ct_with 1 as one %}{% if one %}{{ one }}{% endif %}{% endwith %}',
+        ]
+        contexts = [
+            {'items': range(3), 'pairs': [(1, 'a'), (2, 'b')]},
+            {'items': [], 'pairs': []},
+        ]
+        for source in sources:
+            for ctx in contexts:
+                tpl = template.Template(source)
+                expected = tpl.render(template.Context(ctx))
+                out = []
+                context = template.Context(ctx)
+                depth = len(context.dicts)
+                rendering.render_template_into(tpl, context, out)
+                self.assertEqual(u''.join(out), expected)
+                self.assertEqual(len(context.dicts), depth)
+                stream = io.StringIO()
+                rendering.render_template_into(tpl, template.Context(ctx), stream)
+                self.assertEqual(stream.getvalue(), expected)
+
+        # nested bodies are written into the list rather than joined
+        tpl = template.Template(build_nested_source(2, 'text'))
+        out = []
+        rendering.render_template_into(tpl, template.Context(contexts[0]), out)
+        self.assertTrue(len(out) > 20)
+        self.assertTrue(all(len(chunk) < 50 for chunk in out))
+
+        # tags without write_tag write the output of render
+        class Upper(core.Tag):
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+            def render_tag(self, context, value):
+                return value.upper()
+        lib = template.Library()
+        lib.tag(Upper.as_tag())
+        builtins.append(lib)
+        try:
+            tpl = template.Template('{% load ct_with %}{% ct_with "a" as a %}{% upper a %}{% endwith %}')
+            out = []
+            tpl.nodelist[-1].render_into(template.Context(), out)
+            self.assertEqual(out, [u'A'])
+        finally:
+            builtins.remove(lib)
+
+        templates = [{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {'loaders': [
+                ('django.template.loaders.locmem.Loader', {'nested.html': sources[1]}),
+            ]},
+        }]
+        with self.settings(TEMPLATES=templates):
+            out = []
+            rendering.write_template('nested.html', out, contexts[0])
+            self.assertEqual(u''.join(out), u'1a2b')
+
+    def test_47_for_iterators(self):
+        from customtags import rendering
+        from customtags_tests.templatetags.ct_for import lookahead, is_length_path
+
+        self.assertEqual(list(lookahead(iter([]))), [])
+        self.assertEqual(list(lookahead(iter('ab'))), [('a', False), ('b', True)])
+        self.assertTrue(is_length_path('forloop.revcounter'))
+        self.assertTrue(is_length_path('forloop.parentloop.revcounter0'))
+        self.assertTrue(is_length_path('forloop'))
+        self.assertFalse(is_length_path('forloop.last'))
+        self.assertFalse(is_length_path('revcounter'))
+
+        consumed = []
+        def generate(count):
+            for i in range(count):
+                consumed.append(i)
+                yield i
+
+        source = ('{% load ct_for %}{% ct_for x in values %}{{ x }}'
+                  '{% if forloop.first %}^{% endif %}{% if forloop.last %}${% endif %}'
+                  '{% empty %}none{% endfor %}')
+        tpl = template.Template(source)
+        self.assertEqual(tpl.render(template.Context({'values': generate(3)})), u'0^12$')
+        self.assertEqual(tpl.render(template.Context({'values': generate(0)})), u'none')
+        self.assertEqual(tpl.render(template.Context({'values': generate(1)})), u'0^$')
+
+        # the generator is consumed one item ahead of the rendering
+        del consumed[:]
+        chunks = rendering.iter_template(tpl, template.Context({'values': generate(1000)}))
+        self.assertEqual(next(chunks), u'0')
+        self.assertEqual(consumed, [0, 1])
+        next(chunks)
+        next(chunks)
+        self.assertEqual(consumed, [0, 1, 2])
+        self.assertTrue(u''.join(chunks).endswith(u'999$'))
+        self.assertFalse(tpl.nodelist[-1]._needs_length)
+
+        # bodies referring to the reverse counters get the whole sequence
+        for source in ['{% load ct_for %}{% ct_for x in values %}{{ forloop.revcounter }}{% endfor %}',
+                       '{% load ct_for %}{% ct_for x in values %}{% ct_for y in inner %}'
+                       '{{ forloop.parentloop.revcounter0 }}{% endfor %}{% endfor %}']:
+            tpl = template.Template(source)
+            expected = tpl.render(template.Context({'values': [0, 1, 2], 'inner': 'ab'}))
+            self.assertEqual(tpl.render(template.Context({'values': generate(3), 'inner': 'ab'})),
+                             expected)
+            self.assertTrue(tpl.nodelist[-1]._needs_length)
+
+        # so do sequences with a length, whatever the body
+        tpl = template.Template('{% load ct_for %}{% ct_for x in values %}{% if forloop.last %}'
+                                '{{ forloop.revcounter0 }}{% endif %}{% endfor %}')
+        self.assertEqual(tpl.render(template.Context({'values': range(5)})), u'0')
+
+    def test_48_lazy_forloop(self):
+        from customtags_tests.templatetags.ct_for import ForLoop
+
+        parent = ForLoop({}, 3)
+        parent.index = 2
+        parent.is_last = True
+        loop = ForLoop(parent)
+        loop.index = 1
+        self.assertEqual(loop['counter'], 2)
+        self.assertEqual(loop['counter0'], 1)
+        self.assertFalse(loop['first'])
+        self.assertFalse(loop['last'])
+        self.assertTrue('counter' in loop)
+        self.assertFalse('revcounter' in loop)
+        self.assertEqual(loop.get('revcounter0', 'unknown'), 'unknown')
+        self.assertRaises(KeyError, lambda: loop['missing'])
+        self.assertEqual(loop['parentloop']['revcounter'], 1)
+        self.assertEqual(loop['parentloop']['revcounter0'], 0)
+        self.assertTrue(loop['parentloop']['last'])
+
+        fields = ('{{ forloop.counter }}{{ forloop.counter0 }}{{ forloop.revcounter }}'
+                  '{{ forloop.revcounter0 }}{{ forloop.first }}{{ forloop.last }}')
+        nested = ('{{ forloop.parentloop.counter }}-{{ forloop.counter }}'
+                  '{% ifchanged %}{{ forloop.parentloop.first }}{% endifchanged %},')
+        for body in [fields, nested]:
+            dj_source = '{%% for x in a %%}{%% for y in b %%}%s{%% endfor %%}{%% endfor %%}' % body
+            ct_source = ('{%% load ct_for %%}{%% ct_for x in a %%}{%% ct_for y in b %%}'
+                         '%s{%% endfor %%}{%% endfor %%}' % body)
+            data = {'a': range(3), 'b': 'xy'}
+            self.assertEqual(template.Template(ct_source).render(template.Context(data)),
+                             template.Template(dj_source).render(template.Context(data)))
+
+    def test_49_for_unpacking(self):
+        from customtags_tests.templatetags.ct_for import compile_unpacking
+
+        frame = {}
+        unpack = compile_unpacking(('x', 'y'))
+        unpack(frame, (1, 2))
+        self.assertEqual(frame, {'x': 1, 'y': 2})
+        unpack(frame, (3,))
+        self.assertEqual(frame, {'x': 3})
+        unpack(frame, 'abc')
+        self.assertEqual(frame, {'x': 'a', 'y': 'b'})
+        compile_unpacking(('x',))(frame, (4, 5))
+        self.assertEqual(frame, {'x': (4, 5), 'y': 'b'})
+
+        # the names are split when the tag is parsed
+        tpl = template.Template('{% load ct_for %}{% ct_for x, y z in pairs %}'
+                                '{{ x }}{{ y }}{{ z }},{% endfor %}')
+        node = tpl.nodelist[-1]
+        self.assertEqual(node.container.kwargs['loopvars'], ('x', 'y', 'z'))
+        self.assertFalse('loopvars' in dict(node.container.dynamic_kwargs))
+
+        # variables an item has no value for fall back to the outer context
+        context = template.Context({'pairs': [(1, 2, 3), (4,), (5, 6)], 'y': 'Y', 'z': 'Z'})
+        depth = len(context.dicts)
+        self.assertEqual(tpl.render(context), u'123,4YZ,56Z,')
+        self.assertEqual(len(context.dicts), depth)
+        self.assertFalse('x' in context)
+
+        # names the body stores in the loop's frame stay set for the next
+        # items, as with django's {% for %}, but for loops unpacking items
+        class Remember(helpers.AsTag):
+            options = core.Options(
+                arguments.Argument('value'),
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+
+            def get_value(self, context, value):
+                return value
+
+        templates = [
+            ('{% load ct_for %}{% ct_for x in xs %}{{ seen }}{% if x == 1 %}'
+             '{% remember x as seen %}{{ seen }}{% endif %};{% endfor %}{{ seen }}',
+             'out1;1;out', {'xs': [1, 2], 'seen': 'out'}),
+            ('{% for x in xs %}{{ seen }}{% if x == 1 %}'
+             '{% remember x as seen %}{{ seen }}{% endif %};{% endfor %}{{ seen }}',
+             'out1;1;out', {'xs': [1, 2], 'seen': 'out'}),
+            ('{% load ct_for %}{% ct_for x, y in pairs %}{{ seen }}{% remember y as seen %}'
+             '{{ seen }};{% endfor %}', '1;2;3;', {'pairs': [(0, 1), (2, 2), (3, 3)]}),
+        ]
+        self._tag_tester(templates, Remember)
+
+    def test_50_prefetch(self):
+        from customtags import prefetch
+        from customtags_tests.models import Author, Book, Tag
+
+        self.assertEqual(prefetch.get_lookups(Book, [('author', 'name'), ('tags', 'all'),
+                                                     ('title',), ('missing', 'x')]),
+                         (['author'], ['tags']))
+        self.assertEqual(prefetch.get_lookups(Author, [('book_set', 'all')]),
+                         ([], ['book_set']))
+        self.assertEqual(prefetch.get_lookups(Book, [('author', 'book_set', 'count')]),
+                         (['author'], ['author__book_set']))
+
+        tags = [Tag.objects.create(name=name) for name in 'abc']
+        for index in range(5):
+            author = Author.objects.create(name='author%d' % index)
+            book = Book.objects.create(title='book%d' % index, author=author)
+            book.tags.add(*tags[:index % 3 + 1])
+
+        source = ('{%% load ct_for %%}{%% ct_for book in books %s %%}{{ book.title }} '
+                  'by {{ book.author.name }}:{%% for tag in book.tags.all %%}'
+                  '{{ tag.name }}{%% endfor %%},{%% endfor %%}')
+        expected = template.Template(source % '').render(
+            template.Context({'books': Book.objects.order_by('pk')}))
+        self.assertTrue(expected.startswith(u'book0 by author0:a,book1 by author1:ab,'))
+
+        tpl = template.Template(source % '')
+        with self.assertNumQueries(11):
+            tpl.render(template.Context({'books': Book.objects.order_by('pk')}))
+        tpl = template.Template(source % 'prefetch')
+        with self.assertNumQueries(2):
+            output = tpl.render(template.Context({'books': Book.objects.order_by('pk')}))
+        self.assertEqual(output, expected)
+
+        # through reverse relations
+        tpl = template.Template('{% load ct_for %}{% ct_for author in authors prefetch %}'
+                                '{% for book in author.book_set.all %}{{ book.title }}'
+                                '{% endfor %}{% endfor %}')
+        with self.assertNumQueries(2):
+            self.assertEqual(tpl.render(template.Context({'authors': Author.objects.order_by('pk')})),
+                             u'book0book1book2book3book4')
+
+        # evaluated querysets, values and other sequences are left alone
+        books = Book.objects.all()
+        list(books)
+        self.assertTrue(prefetch.prefetch_queryset(books, [('author',)]) is books)
+        values = Book.objects.values('title')
+        self.assertTrue(prefetch.prefetch_queryset(values, [('author',)]) is values)
+        self.assertEqual(prefetch.prefetch_queryset([1], [('author',)]), [1])
+
+    def test_51_batching(self):
+        from customtags import batching
+
+        calls = []
+        @batching.batchable
+        def price_for(ids):
+            calls.append(list(ids))
+            return [id * 10 for id in ids]
+
+        self.assertEqual(price_for.__name__, 'price_for')
+        self.assertEqual(price_for(2), 20)
+        self.assertEqual(calls, [[2]])
+
+        class Echo(core.Tag):
+            options = core.Options(arguments.Argument("arg"))
+            def render_tag(self, context, arg):
+                return arg
+        lib = template.Library()
+        lib.tag(Echo.as_tag())
+        builtins.append(lib)
+        try:
+            tpl = template.Template('{% load ct_for %}{% ct_for p in products %}'
+                                    '{{ p }}:{% echo price_for(p) %},{% endfor %}')
+
+            # one call per render for all of the keys, without duplicates
+            del calls[:]
+            context = template.Context({'products': [1, 2, 3, 2], 'price_for': price_for})
+            self.assertEqual(tpl.render(context), u'1:10,2:20,3:30,2:20,')
+            self.assertEqual(calls, [[1, 2, 3]])
+            self.assertEqual(batching.get_batch(context), None)
+
+            # and one per item without a batch
+            del calls[:]
+            unbatched = lambda id: price_for(id)
+            context = template.Context({'products': [1, 2, 3], 'price_for': unbatched})
+            self.assertEqual(tpl.render(context), u'1:10,2:20,3:30,')
+            self.assertEqual(calls, [[1], [2], [3]])
+
+            # nested loops join the batch of the outermost one
+            tpl = template.Template('{% load ct_for %}{% ct_for row in rows %}'
+                                    '{% ct_for p in row %}{% echo price_for(p) %} {% endfor %}|'
+                                    '{% endfor %}')
+            del calls[:]
+            context = template.Context({'rows': [[1, 2], [3], [1, 4]], 'price_for': price_for})
+            self.assertEqual(tpl.render(context), u'10 20 |30 |10 40 |')
+            self.assertEqual(calls, [[1, 2, 3, 4]])
+
+            # iterators are read once
+            del calls[:]
+            context = template.Context({'rows': iter([[5], [6]]), 'price_for': price_for})
+            self.assertEqual(tpl.render(context), u'50 |60 |')
+            self.assertEqual(calls, [[5, 6]])
+
+            # the rest of the body runs once per item
+            ticks = []
+            tpl = template.Template('{% load ct_for %}{% ct_for p in products %}'
+                                    '{% cycle "a" "b" %}{% echo price_for(p) %}{{ tick }},'
+                                    '{% endfor %}')
+            del calls[:]
+            context = template.Context({'products': [1, 2, 3], 'price_for': price_for,
+                                        'tick': lambda: ticks.append(1) or ''})
+            self.assertEqual(tpl.render(context), u'a10,b20,a30,')
+            self.assertEqual(calls, [[1, 2, 3]])
+            self.assertEqual(len(ticks), 3)
+
+            # keys depending on names the body binds are fetched one by one
+            tpl = template.Template('{% load ct_for ct_with %}{% ct_for p in products %}'
+                                    '{% ct_with p as q %}{% echo price_for(q) %}{% endwith %}'
+                                    '{% echo price_for(p) %},{% endfor %}')
+            del calls[:]
+            context = template.Context({'products': [1, 2], 'price_for': price_for, 'q': 9})
+            self.assertEqual(tpl.render(context), u'1010,2020,')
+            self.assertEqual(calls, [[1, 2]])
+        finally:
+            builtins.remove(lib)
+
+        batch = batching.Batch()
+        batch.add(price_for, 1)
+        describe = batching.batchable(lambda keys: [repr(key) for key in keys])
+        batch.add(describe, [1])
+        self.assertEqual(batch.call(describe, [1]), '[1]')
+        del calls[:]
+        batch.fetch()
+        self.assertEqual(calls, [[1]])
+        self.assertEqual(batch.call(price_for, 1), 10)
+        self.assertEqual(batch.call(price_for, 7), 70)
+        self.assertEqual(calls, [[1], [7]])
+
+        broken = batching.batchable(lambda ids: [])
+        self.assertRaises(ValueError, broken, 1)
+
+        # caches in the body keep the values of the batched calls
+        from django.core.cache import caches
+        from customtags.render_cache import RenderCache
+        caches['default'].clear()
+        class Price(core.Tag):
+            options = core.Options(arguments.Argument('amount'))
+            render_cache = RenderCache()
+            def render_tag(self, context, amount):
+                return '$%s' % amount
+        lib = template.Library()
+        lib.tag(Price.as_tag())
+        builtins.append(lib)
+        try:
+            tpl = template.Template(
+                '{% load ct_for ct_with customtags %}{% ct_for p in products %}'
+                '{% ct_cache 60 p %}[{% ct_with price_for(p) as x %}{{ x }}{% endwith %}]'
+                '{% endct_cache %}{% ct_with price_for(p) as x %}{% price x %}{% endwith %}'
+                '{% endfor %}')
+            del calls[:]
+            context = template.Context({'products': [1, 2], 'price_for': price_for})
+            self.assertEqual(tpl.render(context), u'[10]$10[20]$20')
+            self.assertEqual(calls, [[1, 2]])
+            self.assertEqual(tpl.render(context), u'[10]$10[20]$20')
+            self.assertEqual(Price.render_cache.stats()['size'], 2)
+
+            # errors are raised by the render
+            def fail():
+                raise ZeroDivisionError
+            tpl = template.Template('{% load ct_for ct_with %}{% ct_for p in products %}'
+                                    '{% ct_with fail() as y %}{% endwith %}'
+                                    '{% ct_with price_for(p) as x %}{{ x }}{% endwith %}'
+                                    '{% endfor %}')
+            del calls[:]
+            context = template.Context({'products': [1, 2], 'price_for': price_for,
+                                        'fail': fail})
+            self.assertRaises(ZeroDivisionError, tpl.render, context)
+            self.assertEqual(calls, [[1, 2]])
+        finally:
+            builtins.remove(lib)
+
+    def test_52_timing(self):
+        import os
+        import json
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command, CommandError
+        from customtags import codegen, rendering, timing
+        from customtags_tests.templatetags.ct_for import For
+        from customtags_tests.templatetags.ct_with import With
+
+        render, parse = core.Tag.__dict__['render'], core.Tag.__dict__['parse']
+        render_into = core.Tag.__dict__['render_into']
+        render_stream = core.Tag.__dict__['render_stream']
+        source = ('{% load ct_for ct_with %}{% ct_for x in seq %}'
+                  '{% ct_with x as y %}{{ y }}{% endwith %}{% endfor %}')
+
+        timing.reset_timings()
+        tpl = template.Template(source)
+        tpl.render(template.Context({'seq': range(10)}))
+        self.assertEqual(timing.get_timings(), [])
+        self.assertFalse(timing.is_enabled())
+
+        timing.enable()
+        try:
+            self.assertTrue(timing.is_enabled())
+            self.assertFalse(codegen.is_compilable_tag(tpl.nodelist[-1]))
+            tpl = template.Template(source)
+            self.assertEqual(tpl.render(template.Context({'seq': range(10)})), u'0123456789')
+            timings = dict(((data['phase'], data['name']), data)
+                           for data in timing.get_timings())
+            self.assertEqual(sorted(timings), [('parse', 'ct_for'), ('parse', 'ct_with'),
+                                               ('render', 'ct_for'), ('render', 'ct_with')])
+            self.assertEqual(timings['render', 'ct_with']['count'], 10)
+            self.assertEqual(timings['render', 'ct_for']['count'], 1)
+            self.assertEqual(timings['render', 'ct_for']['tag'], timing.get_tag_label(For))
+            data = timings['render', 'ct_with']
+            self.assertTrue(0 < data['p50'] <= data['p95'] <= data['p99'] <= data['max'])
+            self.assertTrue(data['max'] <= data['total'])
+            self.assertEqual(sum(data['buckets'].values()), 10)
+            # nested tags are part of the render time of the loop
+            self.assertTrue(timings['render', 'ct_for']['total'] > data['total'])
+
+            # tags written into an output or streamed are timed once each
+            for render_template in (
+                    lambda context: rendering.render_template_into(tpl, context, []),
+                    lambda context: list(rendering.iter_template(tpl, context))):
+                timing.reset_timings()
+                render_template(template.Context({'seq': range(10)}))
+                timings = dict(((data['phase'], data['name']), data['count'])
+                               for data in timing.get_timings())
+                self.assertEqual(timings, {('render', 'ct_for'): 1, ('render', 'ct_with'): 10})
+
+            timing.reset_timings()
+            timing.enable(0.5)
+            tpl.render(template.Context({'seq': range(10)}))
+            timings = dict(((data['phase'], data['name']), data)
+                           for data in timing.get_timings())
+            self.assertEqual(timings['render', 'ct_with']['count'], 5)
+            self.assertRaises(ValueError, timing.enable, 0)
+        finally:
+            timing.disable()
+        self.assertFalse(timing.is_enabled())
+        self.assertTrue(core.Tag.__dict__['render'] is render)
+        self.assertTrue(core.Tag.__dict__['parse'] is parse)
+        self.assertTrue(core.Tag.__dict__['render_into'] is render_into)
+        self.assertTrue(core.Tag.__dict__['render_stream'] is render_stream)
+
+        histogram = timing.Histogram('tag', 'name', 'render')
+        self.assertEqual(histogram.percentile(50), None)
+        for duration in [0.001] * 90 + [0.1] * 10:
+            histogram.add(duration)
+        self.assertTrue(0.001 <= histogram.percentile(50) < 0.0012)
+        self.assertTrue(0.001 <= histogram.percentile(90) < 0.0012)
+        self.assertTrue(0.1 <= histogram.percentile(95) <= 0.1 * 1.2)
+        self.assertEqual(timing.get_bucket(0), 0)
+        self.assertEqual(timing.get_bucket(1e6), timing.BUCKET_COUNT - 1)
+
+        # snapshots of several processes are merged
+        merged = timing.merge_timings([[histogram.as_dict()], [histogram.as_dict()]])
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0]['count'], 200)
+        self.assertEqual(merged[0]['p95'], histogram.percentile(95))
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            timing.reset_timings()
+            timing.record('render', With, 0.002)
+            timing.write_timings(path)
+            with open(path) as snapshot:
+                self.assertEqual(json.load(snapshot)[0]['name'], 'ct_with')
+            out = StringIO()
+            call_command('customtags_timings', path, path, stdout=out)
+            self.assertTrue('ct_with' in out.getvalue())
+            self.assertTrue('       2      4.000' in out.getvalue())
+
+            out = StringIO()
+            call_command('customtags_timings', template=['test_with.html'],
+                         iterations=3, phase='render', stdout=out)
+            report = out.getvalue()
+            self.assertTrue('render          3' in report)
+            self.assertFalse('parse' in report.splitlines()[1])
+            self.assertFalse(timing.is_enabled())
+
+            # timing enabled beforehand keeps its rate and histograms
+            timing.reset_timings()
+            timing.enable(0.5)
+            try:
+                timing.record('render', With, 0.002)
+                call_command('customtags_timings', template=['test_with.html'],
+                             iterations=3, stdout=StringIO())
+                self.assertEqual(timing.get_enabled_sample_rate(), 0.5)
+                self.assertEqual([(data['name'], data['count'])
+                                  for data in timing.get_timings()], [('ct_with', 1)])
+            finally:
+                timing.disable()
+            self.assertEqual(timing.get_enabled_sample_rate(), None)
+            self.assertRaises(CommandError, call_command, 'customtags_timings',
+                              stdout=StringIO())
+        finally:
+            os.remove(path)
+            timing.reset_timings()
+
     def test_99_middleware(self):
         """
         This needs to be last because it modifies the global "builtins" store 
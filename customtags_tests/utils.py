@@ -1,6 +1,7 @@
 
 from django import template
-from timeit import Timer
+from timeit import Timer, default_timer
+import gc
 import os
 
 class TagPool(dict):
@@ -28,10 +29,15 @@ class PseudoSettings:
     USE_I18N = False
     TEMPLATE_STRING_IF_INVALID = ''
 template.settings = PseudoSettings
-template.builtins.insert(0, register)
+from django.template.base import builtins
+builtins.insert(0, register)
 ct_tpl, dj_tpl, ctx = get_performance_suite()
 tpl = %s_tpl"""
 
+CODEGEN_SETUP = """
+from customtags import codegen
+codegen.compile_template(tpl)"""
+
 
 class Benchmark(object): # pragma: no cover
     def __init__(self, tag):
@@ -43,8 +49,11 @@ class Benchmark(object): # pragma: no cover
     def classy(self, iterations):
         return self._timeit('ct', iterations)
     
-    def _timeit(self, prefix, iterations):
-        t = Timer("tpl.render(ctx)", SETUP % (self.mod, prefix))
+    def compiled(self, iterations):
+        return self._timeit('ct', iterations, CODEGEN_SETUP)
+
+    def _timeit(self, prefix, iterations, extra_setup=''):
+        t = Timer("tpl.render(ctx)", SETUP % (self.mod, prefix) + extra_setup)
         return t.timeit(iterations)
 
 
@@ -66,3 +75,211 @@ class Renderer(object):
         return rendered
 
 
+
+
+def build_grammar_arguments(size):
+    """
+    Returns *size* arguments cycling through the argument types that
+    ``structure_arguments`` treats differently.
+    """
+    from customtags.arguments import Argument, Flag, Optional, MultiValueArgument
+    arguments = []
+    for i in range(size):
+        kind = i % 6
+        if kind == 0:
+            arguments.append('kw%d' % i)
+        elif kind == 1:
+            arguments.append(Argument('a%d' % i))
+        elif kind == 2:
+            arguments.append(Argument('b%d' % i, required=False))
+        elif kind == 3:
+            arguments.append(Flag('f%d' % i, true_values=['on%d' % i], default=False))
+        elif kind == 4:
+            arguments.append(Optional('opt%d' % i, Argument('o%d' % i)))
+        else:
+            arguments.append(MultiValueArgument('m%d' % i, required=False))
+    return arguments
+
+
+class GrammarBenchmark(object): # pragma: no cover
+    def __init__(self, size):
+        self.size = size
+
+    def structure(self, iterations):
+        """
+        Times ``Options.initialize`` alone; the arguments are built beforehand
+        since initializing an Options object consumes it.
+        """
+        from customtags.core import Options
+        options = [Options(*build_grammar_arguments(self.size))
+                   for i in range(iterations)]
+        gc.disable()
+        try:
+            start = default_timer()
+            for opts in options:
+                opts.initialize('grammar')
+            return default_timer() - start
+        finally:
+            gc.enable()
+
+    def subclass(self, iterations):
+        """
+        Times the creation of Tag subclasses that inherit their options.
+        """
+        from customtags.core import Tag, Options
+        parent = type('GrammarParent', (Tag,), {
+            'options': Options(*build_grammar_arguments(self.size)),
+        })
+        gc.disable()
+        try:
+            start = default_timer()
+            for i in range(iterations):
+                type('GrammarChild', (parent,), {})
+            return default_timer() - start
+        finally:
+            gc.enable()
+
+
+LIBRARY_TAG = '''
+class Tag%(index)d(core.Tag):
+    name = 'tag_%(index)d'
+    options = core.Options(
+        arguments.Argument('value'),
+        arguments.MultiValueKeywordArgument('kwargs', required=False),
+        arguments.Flag('flag', true_values=['on'], default=False),
+        'as',
+        arguments.Argument('varname', required=False, resolve=False),
+        blocks=['middle_%(index)d', 'end_%(index)d'],
+    )
+
+    def render_tag(self, context, **kwargs):
+        return ''
+
+register.tag(Tag%(index)d.as_tag())
+'''
+
+
+def build_library_source(tags):
+    """
+    Returns the source of a templatetag module registering *tags* tags.
+    """
+    source = ["from django import template",
+              "from customtags import core, arguments",
+              "register = template.Library()"]
+    for index in range(tags):
+        source.append(LIBRARY_TAG % {'index': index})
+    return "\n".join(source)
+
+
+class StartupBenchmark(object): # pragma: no cover
+    def __init__(self, tags):
+        self.code = compile(build_library_source(tags), '<library>', 'exec')
+
+    def import_library(self, lazy):
+        """
+        Times executing the library module, with lazy options or without.
+        """
+        from django.test.utils import override_settings
+        gc.disable()
+        try:
+            with override_settings(CUSTOMTAGS_LAZY_OPTIONS=lazy):
+                start = default_timer()
+                exec self.code in {}
+                return default_timer() - start
+        finally:
+            gc.enable()
+
+
+BRANCH_SOURCE = '''{%% ct_for item in items %%}{{ item }}{%% empty %%}
+{%% ct_with "%(index)d" as index %%}{%% for row in rows %%}<p>{{ index }}{{ row.name|upper }}
+{%% if row.flag %%}{{ row.value|default:"-" }}{%% else %%}{{ row.other }}{%% endif %%}</p>
+{%% endfor %%}{%% endwith %%}{%% endfor %%}'''
+
+
+def build_branches_source(branches):
+    """
+    Returns the source of a template of *branches* loops, each with a large
+    ``{% empty %}`` body that is only rendered for empty sequences.
+    """
+    source = ["{% load ct_for ct_with %}"]
+    for index in range(branches):
+        source.append(BRANCH_SOURCE % {'index': index})
+    return "\n".join(source)
+
+
+class CompileBenchmark(object): # pragma: no cover
+    def __init__(self, branches):
+        self.source = build_branches_source(branches)
+
+    def compile_template(self, lazy):
+        """
+        Times compiling the template, with lazy bodies or without, and
+        rendering it once without taking the branches.
+        """
+        from django.test.utils import override_settings
+        gc.disable()
+        try:
+            with override_settings(CUSTOMTAGS_LAZY_NODELISTS=lazy):
+                start = default_timer()
+                compiled = template.Template(self.source)
+                compiling = default_timer() - start
+                compiled.render(template.Context({'items': [1]}))
+                return compiling, default_timer() - start - compiling
+        finally:
+            gc.enable()
+
+
+NESTED_OPEN = '''{%% ct_with "%(index)d" as level%(index)d %%}<div class="level{{ level%(index)d }}">
+{%% ct_for item%(index)d in items %%}<p>{{ item%(index)d }} of {{ level%(index)d }}: %(text)s</p>
+'''
+
+NESTED_CLOSE = '''{% endfor %}</div>{% endwith %}
+'''
+
+
+def build_nested_source(depth, text='x' * 200):
+    """
+    Returns the source of a template of *depth* ``ct_with`` blocks, each
+    holding a ``ct_for`` loop with the next one.
+    """
+    source = ["{% load ct_for ct_with %}"]
+    for index in range(depth):
+        source.append(NESTED_OPEN % {'index': index, 'text': text})
+    source.append(NESTED_CLOSE * depth)
+    return "".join(source)
+
+
+class NestingBenchmark(object): # pragma: no cover
+    def __init__(self, depth, items=2):
+        self.template = template.Template(build_nested_source(depth))
+        self.data = {'items': range(items)}
+
+    def get_context(self):
+        return template.Context(self.data)
+
+    def render(self, iterations):
+        """
+        Times rendering the template, every tag returning its output.
+        """
+        return self._time(iterations, lambda context: self.template.render(context))
+
+    def render_into(self, iterations):
+        """
+        Times rendering the template into a single list.
+        """
+        from customtags import rendering
+        def render(context):
+            out = []
+            rendering.render_template_into(self.template, context, out)
+            return u''.join(out)
+        return self._time(iterations, render)
+
+    def _time(self, iterations, render):
+        gc.disable()
+        try:
+            start = default_timer()
+            for i in range(iterations):
+                render(self.get_context())
+            return default_timer() - start
+        finally:
+            gc.enable()